@@ -0,0 +1,458 @@
+"""
+An in-process, in-memory stand-in for S3, for benchmarks
+
+It implements just enough of the S3 REST API, with path-style addressing
+and no authentication, for boto 2 and the s3-mp-* tools: bucket listings
+(with a delimiter) and locations, object PUT, GET (with Range), HEAD (with partNumber), DELETE and PUT-copy,
+and MultiPartUploads (initiate, upload part, upload part copy, list parts,
+list uploads, complete and abort). Completed uploads get the same
+md5-of-md5s ETag S3 gives them.
+
+Every response can be delayed by a fixed latency, and every connection's
+bodies can be capped to a bandwidth, to look more like a real endpoint.
+Requests are counted by HTTP method. fail_hook, if set, is called with the
+method and path of every GET, PUT and POST, and can return an HTTP status
+to fail the request with (503 is sent as SlowDown).
+
+    server = FakeS3Server(latency=0.02, bandwidth=50*1024*1024).start()
+    server.store.buckets["bench"] = {}
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import re
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from xml.sax.saxutils import escape
+
+# Size of the writes and reads that bandwidth caps are applied to
+BLOCK_SIZE = 64*1024
+
+LAST_MODIFIED = "2015-01-01T00:00:00.000Z"
+
+def _xml(body):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + body
+
+class Store(object):
+    """
+    The buckets, objects and MultiPartUploads of a FakeS3Server
+
+    buckets maps bucket names to dicts of key names to objects, each a dict
+    of data, etag, meta, content_type, storage_class and (for completed
+    MultiPartUploads) part_sizes. regions maps bucket names to the region
+    ?location reports, which is US Standard for buckets not in it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.regions = {}
+        self.uploads = {}
+        self.requests = {}
+
+    def count(self, method):
+        self.lock.acquire()
+        try:
+            self.requests[method] = self.requests.get(method, 0) + 1
+        finally:
+            self.lock.release()
+
+    def reset_counts(self):
+        """
+        Return the request counts so far, and start counting from zero
+        """
+        self.lock.acquire()
+        try:
+            counts, self.requests = self.requests, {}
+            return counts
+        finally:
+            self.lock.release()
+
+    def put_object(self, bucket, key, data):
+        """
+        Store an object directly, as if it had been uploaded with a PUT
+        """
+        self.buckets.setdefault(bucket, {})[key] = {"data": data, "etag": hashlib.md5(data).hexdigest(),
+                "meta": {}, "content_type": "application/octet-stream", "storage_class": "STANDARD"}
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _parse(self):
+        split = urlparse.urlsplit(self.path)
+        parts = split.path.split("/", 2)
+        bucket = urllib.unquote(parts[1]) if len(parts) > 1 else ""
+        key = urllib.unquote(parts[2]) if len(parts) > 2 else ""
+        query = dict(urlparse.parse_qsl(split.query, keep_blank_values=True))
+        return bucket, key, query
+
+    def _send(self, status, body="", headers=None):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        headers = headers or {}
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD" and body:
+            self._write(body)
+
+    def _write(self, body):
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        for i in range(0, len(body), BLOCK_SIZE):
+            block = body[i:i+BLOCK_SIZE]
+            self.wfile.write(block)
+            time.sleep(float(len(block)) / bandwidth)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        bandwidth = self.server.bandwidth
+        data = []
+        while length:
+            block = self.rfile.read(min(length, BLOCK_SIZE))
+            if not block:
+                break
+            data.append(block)
+            length -= len(block)
+            if bandwidth:
+                time.sleep(float(len(block)) / bandwidth)
+        return "".join(data)
+
+    def _error(self, status, code):
+        self._send(status, _xml("<Error><Code>%s</Code><Message>%s</Message></Error>" % (code, code)),
+                {"Content-Type": "application/xml"})
+
+    def _failed(self):
+        """
+        Send the error fail_hook asks for, if any, returning True if it did
+        """
+        if self.server.fail_hook is None:
+            return False
+        status = self.server.fail_hook(self.command, self.path)
+        if not status:
+            return False
+        self._error(status, status == 503 and "SlowDown" or "InternalError")
+        return True
+
+    def _meta(self):
+        return dict((k[len("x-amz-meta-"):], v) for k, v in self.headers.items()
+                if k.lower().startswith("x-amz-meta-"))
+
+    def _obj_headers(self, obj, length):
+        headers = {"Content-Length": str(length), "ETag": '"%s"' % obj["etag"],
+                   "Last-Modified": "Thu, 01 Jan 2015 00:00:00 GMT",
+                   "Content-Type": obj.get("content_type", "application/octet-stream")}
+        for k, v in obj.get("meta", {}).items():
+            headers["x-amz-meta-" + k] = v
+        if obj.get("storage_class", "STANDARD") != "STANDARD":
+            headers["x-amz-storage-class"] = obj["storage_class"]
+        return headers
+
+    def _copy_source(self):
+        src = urllib.unquote(self.headers.get("x-amz-copy-source")).lstrip("/")
+        bucket, key = src.split("/", 1)
+        return self.store.buckets.get(bucket, {}).get(key.split("?")[0])
+
+    def do_HEAD(self):
+        self.store.count("HEAD")
+        bucket, key, query = self._parse()
+        objects = self.store.buckets.get(bucket)
+        if objects is None:
+            return self._send(404)
+        if not key:
+            return self._send(200)
+        obj = objects.get(key)
+        if obj is None:
+            return self._send(404)
+        if "partNumber" in query:
+            sizes = obj.get("part_sizes") or [len(obj["data"])]
+            return self._send(206, "", self._obj_headers(obj, sizes[int(query["partNumber"]) - 1]))
+        self._send(200, "", self._obj_headers(obj, len(obj["data"])))
+
+    def do_GET(self):
+        self.store.count("GET")
+        if self._failed():
+            return
+        bucket, key, query = self._parse()
+        objects = self.store.buckets.get(bucket)
+        if objects is None:
+            return self._error(404, "NoSuchBucket")
+        if not key:
+            if "location" in query:
+                return self._send(200, _xml('<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                        '%s</LocationConstraint>' % self.store.regions.get(bucket, "")),
+                        {"Content-Type": "application/xml"})
+            if "uploads" in query:
+                return self._list_uploads(bucket, query)
+            return self._list_objects(bucket, objects, query)
+        if "uploadId" in query:
+            return self._list_parts(bucket, key, query)
+        obj = objects.get(key)
+        if obj is None:
+            return self._error(404, "NoSuchKey")
+        data = obj["data"]
+        m = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if m is None:
+            return self._send(200, data, self._obj_headers(obj, len(data)))
+        start = int(m.group(1))
+        end = min(m.group(2) and int(m.group(2)) or len(data) - 1, len(data) - 1)
+        body = data[start:end+1]
+        headers = self._obj_headers(obj, len(body))
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+        self._send(206, body, headers)
+
+    def _list_objects(self, bucket, objects, query):
+        prefix = query.get("prefix", "")
+        marker = query.get("marker", "")
+        delimiter = query.get("delimiter", "")
+        max_keys = int(query.get("max-keys", 1000))
+        # Keys with the delimiter after the prefix are rolled up into one
+        # common prefix each
+        entries = set()
+        for k in objects:
+            if not k.startswith(prefix):
+                continue
+            i = -1
+            if delimiter:
+                i = k.find(delimiter, len(prefix))
+            entries.add(i >= 0 and k[:i+len(delimiter)] or k)
+        entries = sorted(e for e in entries if e > marker)
+        truncated = len(entries) > max_keys
+        entries = entries[:max_keys]
+        contents = "".join("<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>&quot;%s&quot;</ETag>"
+                "<Size>%d</Size><StorageClass>%s</StorageClass></Contents>"
+                % (escape(k), LAST_MODIFIED, objects[k]["etag"], len(objects[k]["data"]),
+                   objects[k].get("storage_class", "STANDARD")) for k in entries if k in objects)
+        prefixes = "".join("<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>" % escape(e)
+                for e in entries if e not in objects)
+        next_marker = ""
+        if truncated and delimiter:
+            next_marker = "<NextMarker>%s</NextMarker>" % escape(entries[-1])
+        self._send(200, _xml('<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>%s<MaxKeys>%d</MaxKeys>'
+                '<Delimiter>%s</Delimiter><IsTruncated>%s</IsTruncated>%s%s</ListBucketResult>'
+                % (bucket, escape(prefix), escape(marker), next_marker, max_keys, escape(delimiter),
+                   truncated and "true" or "false", contents, prefixes)),
+                {"Content-Type": "application/xml"})
+
+    def _list_uploads(self, bucket, query):
+        prefix = query.get("prefix", "")
+        markers = (query.get("key-marker", ""), query.get("upload-id-marker", ""))
+        max_uploads = int(query.get("max-uploads", 1000))
+        uploads = sorted((u["key"], upload_id, u) for upload_id, u in self.store.uploads.items()
+                if u["bucket"] == bucket and u["key"].startswith(prefix) and (u["key"], upload_id) > markers)
+        truncated = len(uploads) > max_uploads
+        uploads = uploads[:max_uploads]
+        owner = "<ID>fake</ID><DisplayName>fake</DisplayName>"
+        items = "".join("<Upload><Key>%s</Key><UploadId>%s</UploadId><Initiator>%s</Initiator><Owner>%s</Owner>"
+                "<StorageClass>%s</StorageClass><Initiated>%s</Initiated></Upload>"
+                % (escape(k), upload_id, owner, owner, u["storage_class"], u["initiated"])
+                for k, upload_id, u in uploads)
+        next_markers = ""
+        if truncated:
+            next_markers = ("<NextKeyMarker>%s</NextKeyMarker><NextUploadIdMarker>%s</NextUploadIdMarker>"
+                    % (escape(uploads[-1][0]), uploads[-1][1]))
+        self._send(200, _xml('<ListMultipartUploadsResult><Bucket>%s</Bucket><KeyMarker>%s</KeyMarker>'
+                '<UploadIdMarker>%s</UploadIdMarker>%s<MaxUploads>%d</MaxUploads><IsTruncated>%s</IsTruncated>'
+                '%s</ListMultipartUploadsResult>'
+                % (bucket, escape(markers[0]), markers[1], next_markers, max_uploads,
+                   truncated and "true" or "false", items)),
+                {"Content-Type": "application/xml"})
+
+    def _list_parts(self, bucket, key, query):
+        upload = self.store.uploads.get(query["uploadId"])
+        if upload is None:
+            return self._error(404, "NoSuchUpload")
+        marker = int(query.get("part-number-marker") or 0)
+        max_parts = int(query.get("max-parts", 1000))
+        numbers = sorted(n for n in upload["parts"] if n > marker)
+        truncated = len(numbers) > max_parts
+        numbers = numbers[:max_parts]
+        items = "".join("<Part><PartNumber>%d</PartNumber><LastModified>%s</LastModified>"
+                "<ETag>&quot;%s&quot;</ETag><Size>%d</Size></Part>"
+                % (n, LAST_MODIFIED, upload["parts"][n][1], len(upload["parts"][n][0])) for n in numbers)
+        next_marker = ""
+        if truncated:
+            next_marker = "<NextPartNumberMarker>%d</NextPartNumberMarker>" % numbers[-1]
+        owner = "<ID>fake</ID><DisplayName>fake</DisplayName>"
+        self._send(200, _xml('<ListPartsResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                '<Initiator>%s</Initiator><Owner>%s</Owner><StorageClass>%s</StorageClass>'
+                '<PartNumberMarker>%d</PartNumberMarker>%s<MaxParts>%d</MaxParts><IsTruncated>%s</IsTruncated>'
+                '%s</ListPartsResult>'
+                % (bucket, escape(key), query["uploadId"], owner, owner, upload["storage_class"], marker,
+                   next_marker, max_parts, truncated and "true" or "false", items)),
+                {"Content-Type": "application/xml"})
+
+    def do_PUT(self):
+        self.store.count("PUT")
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if self._failed():
+            return
+        if not key:
+            self.store.buckets.setdefault(bucket, {})
+            return self._send(200)
+        objects = self.store.buckets.get(bucket)
+        if objects is None:
+            return self._error(404, "NoSuchBucket")
+        if "uploadId" in query:
+            return self._put_part(query, body)
+
+        if self.headers.get("x-amz-copy-source"):
+            src = self._copy_source()
+            if src is None:
+                return self._error(404, "NoSuchKey")
+            obj = dict(src)
+            if self.headers.get("x-amz-metadata-directive") == "REPLACE":
+                obj["meta"] = self._meta()
+                obj["content_type"] = self.headers.get("Content-Type", "application/octet-stream")
+            obj["storage_class"] = self.headers.get("x-amz-storage-class", "STANDARD")
+            obj.pop("part_sizes", None)
+            objects[key] = obj
+            return self._send(200, _xml("<CopyObjectResult><LastModified>%s</LastModified>"
+                    "<ETag>&quot;%s&quot;</ETag></CopyObjectResult>" % (LAST_MODIFIED, obj["etag"])),
+                    {"Content-Type": "application/xml"})
+
+        md5 = self.headers.get("Content-MD5")
+        if md5 and md5.decode("base64") != hashlib.md5(body).digest():
+            return self._error(400, "BadDigest")
+        etag = hashlib.md5(body).hexdigest()
+        objects[key] = {"data": body, "etag": etag, "meta": self._meta(),
+                "content_type": self.headers.get("Content-Type", "application/octet-stream"),
+                "storage_class": self.headers.get("x-amz-storage-class", "STANDARD")}
+        self._send(200, "", {"ETag": '"%s"' % etag})
+
+    def _put_part(self, query, body):
+        upload = self.store.uploads.get(query["uploadId"])
+        if upload is None:
+            return self._error(404, "NoSuchUpload")
+        part_num = int(query["partNumber"])
+        if not self.headers.get("x-amz-copy-source"):
+            md5 = self.headers.get("Content-MD5")
+            if md5 and md5.decode("base64") != hashlib.md5(body).digest():
+                return self._error(400, "BadDigest")
+            etag = hashlib.md5(body).hexdigest()
+            upload["parts"][part_num] = (body, etag)
+            return self._send(200, "", {"ETag": '"%s"' % etag})
+
+        src = self._copy_source()
+        if src is None:
+            return self._error(404, "NoSuchKey")
+        data = src["data"]
+        m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("x-amz-copy-source-range") or "")
+        if m is not None:
+            data = data[int(m.group(1)):int(m.group(2))+1]
+        etag = hashlib.md5(data).hexdigest()
+        upload["parts"][part_num] = (data, etag)
+        self._send(200, _xml("<CopyPartResult><LastModified>%s</LastModified>"
+                "<ETag>&quot;%s&quot;</ETag></CopyPartResult>" % (LAST_MODIFIED, etag)),
+                {"Content-Type": "application/xml"})
+
+    def do_POST(self):
+        self.store.count("POST")
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if self._failed():
+            return
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.store.uploads[upload_id] = {"bucket": bucket, "key": key, "parts": {}, "meta": self._meta(),
+                    "content_type": self.headers.get("Content-Type", "application/octet-stream"),
+                    "storage_class": self.headers.get("x-amz-storage-class", "STANDARD"),
+                    "initiated": LAST_MODIFIED}
+            return self._send(200, _xml("<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>"
+                    "<UploadId>%s</UploadId></InitiateMultipartUploadResult>" % (bucket, escape(key), upload_id)),
+                    {"Content-Type": "application/xml"})
+        if "uploadId" not in query:
+            return self._error(400, "InvalidRequest")
+
+        upload = self.store.uploads.pop(query["uploadId"], None)
+        if upload is None:
+            return self._error(404, "NoSuchUpload")
+        numbers = [int(n) for n in re.findall(r"<PartNumber>(\d+)</PartNumber>", body)]
+        if not numbers or any(n not in upload["parts"] for n in numbers):
+            self.store.uploads[query["uploadId"]] = upload
+            return self._error(400, "InvalidPart")
+        digest = hashlib.md5("".join(upload["parts"][n][1].decode("hex") for n in numbers)).hexdigest()
+        etag = "%s-%d" % (digest, len(numbers))
+        self.store.buckets[bucket][key] = {"data": "".join(upload["parts"][n][0] for n in numbers),
+                "etag": etag, "meta": upload["meta"], "content_type": upload["content_type"],
+                "storage_class": upload["storage_class"],
+                "part_sizes": [len(upload["parts"][n][0]) for n in numbers]}
+        self._send(200, _xml("<CompleteMultipartUploadResult><Location>http://fakes3/%s/%s</Location>"
+                "<Bucket>%s</Bucket><Key>%s</Key><ETag>&quot;%s&quot;</ETag></CompleteMultipartUploadResult>"
+                % (bucket, escape(key), bucket, escape(key), etag)),
+                {"Content-Type": "application/xml"})
+
+    def do_DELETE(self):
+        self.store.count("DELETE")
+        bucket, key, query = self._parse()
+        if "uploadId" in query:
+            if self.store.uploads.pop(query["uploadId"], None) is None:
+                return self._error(404, "NoSuchUpload")
+            return self._send(204)
+        self.store.buckets.get(bucket, {}).pop(key, None)
+        self._send(204)
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP server for Handler, listening on localhost
+
+    :type port: int
+    :param port: Port to listen on, 0 to pick a free one
+
+    :type latency: float
+    :param latency: Seconds to wait before sending each response
+
+    :type bandwidth: int
+    :param bandwidth: Cap on each connection's request and response
+                      bodies, in bytes per second, or 0 for no cap
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0, bandwidth=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.store = Store()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_hook = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serve requests from a daemon thread, returning self
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def boto_config(self):
+        """
+        Return a boto config file's contents pointing boto at this server
+
+        The s3-mp-* tools need --insecure to talk to it, as they default
+        to HTTPS.
+        """
+        return ("[Credentials]\naws_access_key_id = fake\naws_secret_access_key = fake\n"
+                "s3_host = 127.0.0.1\ns3_port = %d\n\n[Boto]\nis_secure = False\n" % self.port)
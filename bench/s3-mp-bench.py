@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Benchmark s3-mp-upload, s3-mp-download and s3-mp-copy against a fake S3
+
+Starts bench/fakes3.py in this process, then runs each tool, as a separate
+process pointed at it through BOTO_CONFIG, over a grid of object sizes,
+split sizes, worker counts and engines. Every run records its wall time,
+throughput, peak RSS (the tool's and its pool workers' together, sampled
+from /proc, so Linux only) and the number of requests of each kind the
+fake served.
+
+Absolute numbers say more about the fake than about S3; compare runs of
+the same grid before and after a change. --latency and --bandwidth make the
+fake behave more like a remote endpoint, which is where -np and --split
+start to matter.
+
+    $ bench/s3-mp-bench.py --sizes 16,128 --splits 5,32 --workers 2,8 -o before.csv
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakes3 import FakeS3Server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OPERATIONS = ("upload", "download", "copy")
+METHODS = ("GET", "PUT", "POST", "HEAD", "DELETE")
+COLUMNS = ("operation", "engine", "size_mb", "split_mb", "workers", "seconds", "MBps",
+           "peak_rss_mb", "requests") + METHODS + ("ok",)
+BUCKET = "bench"
+MB = 1024*1024
+
+# Seconds between samples of the tools' memory use
+RSS_INTERVAL = 0.05
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+parser = argparse.ArgumentParser(description="Benchmark the s3-mp-* tools against a local fake S3",
+        prog="s3-mp-bench")
+parser.add_argument("--sizes", help="Object sizes, in Mb (default 8,64)", type=int_list, default=[8, 64])
+parser.add_argument("--splits", help="Split sizes, in Mb (default 5,16)", type=int_list, default=[5, 16])
+parser.add_argument("--workers", help="Numbers of workers (default 2,8)", type=int_list, default=[2, 8])
+parser.add_argument("--engines", help="Engines to run (default process)", default="process")
+parser.add_argument("--operations", help="Tools to run (default upload,download,copy)",
+        default=",".join(OPERATIONS))
+parser.add_argument("--latency", help="Seconds the fake waits before each response", type=float, default=0)
+parser.add_argument("--bandwidth", help="Cap on each connection to the fake, in Mb/s (default none)",
+        type=float, default=0)
+parser.add_argument("--repeat", help="Run each combination this many times", type=int, default=1)
+parser.add_argument("--extra", help="More arguments for every tool, joined to the flag with '=' "
+        "since they start with '-', such as --extra=--verify", default="")
+parser.add_argument("-o", "--output", help="Write results to this file: CSV if it ends in .csv, "
+        "otherwise JSON")
+parser.add_argument("-v", "--verbose", help="Show the tools' output", default=False, action="store_true")
+
+logger = logging.getLogger("s3-mp-bench")
+
+def make_file(path, size):
+    """
+    Write size bytes of random data to path
+    """
+    fp = open(path, "wb")
+    try:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(MB, remaining))
+            fp.write(block)
+            remaining -= len(block)
+    finally:
+        fp.close()
+
+def tree_rss(pid):
+    """
+    Return the total RSS, in Kb, of a process and all of its descendants
+
+    ru_maxrss can't be used for this, as a child starts out with the peak
+    RSS of the process that forked it, which here includes the fake's data.
+    """
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = open("/proc/%s/stat" % entry).read()
+        except IOError:
+            continue
+        # The command name in brackets may contain spaces
+        parents[int(entry)] = int(stat.rsplit(")", 1)[1].split()[1])
+    pids = set([pid])
+    added = True
+    while added:
+        added = False
+        for child, parent in parents.items():
+            if parent in pids and child not in pids:
+                pids.add(child)
+                added = True
+    total = 0
+    for p in pids:
+        try:
+            for line in open("/proc/%d/status" % p):
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        except IOError:
+            pass
+    return total
+
+def run_tool(tool, args, env, verbose=False):
+    """
+    Run one of the s3-mp-* tools to completion
+
+    :rtype: tuple of (float, int, int)
+    :returns: Wall time, peak RSS in Kb, and exit status
+    """
+    cmd = [sys.executable, os.path.join(ROOT, "s3-mp-%s.py" % tool)] + args
+    logger.debug("Running %s" % " ".join(cmd))
+    out = not verbose and open(os.devnull, "w") or None
+    try:
+        t1 = time.time()
+        proc = subprocess.Popen(cmd, env=env, stdout=out, stderr=out)
+        peak_rss = 0
+        while proc.poll() is None:
+            peak_rss = max(peak_rss, tree_rss(proc.pid))
+            time.sleep(RSS_INTERVAL)
+        return time.time() - t1, peak_rss, proc.returncode
+    finally:
+        if out is not None:
+            out.close()
+
+def gen_runs(options):
+    for size in options.sizes:
+        for split in options.splits:
+            for workers in options.workers:
+                for engine in options.engines.split(","):
+                    for operation in options.operations.split(","):
+                        for _ in range(options.repeat):
+                            yield operation, engine, size, split, workers
+
+def bench(server, workdir, env, operation, engine, size, split, workers, extra, verbose=False):
+    """
+    Run one combination and return its row of results
+    """
+    store = server.store
+    src = os.path.join(workdir, "src-%d" % size)
+    if not os.path.exists(src):
+        make_file(src, size*MB)
+    key_name = "src-%d" % size
+    if operation != "upload" and key_name not in store.buckets[BUCKET]:
+        store.put_object(BUCKET, key_name, open(src, "rb").read())
+
+    common = ["-f", "-np", str(workers), "-e", engine, "-s", str(split)] + extra
+    dest = os.path.join(workdir, "dest")
+    if operation == "upload":
+        args = ["--insecure"] + common + [src, "s3://%s/upload" % BUCKET]
+    elif operation == "download":
+        args = ["--insecure"] + common + ["s3://%s/%s" % (BUCKET, key_name), dest]
+    else:
+        args = common + ["s3://%s/%s" % (BUCKET, key_name), "s3://%s/copy" % BUCKET]
+
+    store.reset_counts()
+    seconds, peak_rss, status = run_tool(operation, args, env, verbose)
+    counts = store.reset_counts()
+
+    # Check that the transfer actually happened
+    if operation == "upload":
+        ok = store.buckets[BUCKET].get("upload", {}).get("data") == open(src, "rb").read()
+        store.buckets[BUCKET].pop("upload", None)
+    elif operation == "download":
+        ok = os.path.exists(dest) and os.path.getsize(dest) == size*MB
+        if os.path.exists(dest):
+            os.remove(dest)
+    else:
+        ok = "copy" in store.buckets[BUCKET]
+        store.buckets[BUCKET].pop("copy", None)
+
+    row = {"operation": operation, "engine": engine, "size_mb": size, "split_mb": split,
+           "workers": workers, "seconds": round(seconds, 3), "MBps": round(size / seconds, 2),
+           "peak_rss_mb": round(peak_rss / 1024., 1), "requests": sum(counts.values()),
+           "ok": ok and status == 0}
+    for method in METHODS:
+        row[method] = counts.get(method, 0)
+    return row
+
+def write_results(rows, path):
+    fp = open(path, "wb")
+    try:
+        if path.lower().endswith(".csv"):
+            writer = csv.DictWriter(fp, COLUMNS)
+            writer.writerow(dict((c, c) for c in COLUMNS))
+            writer.writerows(rows)
+        else:
+            json.dump(rows, fp, indent=2, sort_keys=True)
+    finally:
+        fp.close()
+
+def main(options):
+    server = FakeS3Server(latency=options.latency, bandwidth=int(options.bandwidth*MB)).start()
+    server.store.buckets[BUCKET] = {}
+    workdir = tempfile.mkdtemp(prefix="s3-mp-bench-")
+    try:
+        config = os.path.join(workdir, "boto.cfg")
+        fp = open(config, "w")
+        fp.write(server.boto_config())
+        fp.close()
+        env = dict(os.environ, BOTO_CONFIG=config)
+
+        rows = []
+        print "%-9s %-8s %8s %6s %4s %8s %9s %8s %5s" % ("operation", "engine", "size", "split",
+                "np", "seconds", "MBps", "rss", "reqs")
+        for operation, engine, size, split, workers in gen_runs(options):
+            row = bench(server, workdir, env, operation, engine, size, split, workers,
+                    options.extra.split(), options.verbose)
+            rows.append(row)
+            print "%-9s %-8s %7dM %5dM %4d %8.2f %9.2f %7.1fM %5d%s" % (operation, engine, size, split,
+                    workers, row["seconds"], row["MBps"], row["peak_rss_mb"], row["requests"],
+                    not row["ok"] and "  FAILED" or "")
+            sys.stdout.flush()
+        if options.output:
+            write_results(rows, options.output)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    options = parser.parse_args()
+    if options.verbose:
+        logger.setLevel(logging.DEBUG)
+    main(options)
@@ -1,38 +1,270 @@
 #!/usr/bin/env python
 import argparse
+import datetime
+import logging
+import re
 import urlparse
-import boto
 import sys
 
+# gevent has to patch the standard library before boto (or anything else)
+# imports it, so --engine async is looked for ahead of the other options
+engine_parser = argparse.ArgumentParser(add_help=False)
+engine_parser.add_argument("-e", "--engine")
+if engine_parser.parse_known_args()[0].engine == "async":
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
+
+from boto.exception import S3ResponseError
+from boto.utils import parse_ts
+
+from s3mp.connection import connect, init_worker, worker_bucket, worker_mpu
+from s3mp.engine import ENGINES, Throttle, make_pool, run_tasks
+from s3mp.journal import UploadJournal, find_journals
+from s3mp.ratelimit import RateLimiter, worker_limiter
+from s3mp.retry import RetryPolicy, worker_retry
+
+AGE_UNITS = {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60, "w": 7*24*60*60}
+
+def age(value):
+    """
+    Parse an age such as 90m, 12h, 7d or 2w into a timedelta
+    """
+    m = re.match(r"^(\d+(?:\.\d+)?)([smhdw])$", value.strip())
+    if m is None:
+        raise argparse.ArgumentTypeError("'%s' isn't an age, such as 12h or 7d" % value)
+    return datetime.timedelta(seconds=float(m.group(1)) * AGE_UNITS[m.group(2)])
+
 parser = argparse.ArgumentParser(description="View or remove incomplete S3 multipart uploads",
         prog="s3-mp-cleanup")
-parser.add_argument("uri", type=str, help="The S3 URI to operate on")
+parser.add_argument("uri", type=str, nargs="?", help="The S3 URI to operate on. Only uploads of keys "
+        "starting with its path are listed")
 parser.add_argument("-c", "--cancel", help="Upload ID to cancel", type=str, required=False)
+parser.add_argument("--older-than", help="Only uploads started longer ago than this, such as 12h, "
+        "7d or 2w", type=age, default=None)
+parser.add_argument("-S", "--sizes", help="Total the bytes held by each upload's parts (a part "
+        "listing per upload)", default=False, action="store_true")
+parser.add_argument("--cancel-all", help="Cancel every upload that matches", default=False,
+        action="store_true")
+parser.add_argument("-n", "--dry-run", help="With --cancel-all, report what would be cancelled "
+        "without cancelling anything", default=False, action="store_true")
+parser.add_argument("-np", "--num-processes", help="Number of workers to list parts and cancel "
+        "uploads with (default 16)", type=int, default=16)
+parser.add_argument("-e", "--engine", help="Run requests in processes, threads or gevent greenlets "
+        "(default thread)", choices=ENGINES, default="thread")
+parser.add_argument("-t", "--max-tries", help="Most times to retry a failed request, backing off "
+        "exponentially (default 5)", type=int, default=5)
+parser.add_argument("--max-requests-per-sec", help="Most requests per second to send, across all workers",
+        type=float, default=None)
+parser.add_argument("-j", "--journals", help="List the --resume journals under this directory",
+        type=str, required=False)
+parser.add_argument("--clear-journals", help="Remove the journals listed by --journals, cancelling "
+        "the uploads they were resuming",
+        default=False, action="store_true")
+parser.add_argument("-v", "--verbose", help="Be more verbose", default=False, action="store_true")
+
+logger = logging.getLogger("s3-mp-cleanup")
+
+def cleanup_journals(directory, clear):
+    """
+    List the --resume journals under a directory, and with clear, remove
+    them, cancelling the multipart uploads of the upload journals so their
+    parts aren't left behind
+    """
+    s3 = None
+    for journal in find_journals(directory):
+        print('{}  # {}'.format(journal.path, journal.describe()))
+        if not clear:
+            continue
+        if isinstance(journal, UploadJournal):
+            if s3 is None:
+                s3 = connect()
+            bucket = s3.get_bucket(urlparse.urlsplit(journal.dest).netloc, validate=False)
+            try:
+                bucket.cancel_multipart_upload(journal.key_name, journal.upload_id)
+            except S3ResponseError, err:
+                if err.status != 404:
+                    # Keep the journal, so the upload can still be found
+                    logger.error("Couldn't cancel upload %s, keeping %s: %s" % (journal.upload_id,
+                            journal.path, err))
+                    continue
+        journal.remove()
+
+def list_uploads(bucket, prefix=""):
+    """
+    Yield every incomplete MultiPartUpload of keys under prefix
+
+    Pages through the listing with S3's markers, a thousand uploads at a
+    time, so only one page is held at once.
+    """
+    key_marker = upload_id_marker = ""
+    while True:
+        rs = bucket.get_all_multipart_uploads(prefix=prefix or None, key_marker=key_marker,
+                upload_id_marker=upload_id_marker)
+        for mpu in rs:
+            yield mpu
+        if not rs.is_truncated:
+            return
+        key_marker, upload_id_marker = rs.next_key_marker, rs.next_upload_id_marker
+
+def upload_size(bucket_name, key_name, upload_id):
+    """
+    Total the parts of a MultiPartUpload
+
+    :rtype: tuple of (int, int)
+    :returns: The number of parts and their total size, or None if the
+              upload has finished or been cancelled since it was listed
+    """
+    retry = worker_retry()
+    limiter = worker_limiter()
+    tries = 0
+    while True:
+        retry.wait()
+        limiter.request()
+        try:
+            # Pages through the parts, a thousand at a time
+            sizes = [part.size for part in worker_mpu(bucket_name, key_name, upload_id)]
+            return len(sizes), sum(sizes)
+        except Exception, err:
+            if getattr(err, "error_code", None) == "NoSuchUpload":
+                return None
+            tries = retry.failed(err, tries, "Listing the parts of %s" % upload_id)
+
+def cancel_upload(bucket_name, key_name, upload_id):
+    """
+    Cancel a MultiPartUpload, which deletes its parts
+
+    :rtype: bool
+    :returns: Whether the upload was still there to cancel
+    """
+    retry = worker_retry()
+    limiter = worker_limiter()
+    tries = 0
+    while True:
+        retry.wait()
+        limiter.request()
+        try:
+            worker_bucket(bucket_name).cancel_multipart_upload(key_name, upload_id)
+            return True
+        except Exception, err:
+            if getattr(err, "error_code", None) == "NoSuchUpload":
+                return False
+            tries = retry.failed(err, tries, "Cancelling %s" % upload_id)
+
+def do_upload(args):
+    """
+    Total the parts of a MultiPartUpload, cancel it, or both
+
+    :type args: tuple of (tuple, bool, bool)
+    :param args: The upload's bucket name, key name, upload id, initiator
+                 and start time, whether to total its parts and whether to
+                 cancel it
+
+    :rtype: tuple of (tuple, int, int, bool)
+    :returns: The upload, its number of parts and their total size (zero
+              without sizes), and whether it was still there
+    """
+    upload, sizes, cancel = args
+    bucket_name, key_name, upload_id = upload[:3]
+    num_parts = nbytes = 0
+    found = True
+    if sizes:
+        size = upload_size(bucket_name, key_name, upload_id)
+        found = size is not None
+        num_parts, nbytes = size or (0, 0)
+    if cancel and found:
+        found = cancel_upload(bucket_name, key_name, upload_id)
+    return upload, num_parts, nbytes, found
+
+def format_size(nbytes):
+    for unit, scale in (("T", 1024**4), ("G", 1024**3), ("M", 1024**2), ("K", 1024)):
+        if nbytes >= scale:
+            return "%0.2f%s" % (nbytes / float(scale), unit)
+    return "%dB" % nbytes
+
+def main(uri, cancel, journals=None, clear_journals=False, older_than=None, sizes=False, cancel_all=False,
+        dry_run=False, num_processes=16, engine="thread", max_tries=5, max_requests_per_sec=None, verbose=False):
+    if journals:
+        cleanup_journals(journals, clear_journals)
+        return
+    if not uri:
+        parser.error("uri is required unless --journals is given")
+    if cancel and cancel_all:
+        parser.error("-c and --cancel-all can't be used together")
 
-def main(uri, cancel):
     # Check that dest is a valid S3 url
     split_rs = urlparse.urlsplit(uri)
     if split_rs.scheme != "s3":
         raise ValueError("'%s' is not an S3 url" % uri)
 
-    s3 = boto.connect_s3()
+    s3 = connect()
     bucket = s3.lookup(split_rs.netloc)
-    
-    mpul = bucket.list_multipart_uploads()
-    for mpu in mpul:
-        if not cancel:
-            print('s3-mp-cleanup.py s3://{}/{} -c {}  # {} {}'.format(mpu.bucket.name, mpu.key_name, mpu.id, mpu.initiator.display_name, mpu.initiated))
-        elif cancel == mpu.id:
-            bucket.cancel_multipart_upload(mpu.key_name, mpu.id)
-            break
-    else:
-        if cancel:
+    if bucket is None:
+        raise ValueError("'%s' is not a valid bucket" % split_rs.netloc)
+    prefix = split_rs.path[1:]
+
+    if cancel:
+        for mpu in list_uploads(bucket, prefix):
+            if cancel == mpu.id:
+                bucket.cancel_multipart_upload(mpu.key_name, mpu.id)
+                break
+        else:
             print("No multipart upload {} found for {}".format(cancel, uri))
             sys.exit(1)
-        
-    
+        return
+
+    now = datetime.datetime.utcnow()
+    cancelling = cancel_all and not dry_run
+    # The uploads are streamed from the listing to the workers, and printed
+    # as they come back, so there's only ever a page of them held at once
+    uploads = ((bucket.name, mpu.key_name, mpu.id, mpu.initiator.display_name, mpu.initiated)
+            for mpu in list_uploads(bucket, prefix)
+            if older_than is None or now - parse_ts(mpu.initiated) > older_than)
+
+    pool = None
+    if sizes or cancelling:
+        limiter = RateLimiter(None, max_requests_per_sec)
+        pool = make_pool(engine, num_processes, init_worker, (None, RetryPolicy(max_tries), limiter))
+        tasks = ((upload, sizes, cancelling) for upload in uploads)
+        results = run_tasks(pool, do_upload, tasks, Throttle(2*num_processes))
+    else:
+        results = ((upload, 0, 0, True) for upload in uploads)
+
+    try:
+        count = total_parts = total_bytes = cancelled = 0
+        for upload, num_parts, nbytes, found in results:
+            bucket_name, key_name, upload_id, initiator, initiated = upload
+            count += 1
+            total_parts += num_parts
+            total_bytes += nbytes
+            cancelled += cancelling and found
+            note = ""
+            if sizes:
+                note = ", {} parts, {}".format(num_parts, format_size(nbytes))
+            print('s3-mp-cleanup.py s3://{}/{} -c {}  # {} {}{}'.format(bucket_name, key_name, upload_id,
+                    initiator, initiated, note))
+        logger.debug("%d uploads matched" % count)
+
+        summary = "{} uploads".format(count)
+        if sizes:
+            summary += " holding {} parts, {}".format(total_parts, format_size(total_bytes))
+        if cancelling:
+            print("# Cancelled {} ({} were already gone)".format(summary, count - cancelled))
+        elif cancel_all:
+            print("# Would cancel {}".format(summary))
+        else:
+            print("# {}".format(summary))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
     arg_dict = vars(args)
+    if arg_dict['verbose'] == True:
+        logger.setLevel(logging.DEBUG)
     main(**arg_dict)
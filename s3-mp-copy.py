@@ -1,148 +1,83 @@
 #!/usr/bin/env python
 import argparse
-from cStringIO import StringIO
 import logging
-from math import ceil
-from multiprocessing import Pool
 import sys
-import time
-import urlparse
 
-import boto
-from boto.s3.connection import OrdinaryCallingFormat
+# gevent has to patch the standard library before boto (or anything else)
+# imports it, so --engine async is looked for ahead of the other options
+engine_parser = argparse.ArgumentParser(add_help=False)
+engine_parser.add_argument("-e", "--engine")
+if engine_parser.parse_known_args()[0].engine == "async":
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
 
+from s3mp.engine import ENGINES
+from s3mp.manager import TransferManager
+from s3mp.tuning import AUTO_MAX_WORKERS
 
 parser = argparse.ArgumentParser(description="Copy large files within S3",
         prog="s3-mp-copy")
-parser.add_argument("src", help="The S3 source object")
-parser.add_argument("dest", help="The S3 destination object")
-parser.add_argument("-np", "--num-processes", help="Number of processors to use",
-        type=int, default=2)
+parser.add_argument("src", nargs="?", help="The S3 source object, or a prefix ending in '/'")
+parser.add_argument("dest", nargs="?", help="The S3 destination object, or prefix for a source prefix")
+parser.add_argument("-m", "--manifest", help="Copy every 's3://bucket/key s3://bucket/key' pair listed in this file")
+parser.add_argument("-np", "--num-processes", help="Number of workers to use "
+        "(default 2, or %d with --auto)" % AUTO_MAX_WORKERS, type=int, default=None)
+parser.add_argument("-e", "--engine", help="Run parts in processes, threads or gevent greenlets",
+        choices=ENGINES, default="process")
 parser.add_argument("-f", "--force", help="Overwrite an existing S3 key",
         action="store_true")
 parser.add_argument("-s", "--split", help="Split size, in Mb", type=int, default=50)
+parser.add_argument("-a", "--auto", help="Pick the split size from the object size and tune the number "
+        "of parts in flight while copying, up to --num-processes", default=False, action="store_true")
 parser.add_argument("-rrs", "--reduced-redundancy", help="Use reduced redundancy storage. Default is standard.", 
         default=False,  action="store_true")
+parser.add_argument("-t", "--max-tries", help="Most times to retry a failed part, backing off "
+        "exponentially (default 5)", type=int, default=5)
+parser.add_argument("--max-bandwidth", help="Most MB/s to stream through this host, across all "
+        "workers. Only streamed copies pass data through this host", type=float, default=None)
+parser.add_argument("--max-requests-per-sec", help="Most requests per second to send, across all workers",
+        type=float, default=None)
+parser.add_argument("--stream", help="Copy through this host (a ranged GET and an upload per part) "
+        "instead of having S3 copy the parts. Done anyway for buckets in different regions, or with "
+        "--source-profile", default=False, action="store_true")
+parser.add_argument("--source-profile", help="Read the source with the credentials of this boto "
+        "profile, for a copy between accounts")
+parser.add_argument("--verify", help="Check that each copy ends up with the source object's ETag",
+        default=False, action="store_true")
+parser.add_argument("--stats-file", help="Write metrics for every part to this file: a row per "
+        "part if it ends in .csv, otherwise JSON with latency percentiles and throughput over time")
+parser.add_argument("-p", "--progress", help="Show a progress line on stderr", default=False, action="store_true")
 parser.add_argument("-v", "--verbose", help="Be more verbose", default=False, action="store_true")
 
 logger = logging.getLogger("s3-mp-copy")
 
-def do_part_copy(args):
+def main(src, dest, num_processes=None, engine="process", max_tries=5, max_bandwidth=None,
+        max_requests_per_sec=None, source_profile=None, verbose=False, **options):
     """
-    Copy a part of a MultiPartUpload
-
-    Copy a single chunk between S3 objects. Since we can't pickle
-    S3Connection or MultiPartUpload objects, we have to reconnect and lookup
-    the MPU object with each part upload.
+    Run one copy through a TransferManager, exiting with status 1 if it fails
 
-    :type args: tuple of (string, string, string, int, int, int, int)
-    :param args: The actual arguments of this method. Due to lameness of
-                 multiprocessing, we have to extract these outside of the
-                 function definition.
-
-                 The arguments are: S3 src bucket name, S3 key name, S3 dest
-                 bucket_name, MultiPartUpload id, the part number, 
-                 part start position, part stop position
+    The options other than those of the TransferManager are passed on to
+    TransferManager.copy.
     """
-    # Multiprocessing args lameness
-    src_bucket_name, src_key_name, dest_bucket_name, mpu_id, part_num, start_pos, end_pos = args
-    logger.debug("do_part_copy got args: %s" % (args,))
-
-    # Connect to S3, get the MultiPartUpload
-    s3 = boto.connect_s3(calling_format=OrdinaryCallingFormat())
-    dest_bucket = s3.lookup(dest_bucket_name)
-    mpu = None
-    for mp in dest_bucket.list_multipart_uploads():
-        if mp.id == mpu_id:
-            mpu = mp
-            break
-    if mpu is None:
-        raise Exception("Could not find MultiPartUpload %s" % mpu_id)
-
-    # make sure we have a valid key
-    src_bucket = s3.lookup( src_bucket_name )
-    src_key    = src_bucket.get_key( src_key_name )
-    # Do the copy
-    t1 = time.time()
-    mpu.copy_part_from_key(src_bucket_name, src_key_name, part_num, start_pos, end_pos)
-
-    # Print some timings
-    t2 = time.time() - t1
-    s = (end_pos - start_pos)/1024./1024.
-    logger.info("Copied part %s (%0.2fM) in %0.2fs at %0.2fMbps" % (part_num, s, t2, s/t2))
-
-def validate_url( url ):
-    split = urlparse.urlsplit( url )
-    if split.scheme != "s3":
-        raise ValueError("'%s' is not an S3 url" % url)
-    return split.netloc, split.path[1:]
-
-def main(src, dest, num_processes=2, split=50, force=False, reduced_redundancy=False, verbose=False):
-    dest_bucket_name, dest_key_name = validate_url( dest )
-    src_bucket_name, src_key_name   = validate_url( src )
-
-    s3 = boto.connect_s3(calling_format=OrdinaryCallingFormat())
-    dest_bucket = s3.lookup( dest_bucket_name )
-    dest_key    = dest_bucket.get_key( dest_key_name )
-    
-    # See if we're overwriting an existing key
-    if dest_key is not None:
-        if not force:
-            raise ValueError("'%s' already exists. Specify -f to overwrite it" % dest)
-
-    # Determine the total size and calculate byte ranges
-    src_bucket = s3.lookup( src_bucket_name )
-    src_key    = src_bucket.get_key( src_key_name )
-    size       = src_key.size
-
-    # If file is less than 5G, copy it directly
-    if size < 5*1024*1024*1024:
-        logging.info("Source object is %0.2fM copying it directly" % ( size/1024./1024. ))
-        t1 = time.time()
-        src_key.copy( dest_bucket_name, dest_key_name, reduced_redundancy=reduced_redundancy )
-        t2 = time.time() - t1
-        s = size/1024./1024.
-        logger.info("Finished copying %0.2fM in %0.2fs (%0.2fMbps)" % (s, t2, s/t2))
-        return
-
-    part_size   = max(5*1024*1024, 1024*1024*split)
-    num_parts   = int(ceil(size / float(part_size)))
-    logging.info("Source object is %0.2fM splitting into %d parts of size %0.2fM" % (size/1024./1024., num_parts, part_size/1024./1024.) )
-
-    # Create the multi-part upload object
-    mpu = dest_bucket.initiate_multipart_upload( dest_key_name, reduced_redundancy=reduced_redundancy)
-    logger.info("Initialized copy: %s" % mpu.id)
-
-    # Generate arguments for invocations of do_part_copy 
-    def gen_args(num_parts):
-        cur_pos = 0
-        for i in range(num_parts):
-            part_start = cur_pos
-            cur_pos    = cur_pos + part_size
-            part_end   = min(cur_pos - 1, size - 1)
-            part_num   = i + 1
-            yield (src_bucket_name, src_key_name, dest_bucket_name, mpu.id, part_num, part_start, part_end)
-
-    # Do the thing
+    if num_processes is None:
+        num_processes = AUTO_MAX_WORKERS if options.get("auto") else 2
+    manager = TransferManager(num_processes, engine, None, max_tries, max_bandwidth, max_requests_per_sec,
+            source_profile)
     try:
-        # Create a pool of workers
-        pool = Pool(processes=num_processes)
-        t1 = time.time()
-        pool.map_async(do_part_copy, gen_args(num_parts)).get(9999999)
-        # Print out some timings
-        t2 = time.time() - t1
-        s = size/1024./1024.
-        # Finalize
-        mpu.complete_upload()
-        logger.info("Finished copying %0.2fM in %0.2fs (%0.2fMbps)" % (s, t2, s/t2))
+        manager.copy(src, dest, **options).result()
     except KeyboardInterrupt:
-        logger.warn("Received KeyboardInterrupt, canceling copy")
-        pool.terminate()
-        mpu.cancel_upload()
+        logger.warning("Received KeyboardInterrupt, canceling copy")
+        manager.shutdown(cancel=True)
+        sys.exit(1)
     except Exception, err:
-        logger.error("Encountered an error, canceling copy")
         logger.error(err)
-        mpu.cancel_upload()
+        # Stop any of its parts still in flight
+        manager.shutdown(cancel=True)
+        sys.exit(1)
+    manager.shutdown()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -150,5 +85,6 @@ if __name__ == "__main__":
     arg_dict = vars(args)
     if arg_dict['verbose'] == True:
         logger.setLevel(logging.DEBUG)
+        logging.getLogger("s3mp").setLevel(logging.DEBUG)
     logger.debug("CLI args: %s" % args)
     main(**arg_dict)
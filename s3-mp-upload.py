@@ -1,167 +1,89 @@
 #!/usr/bin/env python
 import argparse
-from cStringIO import StringIO
 import logging
-from math import ceil
-from multiprocessing import Pool
-import time
-import urlparse
+import sys
 
-import boto
-from boto.s3.connection import OrdinaryCallingFormat
+# gevent has to patch the standard library before boto (or anything else)
+# imports it, so --engine async is looked for ahead of the other options
+engine_parser = argparse.ArgumentParser(add_help=False)
+engine_parser.add_argument("-e", "--engine")
+if engine_parser.parse_known_args()[0].engine == "async":
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
+
+from s3mp.compress import CODECS
+from s3mp.engine import ENGINES
+from s3mp.manager import TransferManager
+from s3mp.tuning import AUTO_MAX_WORKERS
 
 parser = argparse.ArgumentParser(description="Transfer large files to S3",
         prog="s3-mp-upload")
-parser.add_argument("src", type=file, help="The file to transfer")
-parser.add_argument("dest", help="The S3 destination object")
-parser.add_argument("-np", "--num-processes", help="Number of processors to use",
-        type=int, default=2)
+parser.add_argument("src", nargs="?", help="The file or directory to transfer, or '-' to read from stdin")
+parser.add_argument("dest", nargs="?", help="The S3 destination object, or prefix for a directory")
+parser.add_argument("-m", "--manifest", help="Upload every 'file s3://bucket/key' pair listed in this file")
+parser.add_argument("-np", "--num-processes", help="Number of workers to use "
+        "(default 2, or %d with --auto)" % AUTO_MAX_WORKERS, type=int, default=None)
+parser.add_argument("-e", "--engine", help="Run parts in processes, threads or gevent greenlets",
+        choices=ENGINES, default="process")
 parser.add_argument("-f", "--force", help="Overwrite an existing S3 key",
         action="store_true")
 parser.add_argument("-s", "--split", help="Split size, in Mb", type=int, default=50)
+parser.add_argument("-a", "--auto", help="Pick the split size from the file size and tune the number "
+        "of parts in flight while uploading, up to --num-processes", default=False, action="store_true")
 parser.add_argument("-rrs", "--reduced-redundancy", help="Use reduced redundancy storage. Default is standard.", default=False,  action="store_true")
 parser.add_argument("--insecure", dest='secure', help="Use HTTP for connection",
         default=True, action="store_false")
-parser.add_argument("-t", "--max-tries", help="Max allowed retries for http timeout", type=int, default=5)
+parser.add_argument("-t", "--max-tries", help="Most times to retry a failed part, backing off "
+        "exponentially (default 5)", type=int, default=5)
+parser.add_argument("--max-bandwidth", help="Most MB/s to upload, across all workers",
+        type=float, default=None)
+parser.add_argument("--max-requests-per-sec", help="Most requests per second to send, across all workers",
+        type=float, default=None)
+parser.add_argument("-b", "--max-buffers", help="With '-' as the source, hold at most this many "
+        "part-sized buffers of stdin in memory (default: one more than --num-processes)", type=int, default=None)
+parser.add_argument("-r", "--resume", help="Keep a journal next to the source file and resume "
+        "from it, instead of canceling the upload on failure", default=False, action="store_true")
+parser.add_argument("--compress", help="Compress every part, in parallel, as a gzip member or zstd "
+        "frame of its own (fetch with s3-mp-download --decompress)", choices=CODECS, default=None)
+parser.add_argument("--sync", metavar="INDEX", help="Keep an index of uploaded files in this file, "
+        "and upload only files that changed since, or whose keys did (one listing of the "
+        "destination per bucket). Changed keys are overwritten without -f")
+parser.add_argument("--verify", help="Check the ETag S3 reports for each finished upload "
+        "against the MD5s of its parts", default=False, action="store_true")
+parser.add_argument("--stats-file", help="Write metrics for every part to this file: a row per "
+        "part if it ends in .csv, otherwise JSON with latency percentiles and throughput over time")
+parser.add_argument("-p", "--progress", help="Show a progress line on stderr", default=False, action="store_true")
 parser.add_argument("-v", "--verbose", help="Be more verbose", default=False, action="store_true")
 parser.add_argument("-q", "--quiet", help="Be less verbose (for use in cron jobs)", default=False, action="store_true")
 
 logger = logging.getLogger("s3-mp-upload")
 
-def do_part_upload(args):
+def main(src, dest, num_processes=None, engine="process", secure=True, max_tries=5, max_bandwidth=None,
+        max_requests_per_sec=None, verbose=False, quiet=False, **options):
     """
-    Upload a part of a MultiPartUpload
-
-    Open the target file and read in a chunk. Since we can't pickle
-    S3Connection or MultiPartUpload objects, we have to reconnect and lookup
-    the MPU object with each part upload.
+    Run one upload through a TransferManager, exiting with status 1 if it fails
 
-    :type args: tuple of (string, string, string, int, int, int)
-    :param args: The actual arguments of this method. Due to lameness of
-                 multiprocessing, we have to extract these outside of the
-                 function definition.
-
-                 The arguments are: S3 Bucket name, MultiPartUpload id, file
-                 name, the part number, part offset, part size
+    The options other than those of the TransferManager are passed on to
+    TransferManager.upload.
     """
-    # Multiprocessing args lameness
-    bucket_name, mpu_id, fname, i, start, size, secure, max_tries, current_tries = args
-    logger.debug("do_part_upload got args: %s" % (args,))
-
-    # Connect to S3, get the MultiPartUpload
-    s3 = boto.connect_s3(calling_format=OrdinaryCallingFormat())
-    s3.is_secure = secure
-    bucket = s3.lookup(bucket_name)
-    mpu = None
-    for mp in bucket.list_multipart_uploads():
-        if mp.id == mpu_id:
-            mpu = mp
-            break
-    if mpu is None:
-        raise Exception("Could not find MultiPartUpload %s" % mpu_id)
-
-    # Read the chunk from the file
-    fp = open(fname, 'rb')
-    fp.seek(start)
-    data = fp.read(size)
-    fp.close()
-    if not data:
-        raise Exception("Unexpectedly tried to read an empty chunk")
-
-    def progress(x,y):
-        logger.debug("Part %d: %0.2f%%" % (i+1, 100.*x/y))
-
-    try:
-        # Do the upload
-        t1 = time.time()
-        mpu.upload_part_from_file(StringIO(data), i+1, cb=progress)
-
-        # Print some timings
-        t2 = time.time() - t1
-        s = len(data)/1024./1024.
-        logger.info("Uploaded part %s (%0.2fM) in %0.2fs at %0.2fMBps" % (i+1, s, t2, s/t2))
-    except Exception, err:
-        logger.debug("Retry request %d of max %d times" % (current_tries, max_tries))
-        if (current_tries > max_tries):
-            logger.error(err)
-        else:
-            time.sleep(3)
-            current_tries += 1
-            do_part_download(bucket_name, mpu_id, fname, i, start, size, secure, max_tries, current_tries)
-
-def main(src, dest, num_processes=2, split=50, force=False, reduced_redundancy=False, verbose=False, quiet=False, secure=True, max_tries=5):
-    # Check that dest is a valid S3 url
-    split_rs = urlparse.urlsplit(dest)
-    if split_rs.scheme != "s3":
-        raise ValueError("'%s' is not an S3 url" % dest)
-
-    s3 = boto.connect_s3(calling_format=OrdinaryCallingFormat())
-    s3.is_secure = secure
-    bucket = s3.lookup(split_rs.netloc)
-    if bucket == None:
-        raise ValueError("'%s' is not a valid bucket" % split_rs.netloc)
-    key = bucket.get_key(split_rs.path)
-    # See if we're overwriting an existing key
-    if key is not None:
-        if not force:
-            raise ValueError("'%s' already exists. Specify -f to overwrite it" % dest)
-
-    # Determine the splits
-    part_size = max(5*1024*1024, 1024*1024*split)
-    src.seek(0,2)
-    size = src.tell()
-    num_parts = int(ceil(size / part_size))
-
-    # If file is less than 5M, just upload it directly
-    if size < 5*1024*1024:
-        src.seek(0)
-        t1 = time.time()
-        k = boto.s3.key.Key(bucket,split_rs.path)
-        k.set_contents_from_file(src)
-        t2 = time.time() - t1
-        s = size/1024./1024.
-        logger.info("Finished uploading %0.2fM in %0.2fs (%0.2fMBps)" % (s, t2, s/t2))
-        return
-
-    # Create the multi-part upload object
-    mpu = bucket.initiate_multipart_upload(split_rs.path, reduced_redundancy=reduced_redundancy)
-    logger.info("Initialized upload: %s" % mpu.id)
-
-    # Generate arguments for invocations of do_part_upload
-    def gen_args(num_parts, fold_last):
-        for i in range(num_parts+1):
-            part_start = part_size*i
-            if i == (num_parts-1) and fold_last is True:
-                yield (bucket.name, mpu.id, src.name, i, part_start, part_size*2, secure, max_tries, 0)
-                break
-            else:
-                yield (bucket.name, mpu.id, src.name, i, part_start, part_size, secure, max_tries, 0)
-
-
-    # If the last part is less than 5M, just fold it into the previous part
-    fold_last = ((size % part_size) < 5*1024*1024)
-
-    # Do the thing
+    if num_processes is None:
+        num_processes = AUTO_MAX_WORKERS if options.get("auto") else 2
+    manager = TransferManager(num_processes, engine, secure, max_tries, max_bandwidth, max_requests_per_sec)
     try:
-        # Create a pool of workers
-        pool = Pool(processes=num_processes)
-        t1 = time.time()
-        pool.map_async(do_part_upload, gen_args(num_parts, fold_last)).get(9999999)
-        # Print out some timings
-        t2 = time.time() - t1
-        s = size/1024./1024.
-        # Finalize
-        src.close()
-        mpu.complete_upload()
-        logger.info("Finished uploading %0.2fM in %0.2fs (%0.2fMBps)" % (s, t2, s/t2))
+        manager.upload(src, dest, **options).result()
     except KeyboardInterrupt:
-        logger.warn("Received KeyboardInterrupt, canceling upload")
-        pool.terminate()
-        mpu.cancel_upload()
+        logger.warning("Received KeyboardInterrupt, canceling upload")
+        manager.shutdown(cancel=True)
+        sys.exit(1)
     except Exception, err:
-        logger.error("Encountered an error, canceling upload")
         logger.error(err)
-        mpu.cancel_upload()
+        # Stop any of its parts still in flight
+        manager.shutdown(cancel=True)
+        sys.exit(1)
+    manager.shutdown()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -169,7 +91,9 @@ if __name__ == "__main__":
     arg_dict = vars(args)
     if arg_dict['quiet'] == True:
         logger.setLevel(logging.WARNING)
+        logging.getLogger("s3mp").setLevel(logging.WARNING)
     if arg_dict['verbose'] == True:
         logger.setLevel(logging.DEBUG)
+        logging.getLogger("s3mp").setLevel(logging.DEBUG)
     logger.debug("CLI args: %s" % args)
     main(**arg_dict)
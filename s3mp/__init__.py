@@ -0,0 +1,9 @@
+"""
+Shared helpers for the s3-mp-* parallel S3 transfer utilities
+
+The transfers themselves can be run from Python through a TransferManager
+(see s3mp.manager), which the tools are wrappers around.
+"""
+from s3mp.manager import CancelledError, TimeoutError, TransferFuture, TransferManager
+
+__all__ = ["CancelledError", "TimeoutError", "TransferFuture", "TransferManager"]
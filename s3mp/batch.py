@@ -0,0 +1,104 @@
+"""
+Helpers for moving many objects in a single run
+
+Each of the s3-mp-* tools accepts a local directory or an S3 prefix (an S3
+url ending in '/') in place of a single file or key, or a manifest file
+listing source and destination pairs. All parts of all the objects are then
+run through one worker pool.
+"""
+import os
+
+from s3mp.journal import DOWNLOAD_JOURNAL_SUFFIX, UPLOAD_JOURNAL_SUFFIX
+
+# The journals (and their temporary files) that --resume leaves next to the
+# files it transfers, which aren't themselves transferred
+JOURNAL_SUFFIXES = (UPLOAD_JOURNAL_SUFFIX, DOWNLOAD_JOURNAL_SUFFIX,
+        UPLOAD_JOURNAL_SUFFIX + ".tmp", DOWNLOAD_JOURNAL_SUFFIX + ".tmp")
+
+def is_prefix(url):
+    """
+    Whether an S3 url names a prefix rather than a single key
+    """
+    return url.endswith("/")
+
+def join_url(prefix, relpath):
+    """
+    Join a relative path onto an S3 url or local directory
+    """
+    if prefix.startswith("s3://"):
+        if not prefix.endswith("/"):
+            prefix += "/"
+        return prefix + relpath
+    return os.path.join(prefix, *relpath.split("/"))
+
+def walk_files(directory):
+    """
+    Yield (path, relative path) for every file under a directory
+
+    Relative paths use '/' as the separator so they can be used as key names.
+    Journals left by --resume are skipped.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(JOURNAL_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, directory)
+            yield path, "/".join(relpath.split(os.sep))
+
+def read_manifest(path):
+    """
+    Read a manifest of transfers
+
+    Each line holds a source and a destination separated by whitespace.
+    Blank lines and lines starting with '#' are skipped.
+
+    :rtype: list of (string, string)
+    """
+    pairs = []
+    fp = open(path, 'r')
+    try:
+        for lineno, line in enumerate(fp):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError("%s:%d: expected a source and a destination" % (path, lineno+1))
+            pairs.append(tuple(fields))
+    finally:
+        fp.close()
+    return pairs
+
+def list_keys(bucket, key_names):
+    """
+    Return the boto Keys, with their sizes and ETags, of the given keys that
+    exist in a bucket
+
+    The keys are grouped by their first path component, and each group is
+    found with one paginated listing of its common prefix rather than a HEAD
+    request per key. Keys at the top of the bucket are found together with
+    one listing of the top level only ('/' as the delimiter), so keys with
+    nothing in common never mean listing the whole bucket.
+
+    :rtype: dict
+    :returns: Key names mapped to Keys
+    """
+    groups = {}
+    for name in set(key_names):
+        top = name.split("/", 1)
+        groups.setdefault(len(top) > 1 and top[0] + "/" or "", []).append(name)
+    keys = {}
+    for top, names in groups.items():
+        wanted = set(names)
+        prefix = os.path.commonprefix(names)
+        listing = bucket.list(prefix=prefix, delimiter=not top and "/" or "")
+        keys.update((key.name, key) for key in listing if key.name in wanted)
+    return keys
+
+def existing_keys(bucket, key_names):
+    """
+    Return which of the given keys already exist in a bucket
+    """
+    return set(list_keys(bucket, key_names))
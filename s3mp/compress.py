@@ -0,0 +1,237 @@
+"""
+Compressing parts on upload, and decompressing them on download
+
+With --compress, the worker that uploads a part compresses it first, as a
+gzip member or zstd frame of its own. Concatenated, the parts make an
+ordinary .gz or .zst file that gunzip and zstd -d read as a single stream,
+but each part can also be decompressed on its own, so downloads with
+--decompress fetch and decompress their parts in parallel as well.
+
+S3 needs every part but the last to be at least 5M. The part size is
+raised, from how well a sample of the file compresses, so that compressed
+parts usually are, and a part that still comes out short is padded with a
+frame decompressors skip (an empty gzip member with a comment, or a zstd
+skippable frame).
+
+Compressed parts vary in size, so where they are can't be worked out from
+the object's size. The upload ends with an index frame, also skipped by
+decompressors, as a part of its own. It lists the compressed size, the size
+without padding and the uncompressed size of every part, and ends with its
+own length, so it can be found by fetching the end of the object.
+
+gzip comes with Python. zstd needs the zstandard module.
+"""
+import hashlib
+import json
+import logging
+import struct
+import zlib
+from math import ceil
+
+from boto.exception import S3ResponseError
+
+from s3mp.tuning import MAX_PARTS, MB, MIN_PART_SIZE
+
+logger = logging.getLogger("s3mp.compress")
+
+CODECS = ("gzip", "zstd")
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Bytes compressed to estimate how well a file compresses
+SAMPLE_SIZE = MB
+
+# Aim for compressed parts this much over S3's minimum, so few need padding
+PART_MARGIN = 1.5
+
+# Largest uncompressed part to use, unless a file is too big to fit in
+# MAX_PARTS of them. Parts are held in memory while they're compressed.
+MAX_COMPRESS_PART_SIZE = 256*MB
+
+INDEX_MAGIC = "s3mp-index "
+
+# Every index frame ends with its length, as 10 digits, then these bytes:
+# the end of an empty gzip member (a zstd index repeats them in its payload)
+INDEX_END = "\0\x03\x00" + "\0" * 8
+INDEX_LENGTH_DIGITS = 10
+
+# Bytes fetched from the end of an object to find its index
+INDEX_READ = 64*1024
+
+# An empty gzip member with a comment: header flags FCOMMENT, no mtime
+GZIP_COMMENT_HEADER = "\x1f\x8b\x08\x10\0\0\0\0\0\xff"
+
+# The last of the zstd skippable frame magic numbers
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+
+class GzipCodec(object):
+    name = "gzip"
+
+    def compress(self, data):
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, frame):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return decompressor.decompress(frame) + decompressor.flush()
+
+    def skippable(self, payload):
+        """
+        Return a frame holding payload that decompresses to nothing
+        """
+        # The comment ends at the first NUL, so payload can't have any
+        return GZIP_COMMENT_HEADER + payload + INDEX_END
+
+    overhead = len(GZIP_COMMENT_HEADER) + len(INDEX_END)
+
+class ZstdCodec(object):
+    name = "zstd"
+
+    def __init__(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression requires zstandard (pip install zstandard)")
+        self._zstd = zstandard
+
+    def compress(self, data):
+        # The frame records its content size, which decompress needs
+        return self._zstd.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+    def decompress(self, frame):
+        return self._zstd.ZstdDecompressor().decompress(frame)
+
+    def skippable(self, payload):
+        payload += INDEX_END
+        return struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(payload)) + payload
+
+    overhead = 8 + len(INDEX_END)
+
+def get_codec(name):
+    """
+    Return the codec for one of CODECS
+    """
+    if name == "gzip":
+        return GzipCodec()
+    elif name == "zstd":
+        return ZstdCodec()
+    raise ValueError("Unknown compression '%s', expected one of %s" % (name, ", ".join(CODECS)))
+
+def compress_part(codec, data, min_size=0):
+    """
+    Compress a part into a frame of its own, padded to at least min_size
+
+    :rtype: tuple of (string, int)
+    :returns: The compressed part and the length of its frame, without the
+              padding
+    """
+    frame = codec.compress(data)
+    short = min_size - len(frame)
+    if short <= 0:
+        return frame, len(frame)
+    logger.debug("Padding a %d byte frame to %d bytes" % (len(frame), min_size))
+    return frame + codec.skippable(" " * max(0, short - codec.overhead)), len(frame)
+
+def index_frame(codec, parts):
+    """
+    Return the index frame that ends a compressed upload
+
+    :type parts: list of tuples
+    :param parts: The (compressed size, frame size, uncompressed size) of
+                  every part, in order
+    """
+    body = INDEX_MAGIC + json.dumps({"codec": codec.name, "parts": [list(p) for p in parts]}) + " "
+    # The length includes the digits themselves
+    length = len(codec.skippable(body + "0" * INDEX_LENGTH_DIGITS))
+    return codec.skippable(body + "%0*d" % (INDEX_LENGTH_DIGITS, length))
+
+def choose_compressed_part_size(codec, fname, size, part_size):
+    """
+    Raise the part size so a file's parts compress to more than 5M
+
+    Compresses up to SAMPLE_SIZE bytes from the start of the file to see
+    how well it compresses. A part size over MAX_COMPRESS_PART_SIZE is
+    lowered to it, or as close as the part limit allows, since each worker
+    holds a whole part in memory.
+    """
+    # One part is left for the index
+    limit = max(MAX_COMPRESS_PART_SIZE, int(ceil(float(size) / (MAX_PARTS - 1) / MB)) * MB)
+    if part_size > limit:
+        logger.info("Using %dM parts for %s instead of %dM, to compress them in memory" %
+                (limit / MB, fname, part_size / MB))
+        part_size = limit
+    fp = open(fname, "rb")
+    try:
+        sample = fp.read(min(size, SAMPLE_SIZE))
+    finally:
+        fp.close()
+    if not sample:
+        return part_size
+    ratio = max(len(codec.compress(sample)) / float(len(sample)), 1e-6)
+    needed = int(ceil(MIN_PART_SIZE * PART_MARGIN / ratio / MB)) * MB
+    new_size = max(part_size, min(needed, MAX_COMPRESS_PART_SIZE))
+    if new_size != part_size:
+        logger.info("%s compresses to %d%%, using %dM parts so they stay over 5M" %
+                (fname, ratio * 100, new_size / MB))
+    return new_size
+
+class FrameIndex(object):
+    """
+    Where the parts of a compressed object are, read from its index frame
+
+    :ivar codec: The codec the parts were compressed with
+    :ivar parts: The (offset, compressed size, frame size, uncompressed
+                 offset, uncompressed size) of every part
+    :ivar size: The uncompressed size of the object
+    :ivar index_range: The first and last byte of the index frame
+    :ivar index_md5: The hex MD5 of the index frame
+    """
+
+    def __init__(self, codec, parts, index_offset, index_data):
+        self.codec = codec
+        self.parts = []
+        offset = usize = 0
+        for length, frame_length, ulength in parts:
+            self.parts.append((offset, length, frame_length, usize, ulength))
+            offset += length
+            usize += ulength
+        self.size = usize
+        self.index_range = (index_offset, index_offset + len(index_data) - 1)
+        self.index_md5 = hashlib.md5(index_data).hexdigest()
+        if offset != index_offset:
+            raise ValueError("The index of a compressed object doesn't match its size")
+
+def _read_tail(key, length):
+    resp = key.bucket.connection.make_request("GET", bucket=key.bucket.name, key=key.name,
+            headers={"Range": "bytes=%d-%d" % (key.size - length, key.size - 1)})
+    data = resp.read()
+    if resp.status not in (200, 206):
+        raise S3ResponseError(resp.status, resp.reason, data)
+    return data
+
+def read_index(key):
+    """
+    Fetch and parse the index frame at the end of a compressed object
+
+    :rtype: FrameIndex
+    :returns: The index, or None if the object doesn't end with one
+    """
+    tail_length = len(INDEX_END) + INDEX_LENGTH_DIGITS
+    if key.size < tail_length:
+        return None
+    tail = _read_tail(key, min(key.size, INDEX_READ))
+    digits = tail[-tail_length:-len(INDEX_END)]
+    if not tail.endswith(INDEX_END) or not digits.isdigit():
+        return None
+    length = int(digits)
+    if length > key.size:
+        return None
+    if length > len(tail):
+        tail = _read_tail(key, length)
+    data = tail[-length:]
+    start = data.find(INDEX_MAGIC)
+    if start < 0:
+        return None
+    state = json.loads(data[start + len(INDEX_MAGIC):-tail_length])
+    return FrameIndex(get_codec(state["codec"]), state["parts"], key.size - length, data)
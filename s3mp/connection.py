@@ -0,0 +1,114 @@
+"""
+S3 connections and MultiPartUpload handles for pool workers
+
+Since we can't pickle S3Connection or MultiPartUpload objects, each worker
+connects once, in init_worker, and keeps the connection in its
+worker_state(). Tasks only carry bucket names, key names and upload ids.
+The worker turns those back into Bucket and MultiPartUpload objects without
+making any requests, so one worker can serve parts of many objects.
+"""
+import time
+import logging
+
+import boto
+from boto.connection import ConnectionPool
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.s3.multipart import MultiPartUpload
+
+from s3mp.engine import worker_state
+
+logger = logging.getLogger("s3mp.connection")
+
+def connect(secure=None, profile=None):
+    """
+    Connect to S3, overriding boto's HTTPS setting if secure is given
+
+    profile names a boto config profile with other credentials to use.
+    """
+    s3 = boto.connect_s3(calling_format=OrdinaryCallingFormat(), profile_name=profile)
+    if secure is not None:
+        s3.is_secure = secure
+    return s3
+
+def multipart_upload(bucket, key_name, upload_id):
+    """
+    Build a handle for an existing MultiPartUpload
+
+    This doesn't list the bucket's multipart uploads to find it, it just
+    fills in what S3 needs to address the upload.
+    """
+    mpu = MultiPartUpload(bucket)
+    mpu.key_name = key_name
+    mpu.id = upload_id
+    return mpu
+
+def init_worker(secure=None, retry=None, limiter=None, source_profile=None):
+    """
+    Set up the S3 connection for a pool worker
+
+    :type secure: bool
+    :param secure: Whether to use HTTPS, or None for boto's default
+
+    :type retry: s3mp.retry.RetryPolicy
+    :param retry: How the worker retries failed parts. Its connection
+                  doesn't retry on its own, unless the boto config says to.
+
+    :type limiter: s3mp.ratelimit.RateLimiter
+    :param limiter: Bandwidth and request rate limits shared by the pool
+
+    :type source_profile: string
+    :param source_profile: A boto profile to make a second connection with,
+                           for reading the source of a copy between accounts
+    """
+    t1 = time.time()
+    state = worker_state()
+    state.s3 = connect(secure)
+    state.s3.num_retries = 0
+    state.source_s3 = state.s3
+    if source_profile is not None:
+        state.source_s3 = connect(secure, source_profile)
+        state.source_s3.num_retries = 0
+    state.buckets = {}
+    state.retry = retry
+    state.limiter = limiter
+    logger.debug("Worker set up S3 connection in %0.3fs" % (time.time() - t1))
+
+def worker_connection(source=False):
+    """
+    Return this worker's S3 connection, or the one for reading the source of
+    a copy if source is set
+    """
+    if source:
+        return worker_state().source_s3
+    return worker_state().s3
+
+def reset_worker_connections():
+    """
+    Drop the HTTP connections this worker's S3 connection keeps alive
+
+    After a request fails on the network, the connection it was on may be
+    dead without boto knowing (httplib marks a response that was cut short
+    as closed, so boto would hand the connection out again).
+    """
+    state = worker_state()
+    for s3 in set([getattr(state, "s3", None), getattr(state, "source_s3", None)]):
+        if s3 is not None:
+            # boto has no public way to do this
+            s3._pool = ConnectionPool()
+
+def worker_bucket(bucket_name):
+    """
+    Return a Bucket on this worker's connection, without validating it
+    """
+    state = worker_state()
+    bucket = state.buckets.get(bucket_name)
+    if bucket is None:
+        bucket = state.s3.get_bucket(bucket_name, validate=False)
+        state.buckets[bucket_name] = bucket
+    return bucket
+
+def worker_mpu(bucket_name, key_name, upload_id):
+    """
+    Return a MultiPartUpload handle on this worker's connection
+    """
+    return multipart_upload(worker_bucket(bucket_name), key_name, upload_id)
@@ -0,0 +1,466 @@
+"""
+Copying S3 objects, in parts, within S3 or through this host
+
+do_part_copy and do_part_stream_copy run in the pool's workers. In the
+thread running the transfer, an ObjectCopy per object starts its
+MultiPartUpload and completes it once the parts are copied. run_copy is
+what TransferManager.copy runs, and s3-mp-copy wraps.
+"""
+from cStringIO import StringIO
+import logging
+from math import ceil
+import time
+import urlparse
+
+from boto.exception import S3ResponseError
+
+from s3mp.batch import existing_keys, is_prefix, join_url, read_manifest
+from s3mp.connection import worker_bucket, worker_connection, worker_mpu
+from s3mp.metrics import part_record
+from s3mp.ratelimit import worker_limiter
+from s3mp.retry import TransientError, worker_retry
+from s3mp.tuning import choose_part_size
+from s3mp.verify import IntegrityError, check_etag, composite_etag, md5_data, object_part_ranges, parse_etag
+
+logger = logging.getLogger("s3mp.copy")
+
+# Bucket names to the regions bucket_region found them in
+_regions = {}
+
+def do_part_copy(args):
+    """
+    Copy a part of a MultiPartUpload
+
+    Copy a single chunk between S3 objects, using this worker's S3
+    connection (see s3mp.connection). Objects under 5G come through here as
+    a single part with no upload id, and are copied with one PUT-copy.
+    Parts of a streamed copy are handed to do_part_stream_copy. Failed
+    requests are retried as the worker's RetryPolicy says. S3 copies the
+    part without it passing through this host, so it counts against the
+    worker's RateLimiter as a request, not as bytes.
+
+    Nothing is looked up per part: the task carries everything the copy
+    request needs.
+
+    :type args: tuple of (int, string, string, string, string, string, int, int, int, string, bool)
+    :param args: The actual arguments of this method. Due to lameness of
+                 multiprocessing, we have to extract these outside of the
+                 function definition.
+
+                 The arguments are: job number, S3 src bucket name, S3 key
+                 name, S3 dest bucket name, S3 key name, MultiPartUpload id
+                 (or None), the part number, part start position, part stop
+                 position, storage class, stream
+
+    :rtype: tuple of (int, int, string, int, float)
+    :returns: The job number, the part number, the ETag S3 returned for it,
+              the part size and the time spent copying it
+    """
+    # Multiprocessing args lameness
+    job, src_bucket_name, src_key_name, dest_bucket_name, dest_key_name, mpu_id, part_num, start_pos, end_pos, storage_class, stream = args
+    if stream:
+        return do_part_stream_copy(args)
+    logger.debug("do_part_copy got args: %s" % (args,))
+    t0 = time.time()
+    s = (end_pos - start_pos + 1)/1024./1024.
+    record = part_record()
+    record.update(job=job, key=src_key_name, part=part_num, offset=start_pos, bytes=end_pos - start_pos + 1)
+
+    retry = worker_retry()
+    limiter = worker_limiter()
+    tries = 0
+    if mpu_id is None:
+        # S3 copies the metadata and content type, but not the storage class
+        while True:
+            retry.wait()
+            limiter.request()
+            t1 = time.time()
+            try:
+                key = worker_bucket(dest_bucket_name).copy_key(dest_key_name, src_bucket_name,
+                        src_key_name, storage_class=storage_class)
+                break
+            except Exception, err:
+                tries = retry.failed(err, tries, "Copy of %s" % src_key_name)
+        t2 = time.time() - t1
+        logger.info("Copied %s (%0.2fM) in %0.2fs" % (src_key_name, s, t2))
+        record.update(setup=t1 - t0, transfer=t2, retries=tries)
+        return (job, part_num, key.etag, end_pos - start_pos + 1, t2)
+
+    # Do the copy
+    mpu = worker_mpu(dest_bucket_name, dest_key_name, mpu_id)
+    while True:
+        retry.wait()
+        limiter.request()
+        t1 = time.time()
+        try:
+            key = mpu.copy_part_from_key(src_bucket_name, src_key_name, part_num, start_pos, end_pos)
+            break
+        except Exception, err:
+            tries = retry.failed(err, tries, "Part %d of %s" % (part_num, src_key_name))
+
+    # Print some timings
+    t2 = time.time() - t1
+    logger.info("Copied part %s (%0.2fM) in %0.2fs at %0.2fMbps (%0.3fs overhead)" % (part_num, s, t2, s/max(t2, 1e-6), t1 - t0))
+    record.update(setup=t1 - t0, transfer=t2, retries=tries)
+    return (job, part_num, key.etag, end_pos - start_pos + 1, t2)
+
+def do_part_stream_copy(args):
+    """
+    Copy a part by downloading it from the source and uploading it
+
+    For copies S3 can't do itself, such as from a bucket in another region
+    or one only the --source-profile credentials can read. The part is read
+    into memory with a ranged GET on the worker's source connection, which
+    a retry resumes from the last byte read, then uploaded with its MD5.
+
+    Takes the same arguments, and returns the same, as do_part_copy.
+    """
+    job, src_bucket_name, src_key_name, dest_bucket_name, dest_key_name, mpu_id, part_num, start_pos, end_pos, storage_class, stream = args
+    logger.debug("do_part_stream_copy got args: %s" % (args,))
+    t0 = time.time()
+    size = end_pos - start_pos + 1
+    record = part_record()
+    record.update(job=job, key=src_key_name, part=part_num, offset=start_pos, bytes=size)
+    retry = worker_retry()
+    limiter = worker_limiter()
+    conn = worker_connection(source=True)
+
+    tries = 0
+    chunks = []
+    got = 0
+    t1 = time.time()
+    while got < size:
+        retry.wait()
+        limiter.request()
+        try:
+            resp = conn.make_request("GET", bucket=src_bucket_name, key=src_key_name,
+                    headers={'Range':"bytes=%d-%d" % (start_pos + got, end_pos)})
+            if record.get("ttfb") is None:
+                record["ttfb"] = time.time() - t1
+            if resp.status != 206:
+                raise S3ResponseError(resp.status, resp.reason, resp.read())
+            while got < size:
+                data = resp.read(min(limiter.block_size or size, size - got))
+                if data == "":
+                    break
+                limiter.transfer(len(data))
+                chunks.append(data)
+                got += len(data)
+            if got < size:
+                raise TransientError("Range %d-%d ended after %d of %d bytes" %
+                        (start_pos, end_pos, got, size))
+        except Exception, err:
+            tries = retry.failed(err, tries, "Part %d of %s" % (part_num, src_key_name))
+
+    data = "".join(chunks)
+    del chunks
+    md5 = md5_data(data)
+    fp = StringIO(data)
+    mpu = worker_mpu(dest_bucket_name, dest_key_name, mpu_id)
+    while True:
+        retry.wait()
+        limiter.request()
+        try:
+            fp.seek(0)
+            key = mpu.upload_part_from_file(limiter.wrap(fp), part_num, size=size, md5=md5)
+            break
+        except Exception, err:
+            tries = retry.failed(err, tries, "Part %d of %s" % (part_num, dest_key_name))
+
+    t2 = time.time() - t1
+    s = size/1024./1024.
+    logger.info("Copied part %s (%0.2fM) in %0.2fs at %0.2fMbps through this host" % (part_num, s, t2, s/max(t2, 1e-6)))
+    record.update(setup=t1 - t0, transfer=t2, retries=tries)
+    return (job, part_num, key.etag, size, t2)
+
+def validate_url( url ):
+    split = urlparse.urlsplit( url )
+    if split.scheme != "s3":
+        raise ValueError("'%s' is not an S3 url" % url)
+    return split.netloc, split.path[1:]
+
+class ObjectCopy(object):
+    """
+    An S3 object being copied to another S3 key
+
+    Objects under 5G are copied directly. Larger ones are copied in parts of
+    a MultiPartUpload. Either way the copy keeps the source's metadata,
+    content headers and storage class (unless --reduced-redundancy is given).
+
+    S3 gives a copy the same ETag as its source if it's copied the way the
+    source was uploaded: directly for a single PUT, or in the same parts.
+    To verify a copy of an object that was uploaded in parts, it's copied in
+    those parts whatever its size.
+
+    A streamed copy goes through this host instead (see do_part_stream_copy),
+    always as a MultiPartUpload. To verify one, an object uploaded with a
+    single PUT is copied as a single part, whose MD5 is its ETag.
+    """
+
+    def __init__(self, job, src_key, dest_bucket, dest_key_name, part_size, stream=False, listed=False):
+        self.job = job
+        self.src_key = src_key
+        self.dest_bucket = dest_bucket
+        self.dest_key_name = dest_key_name
+        self.dest = "s3://%s/%s" % (dest_bucket.name, dest_key_name)
+        self.size = src_key.size
+        self.part_size = part_size
+        self.stream = stream
+        # Keys from a listing don't have their metadata
+        self.listed = listed
+        self.mpu = None
+        self.etag = None
+        self.etags = {}
+        self.remaining = 0
+        self.finished = False
+
+    def source_headers(self):
+        """
+        Return the headers and metadata to give the destination, from a HEAD
+        of the source if it came from a listing
+        """
+        if self.listed:
+            src_key = self.src_key.bucket.get_key(self.src_key.name)
+            if src_key is None:
+                raise ValueError("'s3://%s/%s' no longer exists" % (self.src_key.bucket.name, self.src_key.name))
+            self.src_key = src_key
+            self.listed = False
+        return copy_headers(self.src_key), self.src_key.metadata
+
+    def start(self, reduced_redundancy=False, verify=False):
+        """
+        Initiate the MultiPartUpload if the object needs one
+
+        :rtype: list of tuples
+        :returns: The do_part_copy arguments for every part
+        """
+        size = self.size
+        part_size = self.part_size
+        src_bucket_name = self.src_key.bucket.name
+        src_key_name = self.src_key.name
+        dest_bucket_name = self.dest_bucket.name
+        storage_class = reduced_redundancy and 'REDUCED_REDUNDANCY' or self.src_key.storage_class
+
+        part_ranges = None
+        if verify:
+            part_ranges = object_part_ranges(self.src_key)
+            if part_ranges is None and size >= 5*1024*1024*1024:
+                raise IntegrityError("Can't verify a copy of s3://%s/%s, its ETag isn't "
+                        "an MD5" % (src_bucket_name, src_key_name))
+            if part_ranges is None and self.stream:
+                part_ranges = [(0, size - 1)]
+
+        if self.stream and size == 0:
+            # Nothing to stream
+            headers, metadata = self.source_headers()
+            if storage_class:
+                headers["x-amz-storage-class"] = storage_class
+            key = self.dest_bucket.new_key(self.dest_key_name)
+            key.metadata.update(metadata)
+            key.set_contents_from_string("", headers=headers)
+            self.etag = key.etag
+            return []
+
+        # If file is less than 5G, copy it directly
+        if not self.stream and size < 5*1024*1024*1024 and part_ranges is None:
+            logger.info("Source object is %0.2fM copying it directly" % ( size/1024./1024. ))
+            self.remaining = 1
+            return [(self.job, src_bucket_name, src_key_name, dest_bucket_name,
+                    self.dest_key_name, None, 1, 0, size - 1, storage_class, False)]
+
+        if part_ranges is None:
+            num_parts = int(ceil(size / float(part_size)))
+            part_ranges = [(i*part_size, min((i+1)*part_size - 1, size - 1)) for i in range(num_parts)]
+        else:
+            part_size = part_ranges[0][1] + 1
+        logger.info("Source object is %0.2fM splitting into %d parts of size %0.2fM%s" % (size/1024./1024.,
+                len(part_ranges), part_size/1024./1024., self.stream and ", streaming through this host" or ""))
+
+        # Create the multi-part upload object, with the source's headers
+        headers, metadata = self.source_headers()
+        if storage_class:
+            headers["x-amz-storage-class"] = storage_class
+        mpu = self.mpu = self.dest_bucket.initiate_multipart_upload(self.dest_key_name,
+                headers=headers, metadata=metadata)
+        logger.info("Initialized copy: %s" % mpu.id)
+
+        # Generate arguments for invocations of do_part_copy
+        part_args = []
+        for i, (part_start, part_end) in enumerate(part_ranges):
+            part_args.append((self.job, src_bucket_name, src_key_name, dest_bucket_name,
+                    mpu.key_name, mpu.id, i + 1, part_start, part_end, storage_class, self.stream))
+        self.remaining = len(part_args)
+        return part_args
+
+    def part_done(self, part_num, etag):
+        """
+        Record a finished part, returning True once every part is done
+        """
+        if self.mpu is None:
+            self.etag = etag
+        self.etags[part_num] = etag
+        self.remaining -= 1
+        return self.remaining == 0
+
+    def finish(self, verify=False):
+        if self.mpu is not None:
+            self.etag = self.mpu.complete_upload().etag
+        self.finished = True
+        if not verify:
+            return
+        if self.stream and self.mpu is not None and parse_etag(self.src_key.etag)[1] is None:
+            # A single PUT, streamed as one part: the part's MD5 is the source's
+            check_etag(self.dest, self.etags[1], self.src_key.etag)
+            check_etag(self.dest, self.etag, composite_etag([self.etags[1]]))
+        else:
+            check_etag(self.dest, self.etag, self.src_key.etag)
+
+    def abort(self):
+        mpu, self.mpu = self.mpu, None
+        if mpu is not None:
+            mpu.cancel_upload()
+
+def copy_headers(key):
+    """
+    Return the content headers of a boto Key (from a HEAD) to copy to another
+    """
+    headers = {}
+    for header, value in (("Content-Type", key.content_type), ("Content-Encoding", key.content_encoding),
+            ("Content-Disposition", key.content_disposition), ("Content-Language", key.content_language),
+            ("Cache-Control", key.cache_control)):
+        if value:
+            headers[header] = value
+    return headers
+
+def bucket_region(bucket):
+    """
+    Return the region a bucket is in, or None if it can't be found out
+
+    Regions are looked up once per bucket name, and kept in _regions.
+    """
+    name = bucket.name
+    if name not in _regions:
+        try:
+            _regions[name] = bucket.get_location() or "us-east-1"
+        except S3ResponseError, err:
+            logger.debug("Couldn't find the region of %s: %s" % (name, err))
+            _regions[name] = None
+    return _regions[name]
+
+def needs_stream(src_bucket, dest_bucket):
+    """
+    Return True if S3 can't copy between two buckets itself
+    """
+    if src_bucket.connection is not dest_bucket.connection:
+        # Different credentials
+        return True
+    src_region = bucket_region(src_bucket)
+    dest_region = bucket_region(dest_bucket)
+    return None not in (src_region, dest_region) and src_region != dest_region
+
+def gen_transfers(s3, src_s3, src, dest, manifest):
+    """
+    Yield the (source boto Key, dest Bucket, dest key name, whether the
+    source came from a listing) of every object to copy
+    """
+    buckets = {}
+    def lookup(conn, bucket_name):
+        if (conn, bucket_name) not in buckets:
+            bucket = conn.lookup( bucket_name )
+            if bucket is None:
+                raise ValueError("'%s' is not a valid bucket" % bucket_name)
+            buckets[(conn, bucket_name)] = bucket
+        return buckets[(conn, bucket_name)]
+
+    if manifest:
+        pairs = read_manifest(manifest)
+    else:
+        pairs = [(src, dest)]
+
+    for src_url, dest_url in pairs:
+        dest_bucket_name, dest_key_name = validate_url( dest_url )
+        src_bucket_name, src_key_name   = validate_url( src_url )
+        src_bucket = lookup( src_s3, src_bucket_name )
+        dest_bucket = lookup( s3, dest_bucket_name )
+
+        if is_prefix(src_url):
+            # Copy everything under the prefix, with one listing
+            for src_key in src_bucket.list(prefix=src_key_name):
+                if src_key.name.endswith("/"):
+                    continue
+                relpath = src_key.name[len(src_key_name):]
+                yield src_key, dest_bucket, validate_url(join_url(dest_url, relpath))[1], True
+            continue
+
+        src_key = src_bucket.get_key( src_key_name )
+        if src_key is None:
+            raise ValueError("'%s' does not exist." % src_url)
+        yield src_key, dest_bucket, dest_key_name, False
+
+def run_copy(manager, future, src, dest, split=50, force=False, reduced_redundancy=False, auto=False,
+        manifest=None, verify=False, stats_file=None, progress=False, stream=False):
+    """
+    Copy an object, every object under a prefix, or a manifest's objects
+
+    Runs in a thread of its own for TransferManager.copy, handing the parts
+    to the manager's pool, and checking between them whether the transfer
+    was cancelled. The options are those of s3-mp-copy. Sources are read
+    with the manager's source_profile, if it has one.
+
+    :rtype: list
+    :returns: The ObjectCopy of every object
+    """
+    if not manifest and (src is None or dest is None):
+        raise ValueError("Specify a source and destination, or a manifest")
+
+    copies = []
+    for job, (src_key, dest_bucket, dest_key_name, listed) in enumerate(gen_transfers(manager.s3,
+            manager.source_s3, src, dest, manifest)):
+        part_size = choose_part_size(src_key.size, split, auto)
+        copy_stream = stream or needs_stream(src_key.bucket, dest_bucket)
+        copies.append(ObjectCopy(job, src_key, dest_bucket, dest_key_name, part_size, copy_stream, listed))
+
+    # See if we're overwriting existing keys
+    if not force:
+        for dest_bucket in set(c.dest_bucket for c in copies):
+            existing = existing_keys(dest_bucket, [c.dest_key_name for c in copies if c.dest_bucket is dest_bucket])
+            if existing:
+                raise ValueError("'s3://%s/%s' already exists. Specify -f to overwrite it" %
+                        (dest_bucket.name, sorted(existing)[0]))
+    future.jobs = copies
+
+    part_args = []
+    try:
+        for copy in copies:
+            part_args.extend(copy.start(reduced_redundancy, verify))
+    except Exception:
+        for copy in copies:
+            copy.abort()
+        raise
+
+    # Do the thing
+    try:
+        with manager.run_parts(future, do_part_copy, part_args, sum(c.size for c in copies), auto,
+                stats_file, progress) as parts:
+            for job, part_num, etag, nbytes, seconds in parts:
+                copy = copies[job]
+                if copy.part_done(part_num, etag):
+                    # Finalize
+                    copy.finish(verify)
+                    if len(copies) > 1:
+                        logger.info("Finished copying %s" % copy.src_key.name)
+                parts.record(nbytes, seconds)
+        # Finish the copies that had no parts to send, such as streamed
+        # copies of empty objects
+        for copy in copies:
+            if not copy.finished:
+                copy.finish(verify)
+        parts.finish("copying", sum(c.size for c in copies))
+    except Exception:
+        if not future.cancelled():
+            logger.error("Encountered an error, canceling copy")
+        for copy in copies:
+            if not copy.finished:
+                copy.abort()
+        raise
+    return copies
@@ -0,0 +1,749 @@
+"""
+Downloading S3 objects in parallel byte ranges
+
+do_part_download runs in the pool's workers, fetching a range with a
+ranged GET. In the thread running the transfer, a FileDownload or
+StreamDownload per object works out its ranges and finishes it once
+they're in. run_download is what TransferManager.download runs, and
+s3-mp-download wraps.
+"""
+import hashlib
+import logging
+from math import ceil
+import os
+import re
+import sys
+import time
+import urlparse
+
+from boto.exception import S3ResponseError
+
+from s3mp.batch import is_prefix, join_url, list_keys, read_manifest
+from s3mp.compress import get_codec, read_index
+from s3mp.connection import worker_bucket, worker_connection
+from s3mp.journal import DownloadJournal, download_journal_path
+from s3mp.metrics import part_record
+from s3mp.ratelimit import worker_limiter
+from s3mp.retry import TransientError, worker_retry
+from s3mp.stream import OrderedWriter
+from s3mp.sync import SyncIndex
+from s3mp.tuning import choose_part_size
+from s3mp.writer import RangeWriter, preallocate
+from s3mp.verify import IntegrityError, check_etag, composite_etag, md5_file_range, object_part_ranges, parse_etag
+
+logger = logging.getLogger("s3mp.download")
+
+def do_part_download(args):
+    """
+    Download a part of an S3 object using Range header
+
+    We utilize the existing S3 GET request implemented by Boto and tack on the
+    Range header. We then read in 1Mb chunks of the file and write out to the
+    correct position in the target file. The range only counts as done if
+    exactly the requested number of bytes was written. Objects too small to
+    split come through here with no range, and are fetched with a plain GET.
+    With no file name the range is returned instead, for the parent to
+    write to a stream. With verify set, the range is hashed as it's read.
+    With direct set, it's written around the page cache (see
+    s3mp.writer). A part of a compressed object (see s3mp.compress) is
+    fetched into memory, decompressed, and written, or returned, as the
+    uncompressed range it stands for.
+
+    Failed requests are retried as the worker's RetryPolicy says. A retry
+    only asks for the bytes after the last one written, so a connection
+    dropped near the end of a large range doesn't fetch all of it again.
+
+    :type args: tuple of (int, string, string, string, int, int, int, bool, bool, tuple, int)
+    :param args: The actual arguments of this method. Due to lameness of
+                 multiprocessing, we have to extract these outside of the
+                 function definition.
+
+                 The arguments are: job number, S3 Bucket name, S3 key,
+                 local file name (or None), first byte, last byte (both
+                 None for the whole object), chunk size in Mb, verify,
+                 direct, for a compressed part the codec, frame size,
+                 uncompressed offset and uncompressed size (or None), and
+                 the offset in the file to write the range at (None for
+                 its first byte)
+
+    :rtype: tuple of (int, int, int, float, string, string)
+    :returns: The job number, the byte range that was downloaded, the
+              time it took, the data if there was no file name to write
+              it to, and the hex MD5 of the range if verify was set
+    """
+    job, bucket_name, key_name, fname, min_byte, max_byte, split, verify, direct, frame, offset = args
+    t0 = time.time()
+    conn = worker_connection()
+    retry = worker_retry()
+    limiter = worker_limiter()
+    record = part_record()
+    record.update(job=job, key=key_name, offset=min_byte)
+    tries = 0
+
+    if min_byte is None:
+        # Small enough for a single GET
+        key = worker_bucket(bucket_name).new_key(key_name)
+        while True:
+            retry.wait()
+            limiter.request()
+            t1 = time.time()
+            try:
+                key.get_contents_to_filename(fname)
+                break
+            except Exception, err:
+                tries = retry.failed(err, tries, "Download of %s" % fname)
+        # Small enough to account for after the fact
+        limiter.transfer(key.size)
+        t2 = time.time() - t1
+        logger.debug("Downloaded %s in %0.2fs" % (fname, t2))
+        record.update(offset=0, bytes=key.size, setup=t1 - t0, transfer=t2, retries=tries)
+        return (job, min_byte, max_byte, t2, None, None)
+
+    size = max_byte - min_byte + 1
+    chunk_size = min(size, split*1024*1024, limiter.block_size or size)
+    logger.debug("Reading HTTP stream in %dM chunks" % (chunk_size/1024./1024))
+    md5 = verify and hashlib.md5() or None
+    chunks = []
+    writer = None
+    if fname is not None and frame is None:
+        if offset is None:
+            offset = min_byte
+        logger.debug("Writing %s from byte %d" % (fname, offset))
+        writer = RangeWriter(fname, offset, direct)
+
+    # Bytes of the range written so far
+    s = 0
+    t1 = None
+    try:
+        while s < size:
+            retry.wait()
+            limiter.request()
+            if t1 is None:
+                t1 = time.time()
+            try:
+                # Make the S3 request for what's left of the range
+                resp = conn.make_request("GET", bucket=bucket_name,
+                        key=key_name, headers={'Range':"bytes=%d-%d" % (min_byte + s, max_byte)})
+                if record.get("ttfb") is None:
+                    record["ttfb"] = time.time() - t1
+                if resp.status != 206:
+                    raise S3ResponseError(resp.status, resp.reason, resp.read())
+                while s < size:
+                    data = resp.read(min(chunk_size, size - s))
+                    if data == "":
+                        break
+                    limiter.transfer(len(data))
+                    if writer is None:
+                        # Keep the range for the parent to write out in order
+                        chunks.append(data)
+                    else:
+                        writer.write(data)
+                    if md5 is not None:
+                        md5.update(data)
+                    s += len(data)
+                if s < size:
+                    raise TransientError("Range %d-%d ended after %d of %d bytes" %
+                            (min_byte, max_byte, s, size))
+            except Exception, err:
+                tries = retry.failed(err, tries, "Range %d-%d of %s" % (min_byte, max_byte, key_name))
+    finally:
+        if writer is not None:
+            writer.close()
+    t2 = time.time() - t1
+    record.update(bytes=s, setup=t1 - t0, transfer=t2, retries=tries)
+    s = s / 1024 / 1024.
+    logger.debug("Downloaded %0.2fM in %0.2fs at %0.2fMBps" % (s, t2, s/max(t2, 1e-6)))
+    digest = md5 is not None and md5.hexdigest() or None
+    if frame is not None:
+        codec_name, frame_length, uoffset, usize = frame
+        data = get_codec(codec_name).decompress("".join(chunks)[:frame_length])
+        del chunks[:]
+        if len(data) != usize:
+            raise IntegrityError("Part at byte %d of %s decompressed to %d bytes, expected %d" %
+                    (min_byte, key_name, len(data), usize))
+        if fname is None:
+            return (job, min_byte, max_byte, t2, data, digest)
+        writer = RangeWriter(fname, uoffset, direct)
+        try:
+            writer.write(data)
+        finally:
+            writer.close()
+        return (job, min_byte, max_byte, t2, None, digest)
+    if writer is None:
+        return (job, min_byte, max_byte, t2, "".join(chunks), digest)
+    return (job, min_byte, max_byte, t2, None, digest)
+
+def gen_byte_ranges(size, num_parts):
+    part_size = int(ceil(1. * size / num_parts))
+    for i in range(num_parts):
+        yield (part_size*i, min(part_size*(i+1)-1, size-1))
+
+def parse_range(value):
+    """
+    Parse a byte range as written in an HTTP Range header
+
+    START-END is inclusive, START- runs to the end of the object and -N is
+    its last N bytes.
+
+    :rtype: tuple of (int, int)
+    :returns: The first and last byte, with None for the first byte of a
+              suffix (whose last "byte" is then its length), or for the
+              last byte of a range that runs to the end
+    """
+    m = re.match(r"^(\d*)-(\d*)$", value.strip())
+    if m is None or not (m.group(1) or m.group(2)):
+        raise ValueError("'%s' isn't a byte range, such as 0-1023, 1024- or -1024" % value)
+    start = int(m.group(1)) if m.group(1) else None
+    end = int(m.group(2)) if m.group(2) else None
+    if start is None and not end:
+        raise ValueError("'%s' is an empty range" % value)
+    if start is not None and end is not None and end < start:
+        raise ValueError("'%s' ends before it starts" % value)
+    return start, end
+
+def resolve_ranges(ranges, size, url):
+    """
+    Work out the bytes of an object of the given size that ranges ask for
+
+    A range that runs past the end of the object is cut short, as S3 does,
+    but one that starts past it is an error. The ranges can't overlap, since
+    the ranges of a stream are told apart by their first byte.
+
+    :type ranges: list
+    :param ranges: (first byte, last byte) tuples as parse_range returns,
+                   or strings for it to parse
+
+    :rtype: list of tuples
+    :returns: The first and last byte of every range, in the order given
+    """
+    resolved = []
+    for byte_range in ranges:
+        if isinstance(byte_range, basestring):
+            byte_range = parse_range(byte_range)
+        start, end = byte_range
+        if start is None:
+            start, end = max(size - end, 0), size - 1
+        elif end is None or end >= size:
+            end = size - 1
+        if start >= size:
+            raise ValueError("Range %s is past the end of %s (%d bytes)" %
+                    ("-".join(b is not None and str(b) or "" for b in byte_range), url, size))
+        resolved.append((start, end))
+    in_order = sorted(resolved)
+    for (start, end), (next_start, next_end) in zip(in_order, in_order[1:]):
+        if next_start <= end:
+            raise ValueError("Ranges %d-%d and %d-%d of %s overlap" % (start, end, next_start, next_end, url))
+    return resolved
+
+def split_ranges(ranges, part_size):
+    """
+    Split the ranges of a partial download into parts of at most part_size
+
+    :rtype: generator of tuples
+    :returns: The first and last byte of every part, and its offset in the
+              ranges written out one after another
+    """
+    offset = 0
+    for start, end in ranges:
+        for min_byte in xrange(start, end + 1, part_size):
+            yield min_byte, min(min_byte + part_size - 1, end), offset + min_byte - start
+        offset += end - start + 1
+
+def frame_ranges(key, frames, verify=False):
+    """
+    Work out the ranges to fetch of a compressed object
+
+    :type frames: s3mp.compress.FrameIndex
+    :param frames: The object's index
+
+    :rtype: tuple of (list, list)
+    :returns: The (first byte, last byte, frame argument of
+              do_part_download) of every compressed part, and the (first
+              byte, last byte) of every part S3 has, to verify its ETag with
+    """
+    ranges = [(offset, offset + length - 1, (frames.codec.name, frame_length, uoffset, usize))
+            for offset, length, frame_length, uoffset, usize in frames.parts]
+    if parse_etag(key.etag)[1] is None:
+        # A single PUT, with the index in it too, has to be hashed whole
+        if verify:
+            ranges = [(0, key.size - 1, ranges[0][2])]
+        return ranges, [(0, key.size - 1)]
+    return ranges, [r[:2] for r in ranges] + [frames.index_range]
+
+def etag_of(key, md5s):
+    """
+    Return the ETag S3 gives an object with parts of these MD5s
+    """
+    if parse_etag(key.etag)[1] is None:
+        return md5s[0]
+    return composite_etag(md5s)
+
+class FileDownload(object):
+    """
+    An S3 object being downloaded to a local file
+
+    Objects under 1M are fetched with a single GET. Larger ones are split
+    into byte ranges, with a journal of the finished ranges kept next to the
+    file when resuming is enabled.
+
+    To verify an object that was uploaded in parts, the ranges are the parts
+    it was uploaded in, so the MD5s the workers compute add up to its ETag.
+
+    With decompress set, an object uploaded with --compress is fetched a
+    compressed part at a time, and the workers write the parts out
+    decompressed.
+
+    With ranges set, only those bytes of the object are fetched, split into
+    parts like a whole object, and the file holds them one after another.
+
+    The file is preallocated at its full size before any range is written.
+    """
+
+    def __init__(self, job, key, src, dest, part_size, direct=False, decompress=False, ranges=None):
+        self.job = job
+        self.key = key
+        self.src = src
+        self.dest = dest
+        self.size = key.size
+        # The (first byte, last byte) of every range to fetch, from resolve_ranges
+        self.ranges = ranges
+        if ranges is not None:
+            self.size = sum(end - start + 1 for start, end in ranges)
+        self.part_size = part_size
+        self.direct = direct
+        self.decompress = decompress
+        self.frames = None
+        self.journal = None
+        self.part_ranges = None
+        self.md5s = {}
+        self.remaining = 0
+        self.finished = False
+
+    def start(self, force=False, resume=False, verify=False):
+        """
+        Check the destination file and work out which ranges to fetch
+
+        :rtype: list of tuples
+        :returns: The do_part_download arguments for every range still to go
+        """
+        dest = self.dest
+        # Pick up where we left off if there's a journal for dest
+        if resume:
+            self.journal = DownloadJournal.load(download_journal_path(dest))
+            if self.journal is not None and not os.path.exists(dest):
+                # Nothing left of the earlier download to resume
+                self.journal.remove()
+                self.journal = None
+
+        if os.path.exists(dest) and self.journal is None:
+            if force:
+                os.remove(dest)
+            else:
+                raise ValueError("Destination file '%s' exists, specify -f to"
+                                 " overwrite" % dest)
+        journal = self.journal
+        if journal is not None and (journal.src, journal.size, journal.etag) != (self.src, self.size, self.key.etag):
+            raise ValueError("Journal '%s' was written for a different download, "
+                    "remove it and '%s' to start over" % (journal.path, dest))
+
+        dirname = os.path.dirname(dest)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        split = self.part_size / 1024 / 1024
+        bucket_name = self.key.bucket.name
+        if self.ranges is not None:
+            fd = os.open(dest, os.O_CREAT | os.O_WRONLY)
+            try:
+                preallocate(fd, self.size)
+            finally:
+                os.close(fd)
+            byte_ranges = list(split_ranges(self.ranges, self.part_size))
+            self.remaining = len(byte_ranges)
+            return [(self.job, bucket_name, self.key.name, dest, min_byte, max_byte, split, False, self.direct, None,
+                    offset) for min_byte, max_byte, offset in byte_ranges]
+
+        if self.decompress:
+            self.frames = read_index(self.key)
+            if self.frames is None:
+                logger.warning("%s wasn't uploaded with --compress, downloading it as it is" % self.src)
+        if verify and self.frames is None:
+            self.part_ranges = object_part_ranges(self.key)
+
+        # Skipping multipart if file is less than 1mb
+        if self.size < 1024 * 1024 and self.frames is None:
+            self.remaining = 1
+            return [(self.job, bucket_name, self.key.name, dest, None, None, split, verify, False, None, None)]
+
+        # Reserve the whole file, so it isn't built up from holes as the
+        # ranges land
+        fd = os.open(dest, os.O_CREAT | os.O_WRONLY)
+        try:
+            preallocate(fd, self.frames.size if self.frames is not None else self.size)
+        finally:
+            os.close(fd)
+
+        if self.frames is not None:
+            ranges, self.part_ranges = frame_ranges(self.key, self.frames, verify)
+            self.md5s[self.frames.index_range] = self.frames.index_md5
+            self.remaining = len(ranges)
+            return [(self.job, bucket_name, self.key.name, dest, min_byte, max_byte, split, verify, self.direct, frame, None)
+                    for min_byte, max_byte, frame in ranges]
+
+        if self.part_ranges is not None:
+            all_ranges = self.part_ranges
+        else:
+            num_parts = int(ceil(float(self.size) / self.part_size))
+            all_ranges = list(gen_byte_ranges(self.size, num_parts))
+        if journal is not None:
+            logger.info("Resuming download, %d of %d ranges already done" %
+                    (len(journal.ranges) - len(journal.pending()), len(journal.ranges)))
+        elif resume:
+            journal = self.journal = DownloadJournal(download_journal_path(dest), self.src,
+                    self.size, self.key.etag, all_ranges)
+            journal.save()
+        if journal is not None:
+            byte_ranges = journal.pending()
+        else:
+            byte_ranges = all_ranges
+
+        self.remaining = len(byte_ranges)
+        return [(self.job, bucket_name, self.key.name, dest, min_byte, max_byte, split, verify, self.direct, None, None)
+                for min_byte, max_byte in byte_ranges]
+
+    def range_done(self, min_byte, max_byte, md5=None):
+        """
+        Record a finished byte range, returning True once every range is done
+        """
+        if self.journal is not None:
+            self.journal.mark_done(min_byte, max_byte)
+        if md5 is not None:
+            self.md5s[(min_byte, max_byte)] = md5
+        self.remaining -= 1
+        return self.remaining == 0
+
+    def finish(self, verify=False):
+        if self.journal is not None:
+            self.journal.remove()
+        self.finished = True
+        if verify:
+            self.verify()
+
+    def record(self, index):
+        """
+        Add the finished download to a SyncIndex
+        """
+        part_size = self.part_ranges and self.part_ranges[0][1] + 1 or None
+        index.record(self.dest, self.src, self.key.etag, part_size)
+
+    def verify(self):
+        """
+        Check the downloaded file against the object's ETag
+
+        Parts the workers didn't hash (ranges fetched by an earlier, resumed
+        run, or the whole of a small object) are hashed from the file. An
+        object uploaded with a single PUT has to be hashed from the file as a
+        whole, since MD5s of its ranges can't be combined. A decompressed
+        file can't be hashed at all: a compressed object is checked from the
+        MD5s of what the workers fetched.
+        """
+        if self.frames is not None:
+            expected = etag_of(self.key, [self.md5s[r] for r in self.part_ranges])
+        elif self.part_ranges is None:
+            expected = md5_file_range(self.dest, 0, self.size)
+        else:
+            expected = composite_etag([self.md5s.get(r) or md5_file_range(self.dest, r[0], r[1] - r[0] + 1)
+                    for r in self.part_ranges])
+        check_etag(self.dest, self.key.etag, expected)
+        logger.debug("Verified %s" % self.dest)
+
+class StreamDownload(object):
+    """
+    An S3 object being downloaded to a stream, such as stdout
+
+    The ranges are fetched in parallel and handed back to the parent, which
+    writes them out in order through an OrderedWriter. Ranges are only given
+    to the pool while fewer than the writer's limit are outstanding, so at
+    most that many are ever held in memory, however slow any one of them is.
+
+    With verify set, an object uploaded in parts is fetched in those parts
+    and checked from the MD5s the workers compute. One uploaded with a
+    single PUT is hashed as it's written out.
+
+    With decompress set, the workers decompress the parts of an object
+    uploaded with --compress, and they're written out at the offsets of
+    the uncompressed data.
+
+    With ranges set, only those bytes are fetched, and they're written out
+    one after another.
+    """
+
+    def __init__(self, job, key, src, fp, part_size, decompress=False, ranges=None):
+        self.job = job
+        self.key = key
+        self.src = src
+        self.dest = "<stdout>"
+        self.fp = fp
+        self.size = key.size
+        self.part_size = part_size
+        self.decompress = decompress
+        self.ranges = ranges
+        if ranges is not None:
+            self.size = sum(end - start + 1 for start, end in ranges)
+        self.frames = None
+        # Where in the stream the ranges go, by first byte, for the parts of
+        # a compressed object or a partial download
+        self.offsets = {}
+        self.journal = None
+        self.writer = None
+        self.part_ranges = None
+        self.md5s = []
+        self.verify = False
+        self.remaining = 0
+        self.finished = False
+
+    def start(self, force=False, resume=False, verify=False):
+        """
+        :rtype: list of tuples
+        :returns: The do_part_download arguments for every range, in order
+        """
+        split = self.part_size / 1024 / 1024
+        self.verify = verify
+        if self.ranges is not None:
+            byte_ranges = list(split_ranges(self.ranges, self.part_size))
+            self.offsets = dict((min_byte, offset) for min_byte, max_byte, offset in byte_ranges)
+            self.remaining = len(byte_ranges)
+            return [(self.job, self.key.bucket.name, self.key.name, None, min_byte, max_byte, split, False, False, None,
+                    None) for min_byte, max_byte, offset in byte_ranges]
+        if self.decompress:
+            self.frames = read_index(self.key)
+            if self.frames is None:
+                logger.warning("%s wasn't uploaded with --compress, writing it as it is" % self.src)
+        if self.frames is not None:
+            ranges, self.part_ranges = frame_ranges(self.key, self.frames, verify)
+            self.md5s.append((self.frames.index_range[0], self.frames.index_md5))
+            self.offsets = dict((min_byte, frame[2]) for min_byte, max_byte, frame in ranges)
+            self.remaining = len(ranges)
+            return [(self.job, self.key.bucket.name, self.key.name, None, min_byte, max_byte, split, verify, False, frame, None)
+                    for min_byte, max_byte, frame in ranges]
+        if verify:
+            self.part_ranges = object_part_ranges(self.key)
+        if self.part_ranges is not None:
+            byte_ranges = self.part_ranges
+        elif self.size == 0:
+            byte_ranges = []
+        else:
+            byte_ranges = list(gen_byte_ranges(self.size, int(ceil(float(self.size) / self.part_size))))
+        self.remaining = len(byte_ranges)
+        return [(self.job, self.key.bucket.name, self.key.name, None, min_byte, max_byte, split, verify, False, None, None)
+                for min_byte, max_byte in byte_ranges]
+
+    def gate(self, max_buffers):
+        """
+        Return the Throttle that holds back ranges while max_buffers are outstanding
+        """
+        md5 = None
+        if self.verify and self.part_ranges is None and self.frames is None:
+            md5 = hashlib.md5()
+        self.writer = OrderedWriter(self.fp, max_buffers, md5=md5)
+        return self.writer.throttle
+
+    def range_done(self, min_byte, max_byte, data, md5=None):
+        """
+        Write out a finished range, returning True once every range is done
+        """
+        if md5 is not None:
+            self.md5s.append((min_byte, md5))
+        self.writer.write(self.offsets.get(min_byte, min_byte), data)
+        logger.debug("Wrote up to byte %d, %d ranges waiting" % (self.writer.offset, self.writer.buffered))
+        self.remaining -= 1
+        return self.remaining == 0
+
+    def finish(self, verify=False):
+        self.close()
+        size = self.frames.size if self.frames is not None else self.size
+        if self.writer is not None and self.writer.offset != size:
+            raise Exception("Wrote %d of %d bytes to %s" % (self.writer.offset, size, self.dest))
+        self.finished = True
+        if verify:
+            if self.frames is not None:
+                # A single PUT's one range also holds the index
+                md5s = [md5 for _, md5 in sorted(self.md5s)]
+                expected = etag_of(self.key, md5s[:len(self.part_ranges)])
+            elif self.part_ranges is not None:
+                expected = composite_etag([md5 for _, md5 in sorted(self.md5s)])
+            else:
+                expected = (self.writer and self.writer.md5 or hashlib.md5()).hexdigest()
+            check_etag(self.src, self.key.etag, expected)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def lookup_bucket(s3, buckets, bucket_name):
+    if bucket_name not in buckets:
+        bucket = s3.lookup(bucket_name)
+        if bucket == None:
+            raise ValueError("'%s' is not a valid bucket" % bucket_name)
+        buckets[bucket_name] = bucket
+    return buckets[bucket_name]
+
+def gen_transfers(s3, src, dest, manifest, listing=False):
+    """
+    Yield the (boto Key, S3 url, local file) of every object to download
+
+    With listing set, a manifest's objects are looked up with a listing per
+    top-level prefix (see list_keys) rather than a HEAD each.
+    """
+    buckets = {}
+    if manifest:
+        pairs = read_manifest(manifest)
+    else:
+        pairs = [(src, dest)]
+
+    # Bucket names mapped to their listed keys
+    listed = {}
+    if manifest and listing:
+        key_names = {}
+        for url, fname in pairs:
+            split_rs = urlparse.urlsplit(url)
+            if split_rs.scheme == "s3" and not is_prefix(url):
+                key_names.setdefault(split_rs.netloc, []).append(split_rs.path.lstrip("/"))
+        for bucket_name, names in key_names.items():
+            listed[bucket_name] = list_keys(lookup_bucket(s3, buckets, bucket_name), names)
+
+    for url, fname in pairs:
+        # Check that src is a valid S3 url
+        split_rs = urlparse.urlsplit(url)
+        if split_rs.scheme != "s3":
+            raise ValueError("'%s' is not an S3 url" % url)
+        logger.debug("split_rs: %s" % str(split_rs))
+        bucket = lookup_bucket(s3, buckets, split_rs.netloc)
+
+        if is_prefix(url):
+            # Fetch everything under the prefix, with one listing
+            prefix = split_rs.path.lstrip("/")
+            for key in bucket.list(prefix=prefix):
+                if key.name.endswith("/"):
+                    continue
+                relpath = key.name[len(prefix):]
+                yield key, "s3://%s/%s" % (bucket.name, key.name), join_url(fname, relpath)
+            continue
+
+        # Check that dest does not exist
+        if os.path.isdir(fname):
+            filename = split_rs.path.split('/')[-1]
+            fname = os.path.join(fname, filename)
+
+        if split_rs.netloc in listed:
+            key = listed[split_rs.netloc].get(split_rs.path.lstrip("/"))
+        else:
+            key = bucket.get_key(split_rs.path.lstrip("/"))
+        if key is None:
+          raise ValueError("'%s' does not exist." % split_rs.path)
+        yield key, url, fname
+
+def run_download(manager, future, src, dest, split=32, force=False, resume=False, auto=False, manifest=None,
+        max_buffers=None, verify=False, stats_file=None, progress=False, direct=False, sync=None,
+        decompress=False, ranges=None):
+    """
+    Download an object, every object under a prefix, or a manifest's objects
+
+    Runs in a thread of its own for TransferManager.download, handing the
+    ranges to the manager's pool, and checking between them whether the
+    transfer was cancelled. The options are those of s3-mp-download. A
+    single object is written to dest if it's a file object, or to stdout if
+    it's '-'. ranges (--range) is a list of byte ranges of a single object
+    to fetch instead of all of it, as parse_range returns or strings for it
+    to parse.
+
+    :rtype: list
+    :returns: The FileDownload (or StreamDownload) of every object
+    """
+    if not manifest and (src is None or dest is None):
+        raise ValueError("Specify a source and destination, or a manifest")
+    stream = not manifest and (dest == "-" or hasattr(dest, "write"))
+    if stream and (resume or sync or is_prefix(src)):
+        raise ValueError("Only a single object, without --resume or --sync, can be written to stdout")
+    if decompress and (resume or sync):
+        raise ValueError("--decompress can't be used with --resume or --sync")
+    if ranges and (manifest or is_prefix(src) or resume or sync or verify or decompress):
+        raise ValueError("--range fetches part of a single object, and can't be used with --resume, "
+                "--sync, --verify or --decompress")
+
+    index = sync and SyncIndex.load(sync) or None
+    downloads = []
+    transfers = gen_transfers(manager.s3, src, stream and "-" or dest, manifest, index is not None)
+    if index is not None:
+        # The keys come from the listing (or a HEAD) with their sizes and
+        # ETags, so checking them doesn't take any more requests
+        transfers = list(transfers)
+        changed = [(key, url, fname) for key, url, fname in transfers
+                if not index.unchanged(fname, url, key.size, key.etag)]
+        logger.info("%d of %d objects unchanged since the last sync" % (len(transfers) - len(changed),
+                len(transfers)))
+        transfers = changed
+        if not transfers:
+            index.save()
+            return downloads
+    for job, (key, url, fname) in enumerate(transfers):
+        size = key.size
+        byte_ranges = None
+        if ranges:
+            byte_ranges = resolve_ranges(ranges, key.size, url)
+            size = sum(end - start + 1 for start, end in byte_ranges)
+        part_size = choose_part_size(size, split, auto, multipart=False)
+        if stream:
+            fp = dest == "-" and sys.stdout or dest
+            downloads.append(StreamDownload(job, key, url, fp, part_size, decompress, byte_ranges))
+        else:
+            downloads.append(FileDownload(job, key, url, fname, part_size, direct, decompress, byte_ranges))
+    future.jobs = downloads
+
+    part_args = []
+    for download in downloads:
+        part_args.extend(download.start(force or index is not None, resume, verify))
+
+    try:
+        gate = None
+        if stream:
+            gate = downloads[0].gate(max_buffers or 2*manager.num_processes)
+        with manager.run_parts(future, do_part_download, part_args, sum(d.size for d in downloads), auto,
+                stats_file, progress, gate=gate) as parts:
+            for job, min_byte, max_byte, seconds, data, md5 in parts:
+                download = downloads[job]
+                if stream:
+                    done = download.range_done(min_byte, max_byte, data, md5)
+                else:
+                    done = download.range_done(min_byte, max_byte, md5)
+                if done:
+                    download.finish(verify)
+                    if index is not None:
+                        download.record(index)
+                    if len(downloads) > 1:
+                        logger.info("Finished downloading %s" % download.dest)
+                if min_byte is None:
+                    parts.record(download.size, seconds)
+                else:
+                    parts.record(max_byte - min_byte + 1, seconds)
+        # Finish resumed downloads that had no ranges left to fetch
+        for download in downloads:
+            if not download.finished:
+                download.finish(verify)
+                if index is not None:
+                    download.record(index)
+        parts.finish("downloading", sum(d.size for d in downloads))
+    except Exception:
+        if stream:
+            downloads[0].close()
+        for download in downloads:
+            if not download.finished:
+                logger.error("Download of '%s' is incomplete" % download.dest)
+                if download.journal is not None:
+                    logger.error("Run again with --resume to fetch the missing ranges")
+        raise
+    finally:
+        # Keep the files that did finish, even if others failed
+        if index is not None:
+            index.save()
+    return downloads
@@ -0,0 +1,349 @@
+"""
+Worker pools used to run part transfers concurrently
+
+Three engines are available, all driven through the same subset of the
+multiprocessing.Pool interface (apply_async, imap_unordered, close,
+terminate, join):
+
+process
+    A multiprocessing.Pool. Each worker is a separate interpreter.
+
+thread
+    A multiprocessing.pool.ThreadPool. Part transfers spend nearly all of
+    their time waiting on the network, so many threads can share one
+    interpreter without the GIL getting in the way.
+
+async
+    A pool of gevent greenlets, for running a large number of concurrent
+    part streams cheaply. gevent is an optional dependency. Its monkey
+    patching has to happen before boto, ssl, socket or threading are
+    imported, which is too late by the time a pool is made; the s3-mp-*
+    tools patch on startup when given --engine async, and library callers
+    must call gevent.monkey.patch_all() before importing s3mp.
+
+Whatever the engine, every worker runs the pool initializer once and then
+handles many parts, so state it keeps in worker_state() (such as an S3
+connection, which boto keeps alive between requests) is reused.
+
+run_tasks() feeds tasks to a pool and yields their results, optionally
+through a Throttle that limits how many are in flight at once. Throttled
+tasks are handed over one at a time as slots free up, so the tasks of
+transfers sharing a pool are interleaved rather than run one transfer
+after another.
+"""
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import Queue
+import threading
+
+ENGINES = ("process", "thread", "async")
+
+_local = None
+
+def worker_state():
+    """
+    Return the state object private to the calling worker
+
+    This is local to the current process, thread or greenlet, whichever
+    the engine runs workers as. It is created on first use so that, with
+    the async engine, it is made after gevent has patched threading.
+    """
+    global _local
+    if _local is None:
+        _local = threading.local()
+    return _local
+
+def make_pool(engine, processes, initializer=None, initargs=()):
+    """
+    Create a pool of workers for the given engine
+
+    :type engine: string
+    :param engine: One of ENGINES
+
+    :type processes: int
+    :param processes: Number of workers
+
+    :type initializer: callable
+    :param initializer: Called with initargs once in every worker, before
+                        it handles any tasks
+    """
+    if engine == "process":
+        return Pool(processes=processes, initializer=initializer, initargs=initargs)
+    elif engine == "thread":
+        return ThreadPool(processes=processes, initializer=initializer, initargs=initargs)
+    elif engine == "async":
+        return GreenletPool(processes, initializer, initargs)
+    raise ValueError("Unknown engine '%s', expected one of %s" % (engine, ", ".join(ENGINES)))
+
+class GreenletPool(object):
+    """
+    A pool of gevent greenlets that looks enough like multiprocessing.Pool
+
+    Each greenlet runs the initializer once and then takes tasks off a shared
+    queue until the pool is closed, the same way Pool workers do.
+    """
+
+    def __init__(self, processes, initializer=None, initargs=()):
+        try:
+            import gevent
+            from gevent import monkey
+            from gevent.queue import Queue
+        except ImportError:
+            raise ValueError("The async engine requires gevent (pip install gevent)")
+        if not monkey.is_module_patched("socket"):
+            raise ValueError("The async engine needs gevent.monkey.patch_all() "
+                    "to be called before boto or s3mp are imported")
+        self._gevent = gevent
+        self._queue_class = Queue
+        self._tasks = Queue()
+        self._workers = [gevent.spawn(self._run, initializer, initargs)
+                for _ in range(processes)]
+
+    def _run(self, initializer, initargs):
+        if initializer is not None:
+            initializer(*initargs)
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            func, arg, results = task
+            try:
+                results.put((True, func(arg)))
+            except Exception, err:
+                results.put((False, err))
+
+    def apply_async(self, func, args=(), callback=None):
+        # Unlike Pool's, this returns nothing to wait on; the callback gets
+        # the result, and an error is dropped
+        self._tasks.put((lambda args: func(*args), args, GreenletCallback(callback)))
+
+    def _feed(self, func, iterable, results):
+        count = 0
+        try:
+            for arg in iterable:
+                self._tasks.put((func, arg, results))
+                count += 1
+        except Exception, err:
+            results.put((False, err))
+        # Tell the results how many to expect
+        results.put((None, count))
+
+    def imap_unordered(self, func, iterable):
+        # Feed tasks from a separate greenlet, as Pool does from a thread, so
+        # an iterable that blocks (see run_tasks) doesn't block the caller
+        results = self._queue_class()
+        self._gevent.spawn(self._feed, func, iterable, results)
+        return GreenletResults(results)
+
+    def close(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+
+    def terminate(self):
+        self._gevent.killall(self._workers)
+
+    def join(self):
+        self._gevent.joinall(self._workers)
+
+class GreenletCallback(object):
+    """
+    Stands in for the results queue of a GreenletPool.apply_async task
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def put(self, item):
+        ok, value = item
+        if ok and self.callback is not None:
+            self.callback(value)
+
+class GreenletResults(object):
+    """
+    Iterator over the results of GreenletPool.imap_unordered
+
+    Like the multiprocessing version, next() takes an optional timeout,
+    re-raises any exception the task raised, and raises StopIteration once
+    the iterable is exhausted and every result has been returned.
+    """
+
+    def __init__(self, results):
+        self._results = results
+        self._expected = None
+        self._returned = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self, timeout=None):
+        while True:
+            if self._returned == self._expected:
+                raise StopIteration
+            ok, value = self._results.get(timeout=timeout)
+            if ok is None:
+                self._expected = value
+                continue
+            self._returned += 1
+            if not ok:
+                raise value
+            return value
+
+class Throttle(object):
+    """
+    A limit on the number of tasks in flight that can change as they run
+
+    Must be created after make_pool, so that with the async engine it is
+    built on gevent's patched threading.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def set_limit(self, limit):
+        self._cond.acquire()
+        try:
+            self.limit = limit
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def acquire(self, blocking=True):
+        """
+        Wait for a free slot, returning False if the throttle was closed
+
+        :type blocking: bool
+        :param blocking: If False, return False at once if there is no free
+                         slot instead of waiting for one
+        """
+        self._cond.acquire()
+        try:
+            while blocking and not self._closed and self._in_flight >= self.limit:
+                self._cond.wait()
+            if self._closed or self._in_flight >= self.limit:
+                return False
+            self._in_flight += 1
+            return True
+        finally:
+            self._cond.release()
+
+    def release(self):
+        self._cond.acquire()
+        try:
+            self._in_flight -= 1
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """
+        Stop handing out slots and wake anything waiting for one
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+def call_task(func, task):
+    """
+    Run func(task) in a worker, returning (True, result) or (False, error)
+
+    apply_async has no way to report an error to its caller in Python 2, so
+    run_tasks has its tasks return them instead.
+    """
+    try:
+        return (True, func(task))
+    except Exception, err:
+        return (False, err)
+
+def run_tasks(pool, func, tasks, throttle=None, stats=None, gate=None):
+    """
+    Run func over tasks in a pool, yielding results as they complete
+
+    :type pool: a pool from make_pool
+    :param pool: The pool to run the tasks in
+
+    :type func: callable
+    :param func: The worker function, called with a single task argument
+
+    :type tasks: iterable
+    :param tasks: The tasks to run. This may be a generator, which is
+                  consumed lazily: from the pool's task feeder without a
+                  throttle, and from the caller's thread with one.
+
+    :type throttle: Throttle
+    :param throttle: If given, the next task is only taken from tasks once
+                     fewer than throttle.limit of them are in flight, and
+                     is handed to the pool by itself
+
+    :type stats: s3mp.metrics.TransferStats
+    :param stats: If given, every task is timed and its metrics record is
+                  added to stats as its result comes in
+
+    :type gate: Throttle
+    :param gate: If given (with a throttle), a slot of it is also taken for
+                 every task. These are released by the caller rather than
+                 when the result comes in, such as once an OrderedWriter
+                 has written the task's data out. Tasks wait on it the same
+                 way as on throttle, so results keep being read meanwhile.
+    """
+    if stats is not None:
+        func, tasks = stats.wrap(func, tasks)
+
+    def result_of(value):
+        if stats is None:
+            return value
+        value, record = value
+        stats.add(record)
+        return value
+
+    if throttle is None:
+        results = pool.imap_unordered(func, tasks)
+        while True:
+            try:
+                yield result_of(results.next(9999999))
+            except StopIteration:
+                return
+
+    # Tasks are handed to the pool one at a time, from the caller's thread,
+    # rather than as an iterator: Pool has a single thread that drains the
+    # iterators it's given one after another, so a throttled one would hold
+    # up every transfer started after it until it ran out
+    results = Queue.Queue()
+    tasks_iter = iter(tasks)
+    in_flight = 0
+    exhausted = False
+    try:
+        while True:
+            # Take a slot before pulling the task, so a generator that builds
+            # tasks (such as reading buffers from a stream) runs at most
+            # throttle.limit ahead of the results. Only wait for one if
+            # there's no result to wait for instead.
+            while not exhausted and throttle.acquire(in_flight == 0):
+                if gate is not None and not gate.acquire(in_flight == 0):
+                    throttle.release()
+                    break
+                try:
+                    task = tasks_iter.next()
+                except StopIteration:
+                    throttle.release()
+                    if gate is not None:
+                        gate.release()
+                    exhausted = True
+                    break
+                pool.apply_async(call_task, (func, task), callback=results.put)
+                in_flight += 1
+            if in_flight == 0:
+                return
+            ok, value = results.get(True, 9999999)
+            in_flight -= 1
+            throttle.release()
+            if not ok:
+                raise value
+            yield result_of(value)
+    finally:
+        throttle.close()
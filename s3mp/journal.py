@@ -0,0 +1,184 @@
+"""
+On-disk journals used to resume interrupted transfers
+
+A journal is a small JSON file written next to the local file being
+transferred. It is rewritten atomically (write to a temporary file, then
+rename) after every completed part, so a crash at any point leaves either
+the previous or the new state on disk, never a torn file.
+"""
+import json
+import os
+
+UPLOAD_JOURNAL_SUFFIX = ".s3mp-upload"
+DOWNLOAD_JOURNAL_SUFFIX = ".s3mp-download"
+
+def upload_journal_path(fname):
+    """
+    Return the path of the upload journal for a local file
+    """
+    return fname + UPLOAD_JOURNAL_SUFFIX
+
+def download_journal_path(fname):
+    """
+    Return the path of the download journal for a local file
+    """
+    return fname + DOWNLOAD_JOURNAL_SUFFIX
+
+def find_journals(directory):
+    """
+    Yield the upload and download journals under a directory
+    """
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith(UPLOAD_JOURNAL_SUFFIX):
+                journal = UploadJournal.load(path)
+            elif name.endswith(DOWNLOAD_JOURNAL_SUFFIX):
+                journal = DownloadJournal.load(path)
+            else:
+                continue
+            if journal is not None:
+                yield journal
+
+def read_state(path):
+    """
+    Return the JSON state saved at path, or None if there isn't any
+    """
+    if not os.path.exists(path):
+        return None
+    fp = open(path, 'r')
+    try:
+        return json.load(fp)
+    finally:
+        fp.close()
+
+def write_state(path, state):
+    """
+    Save JSON state to path atomically
+    """
+    tmp_path = path + ".tmp"
+    fp = open(tmp_path, 'w')
+    try:
+        json.dump(state, fp)
+    finally:
+        fp.close()
+    os.rename(tmp_path, path)
+
+class UploadJournal(object):
+    """
+    Record of a MultiPartUpload in progress for a local file
+
+    Keeps the S3 destination and key name, the upload id, the file's size
+    and mtime and the part size the upload was started with, and the ETag of
+    every part that has finished.
+    """
+
+    def __init__(self, path, dest, key_name, upload_id, size, part_size, parts=None, mtime=None):
+        self.path = path
+        self.dest = dest
+        self.key_name = key_name
+        self.upload_id = upload_id
+        self.size = size
+        self.part_size = part_size
+        self.parts = parts or {}
+        self.mtime = mtime
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a journal from disk, returning None if there isn't one
+        """
+        state = read_state(path)
+        if state is None:
+            return None
+        parts = dict((int(num), etag) for num, etag in state['parts'].items())
+        return cls(path, state['dest'], state['key_name'], state['upload_id'],
+                state['size'], state['part_size'], parts, state.get('mtime'))
+
+    def describe(self):
+        return "upload of %s to %s, upload id %s, %d parts done" % (
+                self.path[:-len(UPLOAD_JOURNAL_SUFFIX)], self.dest,
+                self.upload_id, len(self.parts))
+
+    def save(self):
+        write_state(self.path, {
+            'dest': self.dest,
+            'key_name': self.key_name,
+            'upload_id': self.upload_id,
+            'size': self.size,
+            'part_size': self.part_size,
+            'mtime': self.mtime,
+            'parts': dict((str(num), etag) for num, etag in self.parts.items()),
+        })
+
+    def add_part(self, part_num, etag):
+        """
+        Record a finished part and write the journal out
+        """
+        self.parts[part_num] = etag
+        self.save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class DownloadJournal(object):
+    """
+    Record of a ranged download in progress to a local file
+
+    Keeps the S3 source, the size and ETag of the object when the download
+    started, the byte ranges it was split into, and a bitmap with a '1' for
+    every range that has been written out and checked.
+    """
+
+    def __init__(self, path, src, size, etag, ranges, done=None):
+        self.path = path
+        self.src = src
+        self.size = size
+        self.etag = etag
+        self.ranges = ranges
+        self.done = done or ['0'] * len(ranges)
+        self._index = dict((tuple(r), i) for i, r in enumerate(ranges))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a journal from disk, returning None if there isn't one
+        """
+        state = read_state(path)
+        if state is None:
+            return None
+        ranges = [tuple(r) for r in state['ranges']]
+        return cls(path, state['src'], state['size'], state['etag'], ranges,
+                list(state['done']))
+
+    def describe(self):
+        return "download of %s to %s, %d of %d ranges done" % (self.src,
+                self.path[:-len(DOWNLOAD_JOURNAL_SUFFIX)],
+                self.done.count('1'), len(self.ranges))
+
+    def save(self):
+        write_state(self.path, {
+            'src': self.src,
+            'size': self.size,
+            'etag': self.etag,
+            'ranges': [list(r) for r in self.ranges],
+            'done': ''.join(self.done),
+        })
+
+    def pending(self):
+        """
+        Return the byte ranges that still need to be downloaded
+        """
+        return [r for r, done in zip(self.ranges, self.done) if done != '1']
+
+    def mark_done(self, min_byte, max_byte):
+        """
+        Record a finished byte range and write the journal out
+        """
+        self.done[self._index[(min_byte, max_byte)]] = '1'
+        self.save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
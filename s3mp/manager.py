@@ -0,0 +1,491 @@
+"""
+A long-lived TransferManager, for using s3mp from Python
+
+Each run of an s3-mp-* tool connects to S3, starts a pool of workers, moves
+one batch of objects and exits. A TransferManager keeps the connection and
+the pool for as long as it's open, so a service that moves many objects
+only pays for them once: the workers keep their S3 connections alive from
+one transfer to the next, and every transfer shares the same retry policy
+and rate limits.
+
+upload(), download() and copy() take the same sources, destinations and
+options as the tools, and return a TransferFuture straight away. Each
+transfer runs in a thread of its own, which lists and starts its objects
+and hands their parts to the shared pool:
+
+    from s3mp import TransferManager
+
+    with TransferManager(num_processes=16) as manager:
+        futures = [manager.upload(fname, "s3://bucket/logs/" + os.path.basename(fname))
+                   for fname in fnames]
+        for future in futures:
+            future.result()
+
+open() returns a file over an object, for reading parts of it at random
+(see s3mp.reader), whose blocks are fetched through the same pool:
+
+    with manager.open("s3://bucket/table.parquet") as fp:
+        fp.seek(-8, os.SEEK_END)
+        footer_length = struct.unpack("<i", fp.read(4))[0]
+
+Every transfer hands its parts to the pool one at a time from its own
+thread, with at most num_processes of them in flight, so the parts of the
+transfers running at once are interleaved and a small transfer submitted
+after a large one doesn't wait for it to finish. The s3-mp-upload,
+s3-mp-download and s3-mp-copy tools run a single transfer through a
+TransferManager.
+"""
+import logging
+import sys
+import threading
+import time
+import urlparse
+
+from s3mp.connection import connect, init_worker
+from s3mp.copy import run_copy
+from s3mp.download import lookup_bucket, run_download
+from s3mp.engine import Throttle, make_pool, run_tasks
+from s3mp.metrics import TransferStats
+from s3mp.ratelimit import RateLimiter
+from s3mp.reader import BLOCK_SIZE, MAX_BLOCKS, READ_AHEAD, S3File
+from s3mp.retry import RetryPolicy
+from s3mp.tuning import ConcurrencyTuner
+from s3mp.upload import run_upload
+
+logger = logging.getLogger("s3mp.manager")
+
+class CancelledError(Exception):
+    """
+    Raised by TransferFuture.result() for a transfer that was cancelled
+    """
+
+class TimeoutError(Exception):
+    """
+    Raised by TransferFuture.result() when the timeout runs out first
+    """
+
+class TransferFuture(object):
+    """
+    A transfer running in a TransferManager
+
+    Works like concurrent.futures.Future, which Python 2 doesn't have:
+    result() waits for the transfer to finish and returns what it returned,
+    or raises what it raised.
+
+    :ivar jobs: The FileUpload, StreamUpload, FileDownload, StreamDownload
+                or ObjectCopy of every object in the transfer, once it has
+                listed them
+
+    :ivar throttle: The Throttle the transfer's parts go to the pool
+                    through, once it has started them
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.throttle = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        Ask the transfer to stop
+
+        No more of its parts go to the pool, and once the parts in flight
+        are back its unfinished uploads and copies are aborted, and result()
+        raises CancelledError.
+
+        :rtype: bool
+        :returns: False if the transfer had already finished
+        """
+        if self.done():
+            return False
+        self._cancelled = True
+        if self.throttle is not None:
+            self.throttle.close()
+        return True
+
+    def cancelled(self):
+        """
+        Whether cancel() was called before the transfer finished
+        """
+        return self._cancelled
+
+    def raise_if_cancelled(self):
+        """
+        Raise CancelledError if cancel() was called, for the transfer to
+        check between parts
+        """
+        if self._cancelled:
+            raise CancelledError("Transfer cancelled")
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the transfer and return its result, or raise its error
+
+        :type timeout: float
+        :param timeout: Seconds to wait before raising TimeoutError, or None
+                        to wait for as long as it takes
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the transfer and return the error it raised, if any
+        """
+        self._wait(timeout)
+        return self._exc_info and self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """
+        Call fn with this future once the transfer is done, or straight away
+        if it already is
+        """
+        self._lock.acquire()
+        try:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def _wait(self, timeout):
+        # Event.wait() with no timeout can't be interrupted by Ctrl-C in
+        # Python 2, so wait a second at a time
+        deadline = timeout is not None and time.time() + timeout or None
+        while not self._done.is_set():
+            wait = 1.
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise TimeoutError("Transfer still running after %0.2fs" % timeout)
+            self._done.wait(wait)
+
+    def _finish(self, result=None, exc_info=None):
+        """
+        Set the result, or the sys.exc_info() of the error, unless the
+        transfer has already been given one
+        """
+        self._lock.acquire()
+        try:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Error in a transfer's done callback")
+
+    def _abort(self):
+        """
+        Abort the unfinished uploads and copies of a transfer whose parts
+        will never come back, and finish it as cancelled
+        """
+        self._cancelled = True
+        for job in self.jobs:
+            if not job.finished and hasattr(job, "abort"):
+                try:
+                    job.abort()
+                except Exception, err:
+                    logger.error("Couldn't abort %s: %s" % (job.dest, err))
+        self._finish(exc_info=(CancelledError, CancelledError("Transfer cancelled"), None))
+
+class PartRun(object):
+    """
+    The parts of one transfer, going through the manager's pool
+
+    Iterating over it hands the parts to the pool and yields their results
+    as they come in, then raises CancelledError if the transfer was
+    cancelled meanwhile. TransferManager.run_parts makes one, to be used
+    as a context manager, so that leaving the loop early (on an error)
+    stops any more parts going to the pool:
+
+        with manager.run_parts(future, do_part_copy, part_args, size) as parts:
+            for result in parts:
+                ...
+                parts.record(nbytes, seconds)
+        parts.finish("copying", size)
+
+    The parts go through the future's throttle, which allows num_processes
+    of them in flight (or what the tuner settles on, with auto), so the
+    pool's workers are left to other transfers too. Cancelling the transfer
+    closes the throttle, so no more parts go to the pool and the loop ends
+    once the ones in flight are back.
+    """
+
+    def __init__(self, manager, future, func, part_args, size, auto=False, stats_file=None,
+            progress=False, limit=None, gate=None):
+        self.pool = manager.pool
+        self.future = future
+        self.func = func
+        self.part_args = part_args
+        self.gate = gate
+        self.stats_file = stats_file
+        self.tuner = ConcurrencyTuner(2, manager.num_processes) if auto else None
+        if limit is not None:
+            throttle = Throttle(limit)
+        else:
+            throttle = self.tuner and self.tuner.throttle or Throttle(manager.num_processes)
+        future.throttle = self.throttle = throttle
+        if future.cancelled():
+            throttle.close()
+        self.stats = None
+        if stats_file or progress:
+            self.stats = TransferStats(size, progress)
+        self.t1 = time.time()
+        self._results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __iter__(self):
+        self._results = run_tasks(self.pool, self.func, self.part_args, self.throttle, self.stats, self.gate)
+        for result in self._results:
+            yield result
+        self.future.raise_if_cancelled()
+
+    def close(self):
+        """
+        Stop handing parts to the pool
+        """
+        if self._results is not None:
+            self._results.close()
+        self.throttle.close()
+
+    def record(self, nbytes, seconds):
+        """
+        Tell the tuner, if there is one, how long a part of nbytes took
+        """
+        if self.tuner is not None:
+            self.tuner.record(nbytes, seconds)
+
+    def finish(self, verb, size):
+        """
+        Log (and write out) the transfer's metrics, and how fast it went
+
+        :type verb: string
+        :param verb: What was done, such as "uploading"
+
+        :type size: int
+        :param size: Bytes transferred
+        """
+        if self.stats is not None:
+            self.stats.finish()
+            logger.info(self.stats.describe())
+            if self.stats_file:
+                self.stats.write(self.stats_file)
+        t2 = time.time() - self.t1
+        s = size/1024./1024.
+        logger.info("Finished %s %0.2fM in %0.2fs (%0.2fMBps)" % (verb, s, t2, s/max(t2, 1e-6)))
+
+class TransferManager(object):
+    """
+    Runs uploads, downloads and copies through one pool of workers
+
+    :type num_processes: int
+    :param num_processes: Number of workers, shared by every transfer
+
+    :type engine: string
+    :param engine: What the workers are, one of s3mp.engine.ENGINES
+
+    :type secure: bool
+    :param secure: Whether to use HTTPS, or None for boto's default
+
+    :type max_tries: int
+    :param max_tries: Most times to retry a failed part
+
+    :type max_bandwidth: float
+    :param max_bandwidth: Most MB/s to transfer, across all transfers
+
+    :type max_requests_per_sec: float
+    :param max_requests_per_sec: Most requests per second to send, across
+                                 all transfers
+
+    :type source_profile: string
+    :param source_profile: A boto profile to read the sources of copies
+                           with, for copying between accounts
+    """
+
+    def __init__(self, num_processes=16, engine="thread", secure=True, max_tries=5, max_bandwidth=None,
+            max_requests_per_sec=None, source_profile=None):
+        self.num_processes = num_processes
+        self.s3 = connect(secure)
+        self.source_s3 = source_profile and connect(secure, source_profile) or self.s3
+        limiter = RateLimiter(max_bandwidth and max_bandwidth*1024*1024, max_requests_per_sec)
+        self.pool = make_pool(engine, num_processes, init_worker,
+                (secure, RetryPolicy(max_tries), limiter, source_profile))
+        self.futures = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
+
+    def upload(self, src, dest, **options):
+        """
+        Start uploading a file, a directory of files, or a stream
+
+        src and dest, and the options, are those of s3-mp-upload's main()
+        (split, force, verify, manifest and so on). src can also be a file
+        object to read a stream from.
+
+        :rtype: TransferFuture
+        :returns: The transfer, whose result is a list of the FileUpload (or
+                  StreamUpload) of every file
+        """
+        return self._submit(run_upload, src, dest, options)
+
+    def download(self, src, dest, **options):
+        """
+        Start downloading an object, or every object under a prefix
+
+        src and dest, and the options, are those of s3-mp-download's main().
+        dest can also be a file object to write a single object to.
+
+        :rtype: TransferFuture
+        :returns: The transfer, whose result is a list of the FileDownload
+                  (or StreamDownload) of every object
+        """
+        return self._submit(run_download, src, dest, options)
+
+    def copy(self, src, dest, **options):
+        """
+        Start copying an object, or every object under a prefix
+
+        src and dest, and the options, are those of s3-mp-copy's main().
+
+        :rtype: TransferFuture
+        :returns: The transfer, whose result is a list of the ObjectCopy of
+                  every object
+        """
+        return self._submit(run_copy, src, dest, options)
+
+    def run_parts(self, future, func, part_args, size, auto=False, stats_file=None, progress=False,
+            limit=None, gate=None):
+        """
+        Return a PartRun of a transfer's parts through the pool
+
+        :type func: callable
+        :param func: The worker function, called with each of part_args
+
+        :type size: int
+        :param size: Total bytes of the transfer, for its metrics, or None
+                     if it isn't known yet
+
+        :type limit: int
+        :param limit: Most parts to have in flight, instead of num_processes
+
+        :type gate: Throttle
+        :param gate: As for s3mp.engine.run_tasks
+
+        The other options are those of the tools.
+        """
+        return PartRun(self, future, func, part_args, size, auto, stats_file, progress, limit, gate)
+
+    def open(self, url, block_size=BLOCK_SIZE, read_ahead=READ_AHEAD, max_blocks=MAX_BLOCKS):
+        """
+        Open an object for reading, as a file whose blocks are fetched
+        through the pool and cached
+
+        The options are those of s3mp.reader.S3File. The file can't be read
+        once the manager has been shut down.
+
+        :rtype: s3mp.reader.S3File
+        """
+        self._check_open()
+        split_rs = urlparse.urlsplit(url)
+        if split_rs.scheme != "s3":
+            raise ValueError("'%s' is not an S3 url" % url)
+        bucket = lookup_bucket(self.s3, {}, split_rs.netloc)
+        key = bucket.get_key(split_rs.path.lstrip("/"))
+        if key is None:
+            raise ValueError("'%s' does not exist." % url)
+        return S3File(self.pool, key, url, block_size, read_ahead, max_blocks)
+
+    def _check_open(self):
+        if self._closed:
+            raise ValueError("The TransferManager has been shut down")
+
+    def _submit(self, func, src, dest, options):
+        self._lock.acquire()
+        try:
+            self._check_open()
+            future = TransferFuture()
+            self.futures.add(future)
+        finally:
+            self._lock.release()
+        future.add_done_callback(self._forget)
+        thread = threading.Thread(target=self._run, args=(func, future, src, dest, options))
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def _forget(self, future):
+        self._lock.acquire()
+        try:
+            self.futures.discard(future)
+        finally:
+            self._lock.release()
+
+    def _run(self, func, future, src, dest, options):
+        try:
+            result = func(self, future, src, dest, **options)
+        except Exception:
+            future._finish(exc_info=sys.exc_info())
+        else:
+            future._finish(result)
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        Stop taking transfers, and shut the pool down
+
+        :type wait: bool
+        :param wait: Wait for the running transfers to finish first
+
+        :type cancel: bool
+        :param cancel: Stop the running transfers instead. The pool is
+                       terminated, so their parts in flight stop at once,
+                       and their unfinished uploads and copies are aborted.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            futures = list(self.futures)
+        finally:
+            self._lock.release()
+        if cancel:
+            for future in futures:
+                future.cancel()
+            self.pool.terminate()
+            for future in futures:
+                future._abort()
+            self.pool.join()
+            return
+        if wait:
+            for future in futures:
+                future._wait(None)
+        self.pool.close()
+        if wait:
+            self.pool.join()
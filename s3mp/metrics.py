@@ -0,0 +1,227 @@
+"""
+Per-part metrics, collected in the parent, for --stats-file and --progress
+
+When run_tasks is given a TransferStats, every task is stamped with the
+time it was handed to the pool (taken from the task generator) and run
+through TimedTask in the worker. TimedTask starts a record for the part,
+the worker function fills it in through part_record(), and the record
+comes back to the parent with the result. The fields are:
+
+job, key
+    The object the part belongs to
+part, offset, bytes
+    The part number (uploads and copies), its first byte (not known for
+    streamed uploads) and its size
+worker
+    The process id and thread name of the worker that ran it
+queued, started, finished
+    When the part was handed to the pool, picked up by a worker and
+    finished, in seconds since the epoch
+queue_wait
+    started - queued
+setup
+    Time spent before the request: looking up the connection and handles,
+    opening the file and hashing the part
+ttfb
+    Time from sending a ranged GET to getting the response headers back
+    (not recorded for uploads and copies)
+transfer
+    Time spent on the request that moved the part, on the attempt that
+    succeeded. A ranged GET that is retried carries on where it stopped,
+    so for downloads this is from the first attempt.
+retries
+    Number of times the part was retried
+"""
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from math import ceil
+
+from s3mp.engine import worker_state
+
+FIELDS = ("job", "key", "part", "offset", "bytes", "worker", "queued", "started",
+          "finished", "queue_wait", "setup", "ttfb", "transfer", "retries")
+
+# Seconds between updates of the --progress line
+PROGRESS_INTERVAL = 0.5
+
+MB = 1024*1024.
+
+def part_record():
+    """
+    Return the metrics record of the part the calling worker is running
+
+    Outside of a TimedTask this is a throwaway dict, so worker functions
+    can always fill it in.
+    """
+    record = getattr(worker_state(), "part_record", None)
+    if record is None:
+        return {}
+    return record
+
+class TimedTask(object):
+    """
+    Wrap a worker function to time its tasks
+
+    Takes (queued time, task) and returns (result, record).
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, arg):
+        queued, task = arg
+        started = time.time()
+        record = dict.fromkeys(FIELDS)
+        record.update(queued=queued, started=started, queue_wait=started - queued, retries=0,
+                worker="%d/%s" % (os.getpid(), threading.current_thread().name))
+        state = worker_state()
+        state.part_record = record
+        try:
+            result = self.func(task)
+        finally:
+            state.part_record = None
+        record["finished"] = time.time()
+        return result, record
+
+def percentile(values, pct):
+    """
+    Return the pct'th percentile of values (nearest rank), or None
+    """
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[max(0, int(ceil(pct / 100. * len(values))) - 1)]
+
+class TransferStats(object):
+    """
+    Collects part records in the parent, and reports on them
+
+    :type total_bytes: int
+    :param total_bytes: Size of the whole transfer, if known, for --progress
+
+    :type progress: bool
+    :param progress: Keep a progress line updated on stderr
+    """
+
+    def __init__(self, total_bytes=None, progress=False, out=sys.stderr):
+        self.total_bytes = total_bytes
+        self.progress = progress
+        self.out = out
+        self.records = []
+        self.bytes = 0
+        self.start = time.time()
+        self.end = None
+        self._last_progress = 0
+
+    def wrap(self, func, tasks):
+        """
+        Return func and tasks wrapped to time every task (see run_tasks)
+        """
+        return TimedTask(func), ((time.time(), task) for task in tasks)
+
+    def add(self, record):
+        self.records.append(record)
+        self.bytes += record.get("bytes") or 0
+        if self.progress:
+            now = time.time()
+            if now - self._last_progress >= PROGRESS_INTERVAL:
+                self._last_progress = now
+                self._show_progress(now)
+
+    def _show_progress(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        line = "%0.1fM" % (self.bytes / MB)
+        if self.total_bytes:
+            line += " of %0.1fM (%d%%)" % (self.total_bytes / MB, 100 * self.bytes // self.total_bytes)
+        line += ", %d parts, %0.2fMBps, %ds" % (len(self.records), self.bytes / MB / elapsed, elapsed)
+        if self.out.isatty():
+            self.out.write("\r\033[K" + line)
+        else:
+            self.out.write(line + "\n")
+        self.out.flush()
+
+    def finish(self):
+        """
+        Stop the clock, and finish off the progress line
+        """
+        self.end = time.time()
+        if self.progress:
+            self._show_progress(self.end)
+            if self.out.isatty():
+                self.out.write("\n")
+
+    def latencies(self, field):
+        """
+        Return the p50, p95 and p99 of a field over all parts
+        """
+        values = [r[field] for r in self.records]
+        return dict(("p%d" % pct, percentile(values, pct)) for pct in (50, 95, 99))
+
+    def timeline(self, interval=1.0):
+        """
+        Return the throughput, in MBps, of every interval of the transfer
+
+        Each part's bytes are spread evenly over the time it was running.
+        """
+        end = self.end or time.time()
+        bins = [0.] * max(1, int(ceil((end - self.start) / interval)))
+        for r in self.records:
+            t0 = r["started"] - self.start
+            t1 = max(r["finished"] - self.start, t0 + 1e-6)
+            rate = (r["bytes"] or 0) / (t1 - t0)
+            for i in range(int(t0 // interval), min(len(bins), int(ceil(t1 / interval)))):
+                overlap = min(t1, (i+1)*interval) - max(t0, i*interval)
+                if overlap > 0:
+                    bins[i] += rate * overlap
+        return [{"t": i*interval, "MBps": round(b / MB / interval, 3)} for i, b in enumerate(bins)]
+
+    def summary(self):
+        elapsed = (self.end or time.time()) - self.start
+        return {
+            "parts": len(self.records),
+            "bytes": self.bytes,
+            "seconds": elapsed,
+            "MBps": self.bytes / MB / max(elapsed, 1e-6),
+            "retries": sum(r["retries"] or 0 for r in self.records),
+            "part_seconds": self.latencies("transfer"),
+            "queue_wait": self.latencies("queue_wait"),
+            "setup": self.latencies("setup"),
+            "ttfb": self.latencies("ttfb"),
+        }
+
+    def describe(self):
+        """
+        A one line summary of the part latencies, for the log
+        """
+        lat = self.latencies("transfer")
+        if lat["p50"] is None:
+            return "No parts transferred"
+        return ("%d parts, latency p50 %0.2fs p95 %0.2fs p99 %0.2fs, %d retries" %
+                (len(self.records), lat["p50"], lat["p95"], lat["p99"],
+                 sum(r["retries"] or 0 for r in self.records)))
+
+    def write(self, path):
+        """
+        Write the report to path
+
+        A .csv file gets a row per part. Anything else gets JSON with the
+        summary, the throughput timeline and the part records.
+        """
+        fp = open(path, "wb")
+        try:
+            if path.lower().endswith(".csv"):
+                writer = csv.DictWriter(fp, FIELDS)
+                writer.writerow(dict((f, f) for f in FIELDS))
+                for record in sorted(self.records, key=lambda r: r["started"]):
+                    writer.writerow(record)
+            else:
+                report = self.summary()
+                report["timeline"] = self.timeline()
+                report["records"] = sorted(self.records, key=lambda r: r["started"])
+                json.dump(report, fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
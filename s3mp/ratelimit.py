@@ -0,0 +1,140 @@
+"""
+Limits on bandwidth and request rate shared by every worker in a pool
+
+-np only bounds how many parts are in flight, not how fast they move. A
+RateLimiter holds a token bucket for bytes (--max-bandwidth) and one for
+requests (--max-requests-per-sec). The buckets live in shared memory and
+are made in the parent, so however many workers there are, and whatever
+the engine, together they stay under the limits. Any one worker can use
+the whole budget when the others are idle.
+
+Workers take tokens as they go: a request token before each request, and
+byte tokens for every block sent or received. A worker that takes more
+than the bucket holds goes into debt and sleeps until it's paid off, so
+the average rate holds for blocks of any size and waiting workers are
+served roughly in turn.
+"""
+import time
+from multiprocessing import Array
+
+from s3mp.engine import worker_state
+
+# How much of a burst, in seconds of the rate, a bucket can save up
+BURST_SECONDS = 0.25
+
+# Bytes to take from the bandwidth bucket at a time, so every 8K read boto
+# makes doesn't take the shared lock
+BLOCK_SIZE = 256*1024
+
+class TokenBucket(object):
+    """
+    A token bucket in shared memory
+
+    :type rate: float
+    :param rate: Tokens added per second
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.burst = max(self.rate * BURST_SECONDS, 1.)
+        # Tokens in the bucket, and when they were counted
+        self._state = Array("d", [self.burst, time.time()])
+
+    def take(self, n):
+        """
+        Take n tokens, sleeping until the bucket can afford them
+        """
+        lock = self._state.get_lock()
+        lock.acquire()
+        try:
+            now = time.time()
+            tokens = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate)
+            tokens -= n
+            self._state[0] = tokens
+            self._state[1] = now
+        finally:
+            lock.release()
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+class RateLimiter(object):
+    """
+    Bandwidth and request rate limits for a pool of workers
+
+    Create it in the parent, before make_pool, and pass it to the workers
+    through init_worker.
+
+    :type max_bandwidth: float
+    :param max_bandwidth: Most bytes per second, or None for no limit
+
+    :type max_requests: float
+    :param max_requests: Most requests per second, or None for no limit
+    """
+
+    def __init__(self, max_bandwidth=None, max_requests=None):
+        self.bandwidth = max_bandwidth and TokenBucket(max_bandwidth) or None
+        self.requests = max_requests and TokenBucket(max_requests) or None
+
+    def request(self):
+        """
+        Wait until another request can be sent
+        """
+        if self.requests is not None:
+            self.requests.take(1)
+
+    def transfer(self, nbytes):
+        """
+        Wait until nbytes more can be sent or received
+        """
+        if self.bandwidth is not None and nbytes > 0:
+            self.bandwidth.take(nbytes)
+
+    @property
+    def block_size(self):
+        """
+        Largest read that keeps to the bandwidth limit smoothly, or None
+        """
+        return self.bandwidth is not None and BLOCK_SIZE or None
+
+    def wrap(self, fp):
+        """
+        Return fp, or a wrapper that limits the rate it's read at
+        """
+        if self.bandwidth is None:
+            return fp
+        return LimitedReader(fp, self)
+
+class LimitedReader(object):
+    """
+    A file object that takes bandwidth tokens for the data read from it
+
+    Tokens are taken BLOCK_SIZE at a time, ahead of the reads.
+    """
+
+    def __init__(self, fp, limiter):
+        self.fp = fp
+        self.limiter = limiter
+        self._credit = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        while self._credit < len(data):
+            self.limiter.transfer(BLOCK_SIZE)
+            self._credit += BLOCK_SIZE
+        self._credit -= len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.fp.seek(offset, whence)
+
+    def tell(self):
+        return self.fp.tell()
+
+def worker_limiter():
+    """
+    Return the RateLimiter this worker was set up with
+    """
+    limiter = getattr(worker_state(), "limiter", None)
+    if limiter is None:
+        limiter = worker_state().limiter = RateLimiter()
+    return limiter
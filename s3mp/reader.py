@@ -0,0 +1,189 @@
+"""
+Reading an S3 object at random, as a file
+
+Formats such as Parquet, ORC and zip keep an index at the end, and tar
+archives are read a member at a time, so reading one table or member means
+a handful of seeks and short reads into a large object. Downloading the
+object first fetches far more than those need. An S3File, from
+TransferManager.open(), is a read-only file over the object that fetches
+only the blocks reads touch, with ranged GETs run by the manager's pool
+through do_part_download, the same as a download's parts.
+
+Blocks are kept in a cache, least recently used first, and the oldest are
+evicted once there are more than max_blocks. A read that carries on from
+where the last one ended is taken to be reading through the object, and
+the read_ahead blocks after it are fetched in parallel with its own, so
+they're there by the time the reader gets to them. A read anywhere else is
+a seek, which fetches just the blocks it needs, and leaves any read-ahead
+still in flight to be thrown away.
+"""
+import errno
+import logging
+import os
+from collections import OrderedDict
+from math import ceil
+
+from s3mp.download import do_part_download
+from s3mp.tuning import MB
+
+logger = logging.getLogger("s3mp.reader")
+
+BLOCK_SIZE = 8*MB
+
+# Blocks fetched ahead of a reader going through the object
+READ_AHEAD = 4
+
+# Most blocks to cache
+MAX_BLOCKS = 16
+
+class S3File(object):
+    """
+    An S3 object opened for reading, like a file opened with "rb"
+
+    Supports read(), seek(), tell() and close(), and can be used in a with
+    statement. It isn't safe to share between threads.
+
+    :type pool: a pool from s3mp.engine.make_pool
+    :param pool: The pool to fetch blocks with, set up with init_worker
+
+    :type key: boto.s3.key.Key
+    :param key: The object, with its size
+
+    :type url: string
+    :param url: The object's S3 url, used as the file's name
+
+    :type block_size: int
+    :param block_size: Bytes to fetch at a time
+
+    :type read_ahead: int
+    :param read_ahead: Blocks to fetch ahead of a sequential read
+
+    :type max_blocks: int
+    :param max_blocks: Most blocks to keep in the cache
+    """
+
+    def __init__(self, pool, key, url, block_size=BLOCK_SIZE, read_ahead=READ_AHEAD, max_blocks=MAX_BLOCKS):
+        if block_size <= 0 or max_blocks <= 0:
+            raise ValueError("block_size and max_blocks have to be positive")
+        self.pool = pool
+        self.key = key
+        self.name = url
+        self.size = key.size
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.max_blocks = max_blocks
+        self.num_blocks = int(ceil(float(self.size) / block_size))
+        # Block number to data, least recently used first
+        self.blocks = OrderedDict()
+        # Block number to the results of its fetch, for blocks in flight
+        self.pending = {}
+        self.closed = False
+        self.pos = 0
+        # Where the last read ended, to tell reading through from seeking
+        self._next = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def tell(self):
+        self._check_open()
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._check_open()
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError("Invalid whence (%r)" % whence)
+        if offset < 0:
+            raise IOError(errno.EINVAL, "Invalid argument")
+        self.pos = offset
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes, or to the end of the object if size is
+        negative
+        """
+        self._check_open()
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.pos + size, self.size)
+        if end <= self.pos:
+            return ""
+        first = self.pos // self.block_size
+        last = (end - 1) // self.block_size
+        needed = range(first, last + 1)
+        if self.pos == self._next:
+            ahead = range(last + 1, min(last + 1 + self.read_ahead, self.num_blocks))
+        else:
+            # A seek: the blocks read ahead of the last read aren't wanted
+            for index in self.pending.keys():
+                if index not in needed:
+                    del self.pending[index]
+            ahead = []
+        for index in needed + ahead:
+            self._fetch(index)
+
+        # Take the cached blocks before waiting for the rest, and only cache
+        # the new ones once the read has all of them, so they can't evict
+        # blocks the read still needs
+        blocks = dict((index, self.blocks[index]) for index in needed if index in self.blocks)
+        for index in needed:
+            if index not in blocks:
+                blocks[index] = self._wait(index)
+        chunks = []
+        for index in needed:
+            start = index * self.block_size
+            chunks.append(blocks[index][max(self.pos - start, 0):end - start])
+            self._cache(index, blocks[index])
+        self.pos = self._next = end
+        return "".join(chunks)
+
+    def _fetch(self, index):
+        """
+        Start fetching a block, unless it's cached or already on its way
+        """
+        if index in self.blocks or index in self.pending:
+            return
+        min_byte = index * self.block_size
+        max_byte = min(min_byte + self.block_size, self.size) - 1
+        logger.debug("Fetching bytes %d-%d of %s" % (min_byte, max_byte, self.name))
+        args = (index, self.key.bucket.name, self.key.name, None, min_byte, max_byte,
+                max(1, self.block_size / MB), False, False, None, None)
+        self.pending[index] = self.pool.imap_unordered(do_part_download, [args])
+
+    def _wait(self, index):
+        """
+        Wait for a block in flight and return it
+        """
+        results = self.pending.pop(index)
+        return results.next(9999999)[4]
+
+    def _cache(self, index, data):
+        """
+        Cache a block as the most recently used, evicting the least recently
+        used if there are too many
+        """
+        self.blocks.pop(index, None)
+        self.blocks[index] = data
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+    def close(self):
+        """
+        Drop the cache. Blocks still in flight are thrown away when they
+        arrive.
+        """
+        self.closed = True
+        self.blocks.clear()
+        self.pending.clear()
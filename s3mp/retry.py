@@ -0,0 +1,161 @@
+"""
+Retrying failed part requests
+
+Every worker retries its own part, but under S3 throttling (503 SlowDown)
+retrying on a fixed timer has all of them hit S3 again at once. Instead:
+
+- Errors are sorted into throttling, other transient errors and fatal
+  ones (see classify). Fatal errors, such as a missing key, a denied
+  request, a local file that can't be read or a bug, are raised at once.
+  Only network errors, 5xx responses, the 4xx codes in TRANSIENT_CODES
+  and data that arrived damaged are transient.
+- Transient errors are retried after an exponential backoff with full
+  jitter: attempt n sleeps a random time of up to base * 2**n seconds.
+- Throttling also pauses every worker in the pool, including the ones
+  about to start a new part, until the backoff is over. The pause is kept
+  in shared memory so worker processes see it too.
+
+A RetryPolicy is made in the parent and handed to every worker through
+init_worker. boto's own retry loop is turned off on worker connections,
+so retries aren't multiplied, unless num_retries is set in the boto config.
+After a network error, the worker's kept-alive connections are dropped
+before retrying.
+"""
+import httplib
+import logging
+import random
+import socket
+import time
+from multiprocessing import Value
+
+from boto.exception import BotoServerError, S3DataError
+
+from s3mp.connection import reset_worker_connections
+from s3mp.engine import worker_state
+
+logger = logging.getLogger("s3mp.retry")
+
+THROTTLE = "throttle"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# S3 error codes that mean "slow down", whatever the HTTP status
+THROTTLE_CODES = ("SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                  "TooManyRequests", "ServiceUnavailable")
+
+# 4xx error codes worth trying again. ExpiredToken isn't one, since trying
+# again with the same credentials fails the same way.
+TRANSIENT_CODES = ("RequestTimeout", "RequestTimeTooSkewed", "BadDigest", "IncompleteBody",
+                   "InternalError")
+
+class TransientError(Exception):
+    """
+    Raised by worker functions for a failure that should be retried, such
+    as a response that ended early
+    """
+
+def classify(err):
+    """
+    Return whether an error is THROTTLE, TRANSIENT or FATAL
+    """
+    if isinstance(err, BotoServerError):
+        if err.error_code in THROTTLE_CODES or err.status in (429, 503):
+            return THROTTLE
+        if err.status >= 500 or err.error_code in TRANSIENT_CODES:
+            return TRANSIENT
+        return FATAL
+    # S3DataError is raised when the ETag S3 returns for a part isn't the
+    # MD5 of the data sent, so the part is sent again
+    if isinstance(err, (socket.error, httplib.HTTPException, S3DataError, TransientError)):
+        return TRANSIENT
+    return FATAL
+
+class RetryPolicy(object):
+    """
+    How many times, and how long after, failed part requests are retried
+
+    Create it in the parent, before make_pool, and pass it to the workers
+    through init_worker.
+
+    :type max_tries: int
+    :param max_tries: Most times to retry a part before giving up
+
+    :type base: float
+    :param base: Upper bound, in seconds, of the first retry's backoff
+
+    :type cap: float
+    :param cap: Longest backoff, in seconds
+    """
+
+    def __init__(self, max_tries=5, base=0.5, cap=30.):
+        self.max_tries = max_tries
+        self.base = base
+        self.cap = cap
+        # Time until which throttling has paused the whole pool
+        self._paused_until = Value("d", 0.)
+
+    def backoff(self, attempt):
+        """
+        Return a random backoff, in seconds, for the given retry (from 0)
+        """
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def wait(self):
+        """
+        Sleep out any pause throttling has put on the pool
+        """
+        while True:
+            remaining = self._paused_until.value - time.time()
+            if remaining <= 0:
+                return
+            # Spread the end of the pause so workers don't all resume together
+            time.sleep(remaining + random.uniform(0, self.base))
+
+    def failed(self, err, attempt, what):
+        """
+        Handle a failed request: re-raise err, or sleep before retrying it
+
+        :type err: Exception
+        :param err: The error the request failed with. Must be called from
+                    the except clause, so a bare raise re-raises it.
+
+        :type attempt: int
+        :param attempt: Number of times the request has been retried so far
+
+        :type what: string
+        :param what: Description of the request, for the log
+
+        :rtype: int
+        :returns: attempt + 1
+        """
+        kind = classify(err)
+        if kind == FATAL or attempt >= self.max_tries:
+            logger.error("%s failed after %d retries: %s" % (what, attempt, err))
+            raise
+        if not isinstance(err, BotoServerError):
+            # Don't retry on a connection that may be dead
+            reset_worker_connections()
+        delay = self.backoff(attempt)
+        if kind == THROTTLE:
+            # Hold off the whole pool, not just this worker
+            paused_until = time.time() + delay
+            lock = self._paused_until.get_lock()
+            lock.acquire()
+            try:
+                if paused_until > self._paused_until.value:
+                    self._paused_until.value = paused_until
+            finally:
+                lock.release()
+        logger.warning("%s failed (%s: %s), retry %d of %d in %0.2fs" %
+                (what, kind, err, attempt + 1, self.max_tries, delay))
+        time.sleep(delay)
+        return attempt + 1
+
+def worker_retry():
+    """
+    Return the RetryPolicy this worker was set up with
+    """
+    policy = getattr(worker_state(), "retry", None)
+    if policy is None:
+        policy = worker_state().retry = RetryPolicy()
+    return policy
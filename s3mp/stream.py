@@ -0,0 +1,68 @@
+"""
+Writing ranges fetched in parallel to a stream, in order
+
+Ranges of an object complete in whatever order the workers finish them,
+but a pipe has to be written front to back. OrderedWriter holds each range
+until every byte before it has been written, and limits how many ranges
+can be outstanding (being fetched, or waiting on an earlier one) so that a
+slow range can't make the buffer grow without bound.
+"""
+from s3mp.engine import Throttle
+
+class OrderedWriter(object):
+    """
+    Write byte ranges that arrive in any order to a file object, in order
+
+    Must be created after make_pool, since it holds a Throttle. Pass that
+    throttle to run_tasks as its gate: a slot is taken for every range handed
+    to the pool, and freed once write() has written the range out.
+    """
+
+    def __init__(self, fp, limit, offset=0, md5=None):
+        """
+        :type fp: file
+        :param fp: Where to write the data, such as sys.stdout
+
+        :type limit: int
+        :param limit: Most ranges to have outstanding at once
+
+        :type offset: int
+        :param offset: Offset of the first byte that will be written
+
+        :type md5: hashlib md5 object
+        :param md5: If given, updated with the data as it's written
+        """
+        self.fp = fp
+        self.md5 = md5
+        self.offset = offset
+        self.throttle = Throttle(limit)
+        self._pending = {}
+
+    def write(self, offset, data):
+        """
+        Buffer a range, then write out everything that is now contiguous
+        """
+        if offset < self.offset or offset in self._pending:
+            raise ValueError("The range at byte %d was already written" % offset)
+        self._pending[offset] = data
+        while self.offset in self._pending:
+            data = self._pending.pop(self.offset)
+            self.fp.write(data)
+            if self.md5 is not None:
+                self.md5.update(data)
+            self.offset += len(data)
+            self.throttle.release()
+
+    @property
+    def buffered(self):
+        """
+        Number of ranges waiting on an earlier one
+        """
+        return len(self._pending)
+
+    def close(self):
+        """
+        Flush the file object and stop the throttle handing out slots
+        """
+        self.throttle.close()
+        self.fp.flush()
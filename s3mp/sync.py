@@ -0,0 +1,141 @@
+"""
+Skipping files and objects that haven't changed since the last transfer
+
+A SyncIndex is a JSON file, named with --sync, that records every local
+file the tools have uploaded or downloaded: its size and mtime when it was
+transferred, the S3 url, the object's ETag and the part size the ETag was
+made with. On the next run the destination (or source) objects come from
+a listing per top-level prefix rather than a HEAD per file (see
+s3mp.batch.list_keys), and a file is skipped if its size and mtime are
+still what the index says and the object still has the recorded ETag.
+
+A file with the right size that isn't in the index, or whose mtime has
+changed, is hashed in the parts the object was uploaded in and compared
+with the object's ETag, so files that were only touched, or were
+transferred before the index existed, aren't sent again. Without a part
+size for it (a download not in the index of an object uploaded in parts)
+the file is transferred.
+"""
+import logging
+import os
+
+from s3mp.journal import read_state, write_state
+from s3mp.verify import composite_etag, md5_file_range, parse_etag, part_ranges
+
+logger = logging.getLogger("s3mp.sync")
+
+INDEX_VERSION = 1
+
+def same_etag(etag, other):
+    return etag.strip('"').lower() == other.strip('"').lower()
+
+def local_etag(fname, size, etag, part_size=None):
+    """
+    Return the ETag a local file would have if uploaded like an object
+
+    :type etag: string
+    :param etag: The object's ETag, which says whether it was uploaded in
+                 parts, and how many
+
+    :type part_size: int
+    :param part_size: The size of the object's parts
+
+    :rtype: string
+    :returns: The file's ETag, or None if it can't be worked out
+    """
+    num_parts = parse_etag(etag)[1]
+    if num_parts is None:
+        return md5_file_range(fname, 0, size)
+    if not part_size:
+        return None
+    ranges = part_ranges(size, part_size, num_parts)
+    if ranges is None:
+        return None
+    return composite_etag([md5_file_range(fname, start, end - start + 1) for start, end in ranges])
+
+class SyncIndex(object):
+    """
+    Record of the local files transferred to or from S3
+
+    :type path: string
+    :param path: The index file
+
+    :type entries: dict
+    :param entries: Absolute file names mapped to dicts of url, size,
+                    mtime, etag and part_size
+    """
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index, or start an empty one if the file doesn't exist
+        """
+        state = read_state(path)
+        if state is None:
+            return cls(path)
+        if state.get("version") != INDEX_VERSION:
+            raise ValueError("'%s' isn't an s3-mp sync index" % path)
+        return cls(path, state["files"])
+
+    def save(self):
+        write_state(self.path, {"version": INDEX_VERSION, "files": self.entries})
+
+    def entry(self, fname, url):
+        """
+        Return the index entry for a file transferred to or from url
+        """
+        entry = self.entries.get(os.path.abspath(fname))
+        if entry is None or entry["url"] != url:
+            return None
+        return entry
+
+    def record(self, fname, url, etag, part_size=None, size=None, mtime=None):
+        """
+        Record a file as transferred to or from url
+
+        size and mtime default to the file's own, for a file that was just
+        written. An upload should pass the ones it started with, in case the
+        file changed while it was being sent.
+        """
+        if size is None or mtime is None:
+            st = os.stat(fname)
+            size, mtime = st.st_size, st.st_mtime
+        self.entries[os.path.abspath(fname)] = {"url": url, "size": size, "mtime": mtime,
+                "etag": etag.strip('"'), "part_size": part_size}
+
+    def unchanged(self, fname, url, size, etag, part_size=None):
+        """
+        Return True if a local file already matches an S3 object
+
+        :type size: int
+        :param size: The object's size
+
+        :type etag: string
+        :param etag: The object's ETag
+
+        :type part_size: int
+        :param part_size: The part size to hash the file in if the index
+                          doesn't have one for it
+        """
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return False
+        if st.st_size != size:
+            return False
+        entry = self.entry(fname, url)
+        if entry is not None and same_etag(entry["etag"], etag):
+            if (entry["size"], entry["mtime"]) == (size, st.st_mtime):
+                return True
+            part_size = entry["part_size"] or part_size
+        # Not indexed, or touched since: compare the contents
+        expected = local_etag(fname, size, etag, part_size)
+        if expected is None or not same_etag(expected, etag):
+            return False
+        logger.debug("%s matches %s, though it's not in the index" % (fname, url))
+        self.record(fname, url, etag, part_size, size, st.st_mtime)
+        return True
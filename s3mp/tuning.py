@@ -0,0 +1,124 @@
+"""
+Part sizing and concurrency autotuning for the --auto mode
+
+S3 allows at most 10,000 parts per multipart upload, and each part must be
+between 5Mb and 5Gb (except the last, which may be smaller). The part size
+is always raised as needed to respect those limits; with --auto it is also
+picked from the object size instead of from --split.
+
+ConcurrencyTuner adjusts a Throttle while a transfer runs. It starts with a
+few parts in flight and keeps adding more for as long as the measured
+throughput keeps improving.
+"""
+import logging
+from math import ceil
+
+from s3mp.engine import Throttle
+
+MB = 1024*1024
+MIN_PART_SIZE = 5*MB
+MAX_PART_SIZE = 5*1024*MB
+MAX_PARTS = 10000
+
+# With --auto, aim for about this many parts, each of at least 8Mb and,
+# unless the object needs bigger ones to fit in MAX_PARTS, at most 256Mb
+AUTO_TARGET_PARTS = 1000
+AUTO_MIN_PART_SIZE = 8*MB
+AUTO_MAX_PART_SIZE = 256*MB
+
+# Worker pool size with --auto when -np isn't given
+AUTO_MAX_WORKERS = 16
+
+logger = logging.getLogger("s3mp.tuning")
+
+def choose_part_size(size, split, auto=False, multipart=True):
+    """
+    Return the part size, in bytes, for an object of the given size
+
+    :type size: int
+    :param size: Size of the object, in bytes
+
+    :type split: int
+    :param split: The requested split size, in Mb, used unless auto is set
+
+    :type auto: bool
+    :param auto: Pick the part size from the object size
+
+    :type multipart: bool
+    :param multipart: Apply the S3 multipart upload limits. Ranged
+                      downloads don't need them.
+    """
+    if auto:
+        part_size = max(AUTO_MIN_PART_SIZE, min(size // AUTO_TARGET_PARTS, AUTO_MAX_PART_SIZE))
+    else:
+        part_size = split*MB
+    if multipart:
+        part_size = max(part_size, MIN_PART_SIZE, int(ceil(float(size) / MAX_PARTS)))
+    # Keep parts a whole number of Mb
+    part_size = max(MB, int(ceil(float(part_size) / MB)) * MB)
+    if multipart and part_size > MAX_PART_SIZE:
+        raise ValueError("%d bytes is too large for %d parts of at most 5G" % (size, MAX_PARTS))
+    if not auto and part_size != split*MB:
+        logger.warning("Using %dM parts instead of %dM to stay within S3's limits" %
+                (part_size/MB, split))
+    return part_size
+
+class ConcurrencyTuner(object):
+    """
+    Raise the number of parts in flight until throughput levels off
+
+    After every round of parts (as many as are in flight) completes, the
+    aggregate throughput is estimated as the number of parts in flight times
+    the per-part throughput the workers measured. While that improves by at
+    least `gain`, the limit is raised by half again, up to `ceiling`. Once it
+    stops improving the limit settles on the best one seen.
+    """
+
+    def __init__(self, start, ceiling, gain=1.1):
+        self.ceiling = ceiling
+        self.gain = gain
+        self.throttle = Throttle(min(start, ceiling))
+        self.settled = self.throttle.limit >= ceiling
+        self._best = (0., self.throttle.limit)
+        self._reset()
+
+    def _reset(self):
+        self._parts = 0
+        self._bytes = 0
+        self._seconds = 0.
+
+    def record(self, nbytes, seconds):
+        """
+        Record a finished part, adjusting the limit at the end of a round
+
+        :type nbytes: int
+        :param nbytes: Size of the part
+
+        :type seconds: float
+        :param seconds: Time the worker spent transferring it
+        """
+        if self.settled:
+            return
+        self._parts += 1
+        self._bytes += nbytes
+        self._seconds += seconds
+        limit = self.throttle.limit
+        if self._parts < max(2, limit):
+            return
+
+        rate = limit * self._bytes / max(self._seconds, 1e-6) / MB
+        self._reset()
+        best_rate, best_limit = self._best
+        if rate >= best_rate * self.gain and limit < self.ceiling:
+            self._best = (rate, limit)
+            new_limit = min(self.ceiling, limit + max(1, limit // 2))
+            logger.info("Autotune: %d parts in flight gave %0.2fMBps, trying %d" %
+                    (limit, rate, new_limit))
+            self.throttle.set_limit(new_limit)
+        else:
+            if rate > best_rate:
+                best_limit = limit
+            self.settled = True
+            logger.info("Autotune: settled on %d parts in flight (%0.2fMBps)" %
+                    (best_limit, max(rate, best_rate)))
+            self.throttle.set_limit(best_limit)
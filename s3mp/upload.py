@@ -0,0 +1,659 @@
+"""
+Uploading files and streams to S3 in parts
+
+do_part_upload and do_stream_part_upload run in the pool's workers. In the
+thread running the transfer, a FileUpload or StreamUpload per file hands
+them their parts and completes the MultiPartUpload once they're done.
+run_upload is what TransferManager.upload runs, and s3-mp-upload wraps.
+
+Parts are sent without a Content-MD5 header, since computing one would
+mean reading every part twice. S3 can't reject a part damaged on the way,
+so the check happens after the upload instead: the worker hashes the part
+as it's sent and compares that with the ETag S3 returns, and a part that
+doesn't match fails and is sent again (see send_part).
+"""
+from cStringIO import StringIO
+import logging
+from math import ceil
+import os
+import sys
+import time
+import urlparse
+
+from boto.exception import S3ResponseError
+
+from s3mp.compress import choose_compressed_part_size, compress_part, get_codec, index_frame
+from s3mp.batch import existing_keys, join_url, list_keys, read_manifest, walk_files
+from s3mp.connection import multipart_upload, worker_bucket
+from s3mp.journal import UploadJournal, upload_journal_path
+from s3mp.metrics import part_record
+from s3mp.ratelimit import worker_limiter
+from s3mp.retry import worker_retry
+from s3mp.sync import SyncIndex, local_etag, same_etag
+from s3mp.tuning import MAX_PARTS, MIN_PART_SIZE, choose_part_size
+from s3mp.verify import check_etag, composite_etag, md5_data
+
+logger = logging.getLogger("s3mp.upload")
+
+def send_part(bucket_name, key_name, mpu_id, i, fp, size, cb=None):
+    """
+    Send size bytes of fp as part i of a MultiPartUpload, or as the whole
+    object if mpu_id is None, with this worker's connection
+
+    boto hashes the data as it goes out, and raises if S3 returns an ETag
+    that isn't its MD5, so the data is read only once. Given no MD5, boto's
+    set_contents_from_file (and upload_part_from_file) would read it all
+    first to compute a Content-MD5.
+
+    :rtype: boto Key
+    :returns: The key, with the ETag S3 returned
+    """
+    key = worker_bucket(bucket_name).new_key(key_name)
+    # send_file sends key.size as the Content-Length
+    key.size = size
+    query_args = None
+    if mpu_id is not None:
+        query_args = "uploadId=%s&partNumber=%d" % (mpu_id, i+1)
+    # boto reports progress on an empty body as cb(0, 0)
+    key.send_file(fp, cb=size > 0 and cb or None, query_args=query_args, size=size)
+    return key
+
+def do_part_upload(args):
+    """
+    Upload a part of a MultiPartUpload
+
+    Open the target file and stream the chunk straight from it, using this
+    worker's S3 connection (see s3mp.connection). Boto reads the file in
+    small buffers, so the part is never held in memory as a whole, and it
+    is hashed as it's sent rather than read once beforehand for a
+    Content-MD5 (see send_part). Files
+    that are too small for a MultiPartUpload come through here as a single
+    part with no upload id, and are sent with a plain PUT.
+
+    With compression, the part is read into memory and compressed into a
+    frame of its own (see s3mp.compress), padded to the given size if it
+    comes out shorter. A single PUT also carries the object's index frame.
+
+    Failed requests are retried as the worker's RetryPolicy says, sending
+    the whole part again.
+
+    :type args: tuple of (int, string, string, string, string, int, int, int, tuple)
+    :param args: The actual arguments of this method. Due to lameness of
+                 multiprocessing, we have to extract these outside of the
+                 function definition.
+
+                 The arguments are: job number, S3 Bucket name, key name,
+                 MultiPartUpload id (or None), file name, the part number,
+                 part offset, part size, and the codec and size to pad to
+                 if the part is to be compressed (or None)
+
+    :rtype: tuple of (int, int, string, int, float, tuple)
+    :returns: The job number, the part number, the ETag S3 returned for it,
+              the part size, the time spent uploading it, and with
+              compression the (compressed size, frame size, part size)
+    """
+    # Multiprocessing args lameness
+    job, bucket_name, key_name, mpu_id, fname, i, start, size, compress = args
+    logger.debug("do_part_upload got args: %s" % (args,))
+    t0 = time.time()
+    if size <= 0 and mpu_id is not None:
+        raise Exception("Unexpectedly tried to upload an empty chunk")
+
+    def progress(x,y):
+        logger.debug("Part %d: %0.2f%%" % (i+1, 100.*x/y))
+
+    retry = worker_retry()
+    limiter = worker_limiter()
+    tries = 0
+    # Do the upload, reading at most size bytes from the part offset
+    frame = None
+    fp = open(fname, 'rb')
+    try:
+        fp.seek(start)
+        offset, length = start, size
+        if compress is not None:
+            # Send the part compressed, from memory
+            codec = get_codec(compress[0])
+            data = fp.read(size)
+            if len(data) != size:
+                raise IOError("Expected %d bytes to compress, found %d" % (size, len(data)))
+            data, frame_length = compress_part(codec, data, compress[1])
+            frame = (len(data), frame_length, size)
+            if mpu_id is None:
+                # The only part carries the index too
+                data += index_frame(codec, [frame])
+            fp.close()
+            fp = StringIO(data)
+            offset, length = 0, len(data)
+        while True:
+            retry.wait()
+            limiter.request()
+            t1 = time.time()
+            try:
+                fp.seek(offset)
+                key = send_part(bucket_name, key_name, mpu_id, i, limiter.wrap(fp), length, progress)
+                break
+            except Exception, err:
+                tries = retry.failed(err, tries, "Part %d of %s" % (i+1, fname))
+    finally:
+        fp.close()
+
+    # Print some timings
+    t2 = time.time() - t1
+    s = length/1024./1024.
+    if mpu_id is None:
+        logger.info("Uploaded %s (%0.2fM) in %0.2fs at %0.2fMBps" % (fname, s, t2, s/max(t2, 1e-6)))
+    else:
+        logger.info("Uploaded part %s (%0.2fM) in %0.2fs at %0.2fMBps (%0.3fs overhead)" % (i+1, s, t2, s/max(t2, 1e-6), t1 - t0))
+    part_record().update(job=job, key=key_name, part=i+1, offset=start, bytes=size,
+            setup=t1 - t0, transfer=t2, retries=tries)
+    return (job, i+1, key.etag, size, t2, frame)
+
+def do_stream_part_upload(args):
+    """
+    Upload a part of a MultiPartUpload from a buffer read off a stream
+
+    Like do_part_upload, except that the part's data comes with the task
+    instead of being read from a file. A stream that ends within the first
+    part comes through here with no upload id, and is sent with a plain PUT.
+
+    :type args: tuple of (int, string, string, string, int, string)
+    :param args: The arguments are: job number, S3 Bucket name, key name,
+                 MultiPartUpload id (or None), the part number, the part
+                 data
+
+    :rtype: tuple of (int, int, string, int, float, None)
+    :returns: The same as do_part_upload, for a part that isn't compressed
+    """
+    # Multiprocessing args lameness
+    job, bucket_name, key_name, mpu_id, i, data = args
+    logger.debug("do_stream_part_upload got part %d of %s (%d bytes)" % (i+1, key_name, len(data)))
+    size = len(data)
+    t0 = time.time()
+
+    def progress(x,y):
+        logger.debug("Part %d: %0.2f%%" % (i+1, 100.*x/y))
+
+    retry = worker_retry()
+    limiter = worker_limiter()
+    tries = 0
+    fp = StringIO(data)
+    while True:
+        retry.wait()
+        limiter.request()
+        t1 = time.time()
+        try:
+            fp.seek(0)
+            key = send_part(bucket_name, key_name, mpu_id, i, limiter.wrap(fp), size, progress)
+            break
+        except Exception, err:
+            tries = retry.failed(err, tries, "Part %d of %s" % (i+1, key_name))
+
+    # Print some timings
+    t2 = time.time() - t1
+    s = size/1024./1024.
+    logger.info("Uploaded part %s (%0.2fM) in %0.2fs at %0.2fMBps" % (i+1, s, t2, s/max(t2, 1e-6)))
+    part_record().update(job=job, key=key_name, part=i+1, bytes=size,
+            setup=t1 - t0, transfer=t2, retries=tries)
+    return (job, i+1, key.etag, size, t2, None)
+
+class FileUpload(object):
+    """
+    A local file being uploaded to an S3 key
+
+    Files under 5M are sent with a single PUT. Larger ones are split into
+    parts of a MultiPartUpload, which is journalled next to the file when
+    resuming is enabled.
+
+    With compress set, the workers compress the parts, and an index of them
+    is uploaded as a final part (see s3mp.compress).
+    """
+
+    def __init__(self, job, bucket, fname, key_name, dest, size, part_size, mtime=None, compress=None):
+        self.job = job
+        self.bucket = bucket
+        self.fname = fname
+        self.key_name = key_name
+        self.dest = dest
+        self.size = size
+        self.part_size = part_size
+        self.mtime = mtime
+        self.compress = compress
+        self.mpu = None
+        self.etag = None
+        self.frames = {}
+        self.journal = None
+        self.etags = {}
+        self.remaining = 0
+        self.finished = False
+
+    def gen_args(self):
+        """
+        Generate arguments for invocations of do_part_upload
+        """
+        part_size = self.part_size
+        size = self.size
+        if size < 5*1024*1024:
+            yield (self.job, self.bucket.name, self.key_name, None, self.fname, 0, 0, size, self.compress_args())
+            return
+
+        num_parts = int(ceil(size / part_size))
+        # If the last part is less than 5M, just fold it into the previous part
+        fold_last = ((size % part_size) < 5*1024*1024)
+        mpu = self.mpu
+        for i in range(num_parts+1):
+            part_start = part_size*i
+            if i == (num_parts-1) and fold_last is True:
+                yield (self.job, self.bucket.name, mpu.key_name, mpu.id, self.fname, i, part_start, size - part_start,
+                        self.compress_args())
+                break
+            else:
+                yield (self.job, self.bucket.name, mpu.key_name, mpu.id, self.fname, i, part_start, min(part_size, size - part_start),
+                        self.compress_args())
+
+    def compress_args(self):
+        """
+        Return the compression argument for do_part_upload
+        """
+        if self.compress is None:
+            return None
+        # The index is the last part, so every data part of a multipart
+        # upload has to reach S3's minimum
+        return (self.compress, self.mpu is not None and MIN_PART_SIZE or 0)
+
+    def start(self, reduced_redundancy=False, resume=False):
+        """
+        Initiate the MultiPartUpload, or reattach to a journalled one
+
+        :rtype: list of tuples
+        :returns: The do_part_upload arguments for every part still to go
+        """
+        if self.size < 5*1024*1024:
+            part_args = list(self.gen_args())
+            self.remaining = len(part_args)
+            return part_args
+
+        # Reattach to the upload in the journal if we're resuming one
+        if resume:
+            self.journal = UploadJournal.load(upload_journal_path(self.fname))
+            if self.journal is not None and (self.journal.dest, self.journal.size, self.journal.part_size) != (self.dest, self.size, self.part_size):
+                raise ValueError("Journal '%s' was written for a different upload, "
+                        "remove it to start over" % self.journal.path)
+            if self.journal is not None and self.journal.mtime != self.mtime:
+                # The parts already sent may not match the file any more
+                logger.warning("%s has changed since the upload in '%s' was started, starting over" %
+                        (self.fname, self.journal.path))
+                self.discard_journal()
+        if self.journal is not None:
+            self.mpu = multipart_upload(self.bucket, self.journal.key_name, self.journal.upload_id)
+            part_args = self.resume()
+        else:
+            # Create the multi-part upload object
+            self.mpu = self.bucket.initiate_multipart_upload(self.key_name, reduced_redundancy=reduced_redundancy)
+            logger.info("Initialized upload: %s" % self.mpu.id)
+            part_args = list(self.gen_args())
+            if resume:
+                self.journal = UploadJournal(upload_journal_path(self.fname), self.dest,
+                        self.mpu.key_name, self.mpu.id, self.size, self.part_size, mtime=self.mtime)
+                self.journal.save()
+        self.remaining = len(part_args)
+        return part_args
+
+    def discard_journal(self):
+        """
+        Abort the MultiPartUpload recorded in the journal, so its parts don't
+        linger, and remove the journal
+        """
+        journal, self.journal = self.journal, None
+        try:
+            self.bucket.cancel_multipart_upload(journal.key_name, journal.upload_id)
+        except S3ResponseError, err:
+            if err.status != 404:
+                logger.error("Couldn't abort upload %s: %s" % (journal.upload_id, err))
+        journal.remove()
+
+    def resume(self):
+        """
+        Reattach to the MultiPartUpload recorded in the journal
+
+        Lists the parts S3 has for the upload and keeps only those whose size
+        matches the part we would upload, and whose ETag matches the journal
+        if the journal has one for it. The journal is rewritten to hold
+        exactly those parts.
+
+        :rtype: list of tuples
+        :returns: The do_part_upload arguments for the missing parts
+        """
+        journal = self.journal
+        try:
+            uploaded = dict((part.part_number, part) for part in self.mpu)
+        except S3ResponseError, err:
+            if err.status == 404:
+                raise ValueError("Upload %s from '%s' no longer exists, remove the "
+                        "journal to start over" % (journal.upload_id, journal.path))
+            raise
+
+        part_args = list(self.gen_args())
+        expected_sizes = dict((args[5]+1, args[7]) for args in part_args)
+        done = {}
+        for part_num, part in uploaded.items():
+            if expected_sizes.get(part_num) != part.size:
+                continue
+            etag = journal.parts.get(part_num)
+            if etag is not None and etag.strip('"') != part.etag.strip('"'):
+                continue
+            done[part_num] = part.etag
+        journal.parts = done
+        journal.save()
+        self.etags.update(done)
+        logger.info("Resuming upload %s, %d of %d parts already uploaded" %
+                (self.mpu.id, len(done), len(part_args)))
+        return [args for args in part_args if args[5]+1 not in done]
+
+    def part_done(self, part_num, etag, frame=None):
+        """
+        Record a finished part, returning True once every part is done
+        """
+        if self.journal is not None:
+            self.journal.add_part(part_num, etag)
+        if frame is not None:
+            self.frames[part_num] = frame
+        self.etags[part_num] = etag
+        self.remaining -= 1
+        return self.remaining == 0
+
+    def finish(self, verify=False):
+        """
+        Complete the MultiPartUpload, checking its ETag if verify is set
+
+        Single PUTs don't need checking here, boto already compares their
+        ETag with the MD5 sent as Content-MD5.
+        """
+        if self.mpu is not None:
+            if self.compress is not None:
+                self.upload_index()
+            result = self.mpu.complete_upload()
+            self.etag = result.etag
+        else:
+            self.etag = self.etags[1]
+        if self.journal is not None:
+            self.journal.remove()
+        self.finished = True
+        if verify and self.mpu is not None:
+            check_etag(self.dest, result.etag, composite_etag([self.etags[n] for n in sorted(self.etags)]))
+
+    def upload_index(self):
+        """
+        Upload the index of the compressed parts, as the last part
+        """
+        data = index_frame(get_codec(self.compress), [self.frames[n] for n in sorted(self.frames)])
+        part_num = len(self.frames) + 1
+        key = self.mpu.upload_part_from_file(StringIO(data), part_num, size=len(data), md5=md5_data(data))
+        self.etags[part_num] = key.etag
+
+    def record(self, index):
+        """
+        Add the finished upload to a SyncIndex, as the file was when it started
+        """
+        index.record(self.fname, self.dest, self.etag, self.mpu and self.part_size or None,
+                self.size, self.mtime)
+
+    def abort(self):
+        """
+        Cancel the MultiPartUpload, unless it's journalled for resuming
+        """
+        mpu, self.mpu = self.mpu, None
+        if mpu is None:
+            return
+        if self.journal is not None:
+            logger.error("Run again with --resume to continue upload %s of '%s'" % (mpu.id, self.fname))
+        else:
+            mpu.cancel_upload()
+
+class StreamUpload(object):
+    """
+    A stream, such as stdin, being uploaded to an S3 key
+
+    The stream is read one part_size buffer at a time as the throttle the
+    tasks are run through frees up a slot (see run_tasks), so how much of it
+    is held in memory is capped by the throttle, not by its length. A stream
+    that ends within the first buffer is sent with a single PUT, otherwise
+    the MultiPartUpload is initiated once the first buffer fills and is
+    completed when the stream ends.
+    """
+
+    def __init__(self, job, bucket, stream, key_name, dest, part_size):
+        self.job = job
+        self.bucket = bucket
+        self.fname = "<stdin>"
+        self.stream = stream
+        self.key_name = key_name
+        self.dest = dest
+        self.part_size = part_size
+        self.size = 0
+        self.mpu = None
+        self.parts = 0
+        self.done = 0
+        self.etags = {}
+        self.eof = False
+        self.finished = False
+
+    def start(self, reduced_redundancy=False):
+        """
+        Return a generator of do_stream_part_upload arguments
+
+        Reading from the stream, and initiating the MultiPartUpload, happen
+        as the generator is consumed.
+        """
+        bucket_name = self.bucket.name
+        data = self.stream.read(self.part_size)
+        if len(data) < self.part_size:
+            self.eof = True
+            self.size = len(data)
+            self.parts = 1
+            logger.info("Stream is %0.2fM, uploading it directly" % (self.size/1024./1024.))
+            yield (self.job, bucket_name, self.key_name, None, 0, data)
+            return
+
+        mpu = self.mpu = self.bucket.initiate_multipart_upload(self.key_name, reduced_redundancy=reduced_redundancy)
+        logger.info("Initialized upload: %s" % mpu.id)
+        while data:
+            if self.parts == MAX_PARTS:
+                raise ValueError("Stream is longer than %d parts of %dM, use a larger --split" %
+                        (MAX_PARTS, self.part_size/1024/1024))
+            i = self.parts
+            self.parts += 1
+            self.size += len(data)
+            yield (self.job, bucket_name, mpu.key_name, mpu.id, i, data)
+            data = self.stream.read(self.part_size)
+        self.eof = True
+
+    def part_done(self, part_num, etag, frame=None):
+        """
+        Record a finished part, returning True once the stream has ended
+        and every part is done
+        """
+        self.done += 1
+        self.etags[part_num] = etag
+        return self.eof and self.done == self.parts
+
+    def finish(self, verify=False):
+        if self.mpu is not None:
+            result = self.mpu.complete_upload()
+        self.finished = True
+        if verify and self.mpu is not None:
+            check_etag(self.dest, result.etag, composite_etag([self.etags[n] for n in sorted(self.etags)]))
+
+    def abort(self):
+        mpu, self.mpu = self.mpu, None
+        if mpu is not None:
+            mpu.cancel_upload()
+
+def gen_transfers(src, dest, manifest):
+    """
+    Yield the (local file, S3 url) pairs to upload
+    """
+    if manifest:
+        for pair in read_manifest(manifest):
+            yield pair
+    elif os.path.isdir(src):
+        for path, relpath in walk_files(src):
+            yield path, join_url(dest, relpath)
+    else:
+        yield src, dest
+
+def run_upload(manager, future, src, dest, split=50, force=False, reduced_redundancy=False, resume=False,
+        auto=False, manifest=None, max_buffers=None, verify=False, stats_file=None, progress=False, sync=None,
+        compress=None):
+    """
+    Upload a file, a directory of files, a manifest's files or a stream
+
+    Runs in a thread of its own for TransferManager.upload, handing the parts
+    to the manager's pool, and checking between them whether the transfer
+    was cancelled. The options are those of s3-mp-upload. A stream is read
+    from src if it's a file object, or from stdin if it's '-'.
+
+    :rtype: list
+    :returns: The FileUpload (or StreamUpload) of every file uploaded
+    """
+    if not manifest and (src is None or dest is None):
+        raise ValueError("Specify a source and destination, or a manifest")
+    stream = not manifest and (src == "-" or hasattr(src, "read"))
+    if stream and (resume or auto or sync or compress):
+        raise ValueError("--resume, --auto, --sync and --compress need a source file, not a stream")
+    if compress and (resume or sync):
+        raise ValueError("--compress can't be used with --resume or --sync")
+    codec = compress and get_codec(compress) or None
+
+    s3 = manager.s3
+    buckets = {}
+    uploads = []
+    transfers = stream and [(src, dest)] or gen_transfers(src, dest, manifest)
+    for job, (fname, url) in enumerate(transfers):
+        # Check that dest is a valid S3 url
+        split_rs = urlparse.urlsplit(url)
+        if split_rs.scheme != "s3":
+            raise ValueError("'%s' is not an S3 url" % url)
+        if split_rs.netloc not in buckets:
+            bucket = s3.lookup(split_rs.netloc)
+            if bucket == None:
+                raise ValueError("'%s' is not a valid bucket" % split_rs.netloc)
+            buckets[split_rs.netloc] = bucket
+        bucket = buckets[split_rs.netloc]
+        key_name = split_rs.path.lstrip("/")
+
+        if stream:
+            if not key_name or key_name.endswith("/"):
+                raise ValueError("'%s' must name a key to upload a stream to" % url)
+            fp = src == "-" and sys.stdin or src
+            uploads.append(StreamUpload(job, bucket, fp, key_name, url, choose_part_size(0, split)))
+            continue
+
+        # Determine the splits
+        st = os.stat(fname)
+        part_size = choose_part_size(st.st_size, split, auto)
+        if codec is not None and st.st_size >= MIN_PART_SIZE:
+            part_size = choose_compressed_part_size(codec, fname, st.st_size, part_size)
+        uploads.append(FileUpload(job, bucket, fname, key_name, url, st.st_size, part_size, st.st_mtime, compress))
+
+    index = None
+    if sync:
+        # Skip the files whose keys already match them
+        index = SyncIndex.load(sync)
+        unchanged = set()
+        for bucket in buckets.values():
+            bucket_uploads = [u for u in uploads if u.bucket is bucket]
+            existing = list_keys(bucket, [u.key_name for u in bucket_uploads])
+            for upload in bucket_uploads:
+                key = existing.get(upload.key_name)
+                if key is not None and index.unchanged(upload.fname, upload.dest, key.size, key.etag,
+                        upload.part_size):
+                    unchanged.add((upload.fname, upload.dest))
+        logger.info("%d of %d files unchanged since the last sync" % (len(unchanged), len(uploads)))
+        uploads = [u for u in uploads if (u.fname, u.dest) not in unchanged]
+        for job, upload in enumerate(uploads):
+            upload.job = job
+        if not uploads:
+            index.save()
+            return uploads
+    elif resume and not force:
+        # A resumed run carries on with the files it has journals for, and
+        # skips those whose keys a run before it finished
+        uploaded = set()
+        for bucket in buckets.values():
+            bucket_uploads = [u for u in uploads if u.bucket is bucket]
+            existing = list_keys(bucket, [u.key_name for u in bucket_uploads])
+            for upload in bucket_uploads:
+                key = existing.get(upload.key_name)
+                if key is None or os.path.exists(upload_journal_path(upload.fname)):
+                    continue
+                # Only a key holding this file counts as done, which the
+                # listing's ETag says without fetching it
+                expected = key.size == upload.size and local_etag(upload.fname, upload.size, key.etag,
+                        upload.part_size)
+                if not expected or not same_etag(expected, key.etag):
+                    raise ValueError("'%s' already exists. Specify -f to overwrite it" % upload.dest)
+                uploaded.add(upload)
+        if uploaded:
+            logger.info("%d of %d files already uploaded" % (len(uploaded), len(uploads)))
+            uploads = [u for u in uploads if u not in uploaded]
+            for job, upload in enumerate(uploads):
+                upload.job = job
+    elif not force:
+        # See if we're overwriting existing keys
+        for bucket in buckets.values():
+            key_names = [u.key_name for u in uploads if u.bucket is bucket]
+            existing = existing_keys(bucket, key_names)
+            if existing:
+                raise ValueError("'s3://%s/%s' already exists. Specify -f to overwrite it" %
+                        (bucket.name, sorted(existing)[0]))
+    future.jobs = uploads
+
+    if stream:
+        # Parts are read from the stream as the pool takes them
+        part_args = uploads[0].start(reduced_redundancy)
+    else:
+        part_args = []
+        try:
+            for upload in uploads:
+                part_args.extend(upload.start(reduced_redundancy, resume))
+        except Exception:
+            for upload in uploads:
+                upload.abort()
+            raise
+
+    # Do the thing
+    try:
+        with manager.run_parts(future, stream and do_stream_part_upload or do_part_upload, part_args,
+                not stream and sum(u.size for u in uploads) or None, auto, stats_file, progress,
+                limit=stream and (max_buffers or manager.num_processes + 1) or None) as parts:
+            for job, part_num, etag, nbytes, seconds, frame in parts:
+                upload = uploads[job]
+                if upload.part_done(part_num, etag, frame):
+                    # Finalize
+                    upload.finish(verify)
+                    if index is not None:
+                        upload.record(index)
+                    if len(uploads) > 1:
+                        logger.info("Finished uploading %s" % upload.fname)
+                parts.record(nbytes, seconds)
+        # Finalize resumed uploads that had no parts left to send, and
+        # streams whose end was only read after their last part finished
+        for upload in uploads:
+            if not upload.finished:
+                upload.finish(verify)
+                if index is not None:
+                    upload.record(index)
+        parts.finish("uploading", sum(u.size for u in uploads))
+    except Exception:
+        if not future.cancelled():
+            logger.error("Encountered an error, canceling upload")
+        for upload in uploads:
+            if not upload.finished:
+                upload.abort()
+        raise
+    finally:
+        # Keep the files that did finish, even if others failed
+        if index is not None:
+            index.save()
+    return uploads
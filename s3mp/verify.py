@@ -0,0 +1,148 @@
+"""
+End-to-end integrity checks for --verify
+
+S3 reports the ETag of an object uploaded with a single PUT as the MD5 of
+its data. For a MultiPartUpload, the ETag is the MD5 of the concatenated
+binary MD5s of the parts, followed by "-" and the number of parts. So a
+transfer can be checked against the ETag from per-part MD5s, provided the
+parts are hashed with the same boundaries they were uploaded with.
+
+The part MD5s are computed by the workers, which have the part's bytes
+anyway. hashlib releases the GIL while hashing large buffers, so workers
+hash in parallel with every engine, and the parent only combines the
+digests.
+"""
+import base64
+import hashlib
+import re
+
+# Read this much at a time when hashing a file. boto's compute_md5 reads
+# 8K at a time, which costs more in Python overhead than in hashing.
+HASH_BUFFER = 1024*1024
+
+MULTIPART_ETAG = re.compile(r'^([0-9a-fA-F]{32})-(\d+)$')
+
+class IntegrityError(Exception):
+    """
+    Raised when a transfer doesn't match the ETag S3 has for it
+    """
+
+def md5_data(data):
+    """
+    Return the (hex, base64) MD5 digests of a string, in the form boto's md5
+    arguments take
+    """
+    digest = hashlib.md5(data).digest()
+    return (digest.encode("hex"), base64.b64encode(digest))
+
+def md5_file(fp, size):
+    """
+    Return the (hex, base64) MD5 digests of the next size bytes of fp
+
+    Like boto.utils.compute_md5, fp is left where it started.
+    """
+    start = fp.tell()
+    md5 = hashlib.md5()
+    remaining = size
+    while remaining > 0:
+        data = fp.read(min(HASH_BUFFER, remaining))
+        if not data:
+            break
+        md5.update(data)
+        remaining -= len(data)
+    fp.seek(start)
+    if remaining > 0:
+        raise IOError("Expected %d bytes to hash, found %d" % (size, size - remaining))
+    digest = md5.digest()
+    return (digest.encode("hex"), base64.b64encode(digest))
+
+def md5_file_range(fname, start, size):
+    """
+    Return the hex MD5 of size bytes of the named file, from start
+    """
+    fp = open(fname, 'rb')
+    try:
+        fp.seek(start)
+        return md5_file(fp, size)[0]
+    finally:
+        fp.close()
+
+def composite_etag(part_digests):
+    """
+    Return the ETag S3 gives a MultiPartUpload with parts of these MD5s
+
+    :type part_digests: list of strings
+    :param part_digests: The hex MD5 (or ETag) of every part, in order
+    """
+    md5 = hashlib.md5()
+    for digest in part_digests:
+        md5.update(digest.strip('"').decode("hex"))
+    return "%s-%d" % (md5.hexdigest(), len(part_digests))
+
+def parse_etag(etag):
+    """
+    Split an ETag into its hex digest and number of parts
+
+    :rtype: tuple of (string, int)
+    :returns: The digest and the number of parts, which is None if the
+              ETag is the MD5 of the whole object
+    """
+    etag = etag.strip('"').lower()
+    m = MULTIPART_ETAG.match(etag)
+    if m is not None:
+        return m.group(1), int(m.group(2))
+    return etag, None
+
+def part_ranges(size, part_size, num_parts):
+    """
+    Return the (first byte, last byte) of each part of an uploaded object
+
+    All parts but the last are part_size bytes, the last one is whatever is
+    left (which may be more than part_size, as s3-mp-upload folds a small
+    tail into the last part). Returns None if the object can't have been
+    uploaded as num_parts parts of part_size.
+    """
+    last_start = part_size * (num_parts - 1)
+    if part_size <= 0 or last_start >= size:
+        return None
+    ranges = [(part_size*i, part_size*(i+1) - 1) for i in range(num_parts - 1)]
+    ranges.append((last_start, size - 1))
+    return ranges
+
+def first_part_size(conn, bucket_name, key_name):
+    """
+    Ask S3 for the size of part 1 of a MultiPartUpload-ed object
+    """
+    resp = conn.make_request("HEAD", bucket=bucket_name, key=key_name,
+            query_args="partNumber=1")
+    resp.read()
+    if resp.status not in (200, 206):
+        raise IntegrityError("Couldn't find the part size of s3://%s/%s (HTTP %d)" %
+                (bucket_name, key_name, resp.status))
+    return int(resp.getheader("content-length"))
+
+def check_etag(name, etag, expected):
+    """
+    Raise IntegrityError unless etag matches the expected one
+    """
+    if etag.strip('"').lower() != expected.strip('"').lower():
+        raise IntegrityError("%s failed verification: S3 has ETag %s, expected %s" %
+                (name, etag.strip('"'), expected.strip('"')))
+
+def object_part_ranges(key):
+    """
+    Return the byte ranges a boto Key was uploaded in
+
+    :rtype: list of tuples
+    :returns: The (first byte, last byte) of every part, or None if the
+              object was uploaded with a single PUT
+    """
+    digest, num_parts = parse_etag(key.etag)
+    if num_parts is None:
+        return None
+    part_size = first_part_size(key.bucket.connection, key.bucket.name, key.name)
+    ranges = part_ranges(key.size, part_size, num_parts)
+    if ranges is None:
+        raise IntegrityError("s3://%s/%s can't be %d parts of %d bytes, as its ETag %s says" %
+                (key.bucket.name, key.name, num_parts, part_size, key.etag.strip('"')))
+    return ranges
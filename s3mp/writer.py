@@ -0,0 +1,201 @@
+"""
+Writing downloaded ranges into the destination file
+
+Workers write their ranges into one file at scattered offsets. Left to
+itself, the file grows sparsely as the ranges land, which fragments it
+badly on XFS and ext4 with many workers, so preallocate() reserves the
+whole size up front.
+
+A RangeWriter writes one range. With direct set, the data bypasses the
+page cache, so a very large download doesn't evict everything else on the
+host: it's gathered into a page-aligned buffer (one per worker, reused for
+every range it writes) and written with O_DIRECT. O_DIRECT needs the file
+offset and length aligned too, so the unaligned head and tail of a range
+are written through the page cache and then dropped from it. On a
+filesystem without O_DIRECT (such as tmpfs), everything goes through the
+page cache and is synced and dropped as it's written instead.
+
+The system calls Python 2 doesn't have are made through ctypes where the
+C library provides them, and skipped (or emulated) otherwise.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import mmap
+import os
+
+from s3mp.engine import worker_state
+
+logger = logging.getLogger("s3mp.writer")
+
+# O_DIRECT offsets, lengths and buffers must be multiples of this
+ALIGNMENT = 4096
+
+# Size of each worker's aligned buffer
+BUFFER_SIZE = 4*1024*1024
+
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_libc = None
+
+def _libc_function(name, *argtypes):
+    """
+    Return a function from the C library, or None if it doesn't have it
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.argtypes = argtypes
+        func.restype = ctypes.c_int
+    return func
+
+def preallocate(fd, size):
+    """
+    Allocate size bytes for a file, so it isn't built up from holes
+
+    Falls back to just setting the size where posix_fallocate isn't
+    available or the filesystem doesn't support it.
+    """
+    fallocate = _libc_function("posix_fallocate64", ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    if fallocate is not None and size > 0:
+        # Returns the error rather than setting errno
+        err = fallocate(fd, 0, size)
+        if err == 0:
+            return
+        if err not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err))
+        logger.debug("posix_fallocate not supported (%s), truncating instead" % os.strerror(err))
+    os.ftruncate(fd, size)
+
+def drop_cache(fd, offset, length):
+    """
+    Write a byte range of a file to disk and drop it from the page cache
+
+    Dirty pages can't be dropped, so the range is synced first.
+    """
+    if length <= 0:
+        return
+    sync_range = _libc_function("sync_file_range", ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+            ctypes.c_uint)
+    if sync_range is None or sync_range(fd, offset, length, SYNC_FILE_RANGE_WAIT_BEFORE |
+            SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER) != 0:
+        os.fdatasync(fd)
+    fadvise = _libc_function("posix_fadvise64", ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+            ctypes.c_int)
+    if fadvise is not None:
+        fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+def worker_buffer():
+    """
+    Return this worker's page-aligned buffer of BUFFER_SIZE bytes
+    """
+    state = worker_state()
+    buf = getattr(state, "write_buffer", None)
+    if buf is None:
+        # Anonymous maps are page aligned
+        buf = state.write_buffer = mmap.mmap(-1, BUFFER_SIZE)
+    return buf
+
+class RangeWriter(object):
+    """
+    Write a range of a file from a series of strings
+
+    :type fname: string
+    :param fname: The file, which must exist
+
+    :type offset: int
+    :param offset: Where in the file the first byte goes
+
+    :type direct: bool
+    :param direct: Keep the data out of the page cache
+    """
+
+    def __init__(self, fname, offset, direct=False):
+        self.fd = os.open(fname, os.O_WRONLY)
+        self.offset = offset
+        # Start of what hasn't been dropped from the page cache yet
+        self.dropped = offset
+        self.direct_fd = None
+        self.drop = direct
+        if direct and hasattr(os, "O_DIRECT"):
+            try:
+                self.direct_fd = os.open(fname, os.O_WRONLY | os.O_DIRECT)
+            except OSError, err:
+                if err.errno != errno.EINVAL:
+                    os.close(self.fd)
+                    raise
+                logger.debug("%s doesn't support O_DIRECT, dropping pages from the cache instead" % fname)
+        if self.direct_fd is not None:
+            self.buffer = worker_buffer()
+            # File offset of the start of the buffer, and bytes in it
+            self.buffer_offset = None
+            self.filled = 0
+
+    def _write_cached(self, data):
+        # Through the page cache, at self.offset
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        written = 0
+        while written < len(data):
+            written += os.write(self.fd, buffer(data, written))
+        self.offset += len(data)
+
+    def _flush_buffer(self, length):
+        # Write the first length bytes of the buffer, a multiple of ALIGNMENT
+        os.lseek(self.direct_fd, self.buffer_offset, os.SEEK_SET)
+        written = 0
+        while written < length:
+            written += os.write(self.direct_fd, buffer(self.buffer, written, length - written))
+
+    def write(self, data):
+        if self.direct_fd is None:
+            self._write_cached(data)
+            if self.drop and self.offset - self.dropped >= BUFFER_SIZE:
+                drop_cache(self.fd, self.dropped, self.offset - self.dropped)
+                self.dropped = self.offset
+            return
+        pos = 0
+        if self.buffer_offset is None:
+            # Reach an aligned offset before buffering
+            head = min(len(data), -self.offset % ALIGNMENT)
+            if head:
+                self._write_cached(data[:head])
+                pos = head
+            if pos == len(data):
+                return
+            self.buffer_offset = self.offset
+        while pos < len(data):
+            n = min(len(data) - pos, BUFFER_SIZE - self.filled)
+            self.buffer[self.filled:self.filled + n] = data[pos:pos + n]
+            self.filled += n
+            pos += n
+            if self.filled == BUFFER_SIZE:
+                self._flush_buffer(BUFFER_SIZE)
+                self.buffer_offset += BUFFER_SIZE
+                self.filled = 0
+        self.offset = self.buffer_offset + self.filled
+
+    def close(self):
+        """
+        Write out anything still buffered, and close the file
+        """
+        try:
+            if self.direct_fd is not None and self.buffer_offset is not None:
+                aligned = self.filled - self.filled % ALIGNMENT
+                if aligned:
+                    self._flush_buffer(aligned)
+                # The unaligned tail goes through the page cache
+                self.offset = self.buffer_offset + aligned
+                self._write_cached(self.buffer[aligned:self.filled])
+                self.filled = 0
+            if self.drop:
+                drop_cache(self.fd, self.dropped, self.offset - self.dropped)
+        finally:
+            os.close(self.fd)
+            if self.direct_fd is not None:
+                os.close(self.direct_fd)
@@ -0,0 +1,91 @@
+"""
+The fake S3 from bench/fakes3.py, for the tests to run against
+
+One server is started, on first use, for the whole run, and boto's config
+is pointed at it. The tools talk to it over HTTP, so anything that makes
+its own connection needs secure=False (or --insecure).
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(0, ROOT)
+
+import boto
+
+from fakes3 import FakeS3Server
+
+from s3mp import TransferManager
+
+BUCKET = "test"
+
+# What a test's TransferManager is made with, short of its manager_options
+MANAGER_OPTIONS = {"num_processes": 4, "engine": "thread", "secure": False}
+
+_server = None
+
+def fake_s3():
+    """
+    Return the FakeS3Server, starting it the first time
+    """
+    global _server
+    if _server is None:
+        _server = FakeS3Server().start()
+        fd, path = tempfile.mkstemp(prefix="s3mp-test-", suffix=".cfg")
+        os.write(fd, _server.boto_config())
+        os.close(fd)
+        # boto reads its config when it's imported, and the connection code
+        # holds on to that object, so load the fake's settings into it
+        os.environ["BOTO_CONFIG"] = path
+        boto.config.load_from_path(path)
+    return _server
+
+class FakeS3TestCase(unittest.TestCase):
+    """
+    A test with an empty bucket, BUCKET, on the fake S3, and a scratch
+    directory, self.tmp, that are cleared before every test, and a
+    TransferManager, self.manager, that is shut down after it
+    """
+
+    #: Options for self.manager that differ from MANAGER_OPTIONS
+    manager_options = {}
+
+    def setUp(self):
+        self.server = fake_s3()
+        self.store = self.server.store
+        self.store.buckets[BUCKET] = {}
+        self.store.uploads.clear()
+        self.server.fail_hook = None
+        self.store.reset_counts()
+        self.tmp = tempfile.mkdtemp(prefix="s3mp-test-")
+        self.manager = None
+        self.make_manager(**self.manager_options)
+
+    def tearDown(self):
+        self.shutdown_manager()
+        self.server.fail_hook = None
+        for name in os.listdir(self.tmp):
+            os.remove(os.path.join(self.tmp, name))
+        os.rmdir(self.tmp)
+
+    def url(self, key_name):
+        return "s3://%s/%s" % (BUCKET, key_name)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def make_manager(self, **options):
+        """
+        Replace self.manager with one made with the given options
+        """
+        self.shutdown_manager()
+        self.manager = TransferManager(**dict(MANAGER_OPTIONS, **options))
+        return self.manager
+
+    def shutdown_manager(self, wait=True):
+        if self.manager is not None:
+            self.manager.shutdown(wait)
+            self.manager = None
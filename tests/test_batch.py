@@ -0,0 +1,47 @@
+import unittest
+import urlparse
+
+from fake import BUCKET, FakeS3TestCase
+
+from s3mp.batch import list_keys
+from s3mp.connection import connect
+
+class ListKeysTest(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        for name in ("a/1", "a/2", "a/x/3", "b/1", "top", "z/1", "z/2", "z/3"):
+            self.store.put_object(BUCKET, name, name)
+        self.bucket = connect().get_bucket(BUCKET, validate=False)
+        self.listings = []
+        self.server.fail_hook = self.record_listing
+
+    def record_listing(self, method, path):
+        query = urlparse.parse_qs(urlparse.urlsplit(path).query, keep_blank_values=True)
+        if method == "GET" and urlparse.urlsplit(path).path.strip("/") == BUCKET:
+            self.listings.append(query.get("prefix", [""])[0])
+
+    def test_listed_per_top_level_prefix(self):
+        keys = list_keys(self.bucket, ["a/1", "a/x/3", "a/missing", "b/1", "top", "missing"])
+        self.assertEqual(sorted(keys), ["a/1", "a/x/3", "b/1", "top"])
+        self.assertEqual(keys["a/x/3"].size, len("a/x/3"))
+        # The bucket is never listed as a whole, and no key gets a HEAD
+        self.assertEqual(sorted(self.listings), ["", "a/", "b/1"])
+        self.assertEqual(self.store.reset_counts().get("HEAD"), None)
+
+    def test_keys_at_the_top(self):
+        for i in range(5):
+            self.store.put_object(BUCKET, "file%d" % i, "x")
+        keys = list_keys(self.bucket, ["file%d" % i for i in range(5)] + ["missing"])
+        self.assertEqual(sorted(keys), ["file%d" % i for i in range(5)])
+        self.assertEqual(self.listings, [""])
+        self.assertEqual(self.store.reset_counts().get("HEAD"), None)
+
+    def test_one_key(self):
+        self.assertEqual(list(list_keys(self.bucket, ["z/2"])), ["z/2"])
+        self.assertEqual(list_keys(self.bucket, ["z/4"]), {})
+        self.assertEqual(self.listings, ["z/2", "z/4"])
+        self.assertEqual(self.store.reset_counts().get("HEAD"), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import datetime
+import imp
+import os
+import sys
+import unittest
+import uuid
+from cStringIO import StringIO
+
+from fake import BUCKET, ROOT, FakeS3TestCase
+
+from s3mp.journal import upload_journal_path
+from s3mp.tuning import MB
+
+cleanup = imp.load_source("s3_mp_cleanup", os.path.join(ROOT, "s3-mp-cleanup.py"))
+
+class CleanupTestCase(FakeS3TestCase):
+
+    def run_cleanup(self, func, *args, **kwargs):
+        """
+        Call one of s3-mp-cleanup's functions, returning what it printed
+        """
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            func(*args, **kwargs)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+class CleanupJournalsTest(CleanupTestCase):
+
+    manager_options = {"max_tries": 1}
+
+    def setUp(self):
+        CleanupTestCase.setUp(self)
+        self.fname = self.path("src")
+        fp = open(self.fname, "wb")
+        fp.write(os.urandom(16*MB))
+        fp.close()
+        # Upload all but the last part, leaving a journal and an open upload
+        self.server.fail_hook = lambda method, path: "partNumber=3" in path and 500 or None
+        try:
+            future = self.manager.upload(self.fname, self.url("obj"), split=5, resume=True)
+            self.assertRaises(Exception, future.result)
+        finally:
+            self.server.fail_hook = None
+        self.journal = upload_journal_path(self.fname)
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertEqual(len(self.store.uploads), 1)
+
+    def test_list_journals(self):
+        out = self.run_cleanup(cleanup.cleanup_journals, self.tmp, False)
+        self.assertTrue(out.startswith(self.journal + "  # "))
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertEqual(len(self.store.uploads), 1)
+
+    def test_clear_journals_cancels_their_uploads(self):
+        self.run_cleanup(cleanup.cleanup_journals, self.tmp, True)
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(self.store.uploads, {})
+
+    def test_clear_journal_of_a_finished_upload(self):
+        self.store.uploads.clear()
+        self.run_cleanup(cleanup.cleanup_journals, self.tmp, True)
+        self.assertFalse(os.path.exists(self.journal))
+
+class CleanupUploadsTest(CleanupTestCase):
+
+    def add_upload(self, key_name, part_sizes=()):
+        upload_id = uuid.uuid4().hex
+        parts = dict((n + 1, ("x" * size, "etag")) for n, size in enumerate(part_sizes))
+        self.store.uploads[upload_id] = {"bucket": BUCKET, "key": key_name, "parts": parts, "meta": {},
+                "content_type": "application/octet-stream", "storage_class": "STANDARD",
+                "initiated": "2015-01-01T00:00:00.000Z"}
+        return upload_id
+
+    def cleanup(self, uri, cancel=None, **options):
+        options.setdefault("num_processes", 4)
+        return self.run_cleanup(cleanup.main, uri, cancel, **options).splitlines()
+
+    def test_list_with_sizes(self):
+        upload_id = self.add_upload("a/1", [1024, 1024, 512])
+        self.add_upload("a/2")
+        self.add_upload("b/1", [100])
+        lines = self.cleanup(self.url("a/"), sizes=True)
+        self.assertEqual(len(lines), 3)
+        self.assertTrue("s3-mp-cleanup.py s3://test/a/1 -c %s  # fake 2015-01-01T00:00:00.000Z, "
+                "3 parts, 2.50K" % upload_id in lines)
+        self.assertEqual(lines[-1], "# 2 uploads holding 3 parts, 2.50K")
+        self.assertEqual(len(self.store.uploads), 3)
+
+    def test_older_than(self):
+        self.add_upload("a/1")
+        lines = self.cleanup(self.url(""), older_than=cleanup.age("1d"))
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[-1], "# 1 uploads")
+        age = datetime.datetime.utcnow() - datetime.datetime(2014, 12, 1)
+        lines = self.cleanup(self.url(""), older_than=age)
+        self.assertEqual(lines, ["# 0 uploads"])
+
+    def test_dry_run(self):
+        self.add_upload("a/1")
+        lines = self.cleanup(self.url(""), cancel_all=True, dry_run=True)
+        self.assertEqual(lines[-1], "# Would cancel 1 uploads")
+        self.assertEqual(len(self.store.uploads), 1)
+
+    def test_cancel_all_over_several_pages(self):
+        for i in range(1005):
+            self.add_upload("k/%04d" % i)
+        self.add_upload("other")
+        lines = self.cleanup(self.url("k/"), cancel_all=True, num_processes=8)
+        self.assertEqual(len(lines), 1006)
+        self.assertEqual(lines[-1], "# Cancelled 1005 uploads (0 were already gone)")
+        self.assertEqual([u["key"] for u in self.store.uploads.values()], ["other"])
+
+    def test_cancel_one(self):
+        upload_id = self.add_upload("a/1")
+        self.add_upload("a/2")
+        self.cleanup(self.url("a/"), upload_id)
+        self.assertFalse(upload_id in self.store.uploads)
+        self.assertEqual(len(self.store.uploads), 1)
+        self.assertRaises(SystemExit, self.cleanup, self.url("a/"), upload_id)
+
+    def test_age(self):
+        self.assertEqual(cleanup.age("90m"), datetime.timedelta(minutes=90))
+        self.assertEqual(cleanup.age("1.5d"), datetime.timedelta(hours=36))
+        self.assertRaises(Exception, cleanup.age, "7 days")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import gzip
+import os
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from fake import FakeS3TestCase
+
+from s3mp.compress import (INDEX_END, INDEX_LENGTH_DIGITS, INDEX_READ, MAX_COMPRESS_PART_SIZE, GzipCodec,
+        choose_compressed_part_size, compress_part, get_codec, index_frame, read_index)
+from s3mp.connection import connect
+from s3mp.tuning import MB
+
+def gunzip(data):
+    """
+    Decompress every member of a gzip stream, as gunzip does
+    """
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+def temp_file(data):
+    fd, fname = tempfile.mkstemp(prefix="s3mp-test-")
+    os.write(fd, data)
+    os.close(fd)
+    return fname
+
+class CodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = GzipCodec()
+
+    def test_get_codec(self):
+        self.assertEqual(get_codec("gzip").name, "gzip")
+        self.assertRaises(ValueError, get_codec, "lzma")
+
+    def test_round_trip(self):
+        data = os.urandom(1000) + "a" * 100000
+        self.assertEqual(self.codec.decompress(self.codec.compress(data)), data)
+
+    def test_padding_is_skipped(self):
+        data = "a" * 100000
+        part, frame_length = compress_part(self.codec, data, 5000)
+        self.assertEqual(len(part), 5000)
+        self.assertEqual(part[:frame_length], self.codec.compress(data))
+        self.assertEqual(gunzip(part), data)
+
+    def test_no_padding_needed(self):
+        data = os.urandom(10000)
+        part, frame_length = compress_part(self.codec, data, 5000)
+        self.assertEqual(len(part), frame_length)
+
+    def test_index_frame(self):
+        parts = [(100, 90, 1000), (50, 50, 400)]
+        frame = index_frame(self.codec, parts)
+        self.assertTrue(frame.endswith(INDEX_END))
+        digits = frame[-len(INDEX_END) - INDEX_LENGTH_DIGITS:-len(INDEX_END)]
+        self.assertEqual(int(digits), len(frame))
+        # Parts and index together still decompress to the parts' data
+        first, _ = compress_part(self.codec, "x" * 1000, 0)
+        second, _ = compress_part(self.codec, "y" * 400, 0)
+        self.assertEqual(gunzip(first + second + frame), "x" * 1000 + "y" * 400)
+
+    def test_part_size_for_a_compressible_file(self):
+        fname = temp_file("\0" * (2*MB))
+        try:
+            self.assertEqual(choose_compressed_part_size(self.codec, fname, 2*MB, 5*MB),
+                    MAX_COMPRESS_PART_SIZE)
+        finally:
+            os.remove(fname)
+
+    def test_part_size_for_an_incompressible_file(self):
+        fname = temp_file(os.urandom(2*MB))
+        try:
+            # 5M, with a margin, over the ratio of about 1
+            self.assertEqual(choose_compressed_part_size(self.codec, fname, 2*MB, 5*MB), 8*MB)
+        finally:
+            os.remove(fname)
+
+class CompressedTransferTest(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.bucket = connect().get_bucket("test", validate=False)
+
+    def test_upload_and_download(self):
+        # Incompressible, so 8M parts
+        data = os.urandom(20*MB)
+        src = self.path("src")
+        open(src, "wb").write(data)
+        self.manager.upload(src, self.url("obj.gz"), split=5, compress="gzip", verify=True).result()
+        stored = self.store.buckets["test"]["obj.gz"]["data"]
+        self.assertEqual(gunzip(stored), data)
+
+        index = read_index(self.bucket.get_key("obj.gz"))
+        self.assertEqual(index.codec.name, "gzip")
+        self.assertEqual(index.size, len(data))
+        # The last 4M is folded into the part before it
+        self.assertEqual([p[4] for p in index.parts], [8*MB, 12*MB])
+        self.assertEqual(index.index_range[1], len(stored) - 1)
+
+        self.manager.download(self.url("obj.gz"), self.path("dest"), decompress=True, verify=True).result()
+        self.assertEqual(open(self.path("dest"), "rb").read(), data)
+
+    def test_object_without_an_index(self):
+        self.store.put_object("test", "plain", "plain data" * 100)
+        self.assertEqual(read_index(self.bucket.get_key("plain")), None)
+        self.store.put_object("test", "tiny", "x")
+        self.assertEqual(read_index(self.bucket.get_key("tiny")), None)
+
+    def test_index_longer_than_the_first_read(self):
+        parts = [(10, 10, 100)] * 8000
+        frame = index_frame(GzipCodec(), parts)
+        self.assertTrue(len(frame) > INDEX_READ)
+        self.store.put_object("test", "obj.gz", "z" * 80000 + frame)
+        index = read_index(self.bucket.get_key("obj.gz"))
+        self.assertEqual(len(index.parts), 8000)
+        self.assertEqual(index.size, 800000)
+        self.assertEqual(index.parts[-1][:2], (79990, 10))
+
+if __name__ == "__main__":
+    unittest.main()
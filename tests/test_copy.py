@@ -0,0 +1,57 @@
+import os
+import unittest
+from cStringIO import StringIO
+
+from fake import FakeS3TestCase
+
+from s3mp.verify import IntegrityError
+
+class CopyTest(FakeS3TestCase):
+
+    def test_verified_copy(self):
+        self.store.put_object("test", "src", "x" * 100)
+        copies = self.manager.copy(self.url("src"), self.url("copy"), verify=True).result()
+        self.assertEqual(copies[0].etag.strip('"'), self.store.buckets["test"]["src"]["etag"])
+
+    def test_verified_copy_of_an_object_uploaded_in_parts(self):
+        data = os.urandom(12*1024*1024)
+        self.manager.upload(StringIO(data), self.url("src"), split=5).result()
+        copies = self.manager.copy(self.url("src"), self.url("copy"), split=50, verify=True).result()
+        # Copied in the source's three parts, though it's smaller than --split
+        self.assertEqual(copies[0].etag.strip('"'), self.store.buckets["test"]["src"]["etag"])
+        self.assertEqual(self.store.buckets["test"]["copy"]["data"], data)
+
+    def test_etag_mismatch(self):
+        self.store.put_object("test", "src", "x" * 100)
+        # The source is replaced between its HEAD and the copy
+        def replace_source(method, path):
+            if method == "PUT" and path.startswith("/test/copy"):
+                self.store.put_object("test", "src", "y" * 100)
+        self.server.fail_hook = replace_source
+        future = self.manager.copy(self.url("src"), self.url("copy"), verify=True)
+        self.assertRaises(IntegrityError, future.result)
+
+    def test_streamed_copy_of_an_empty_object(self):
+        self.store.put_object("test", "empty", "")
+        copies = self.manager.copy(self.url("empty"), self.url("copy"), stream=True, verify=True).result()
+        self.assertTrue(copies[0].finished)
+        self.assertEqual(self.store.buckets["test"]["copy"]["data"], "")
+        self.assertEqual(copies[0].etag.strip('"'), self.store.buckets["test"]["empty"]["etag"])
+
+    def test_streamed_copy_of_an_empty_object_keeps_its_storage_class(self):
+        self.store.put_object("test", "empty", "")
+        self.store.buckets["test"]["empty"]["storage_class"] = "STANDARD_IA"
+        self.manager.copy(self.url("empty"), self.url("copy"), stream=True).result()
+        self.assertEqual(self.store.buckets["test"]["copy"]["storage_class"], "STANDARD_IA")
+        self.manager.copy(self.url("empty"), self.url("rrs"), stream=True, reduced_redundancy=True).result()
+        self.assertEqual(self.store.buckets["test"]["rrs"]["storage_class"], "REDUCED_REDUNDANCY")
+
+    def test_streamed_copy(self):
+        data = "x" * (6*1024*1024)
+        self.store.put_object("test", "src", data)
+        copies = self.manager.copy(self.url("src"), self.url("copy"), stream=True, split=5, verify=True).result()
+        self.assertTrue(copies[0].finished)
+        self.assertEqual(self.store.buckets["test"]["copy"]["data"], data)
+
+if __name__ == "__main__":
+    unittest.main()
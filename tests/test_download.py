@@ -0,0 +1,216 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+from fake import FakeS3TestCase
+
+import fakes3
+
+from s3mp.download import parse_range, resolve_ranges, split_ranges
+from s3mp.journal import DownloadJournal, download_journal_path
+from s3mp.tuning import MB
+
+class FailingGets(object):
+    """
+    A fail_hook that fails the GETs of an object with the given numbers,
+    counting from 1
+    """
+
+    def __init__(self, key_name, numbers, status=500):
+        self.key_name = key_name
+        self.numbers = numbers
+        self.status = status
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, method, path):
+        if method != "GET" or not path.split("?")[0].endswith("/" + self.key_name):
+            return None
+        self.lock.acquire()
+        try:
+            self.count += 1
+            return self.count in self.numbers and self.status or None
+        finally:
+            self.lock.release()
+
+class SlowFirstRange(object):
+    """
+    Hold up the fake's GETs of the first byte range of an object for delay
+    seconds, counting the GETs of other ranges that start meanwhile
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.count = 0
+        self.started_meanwhile = None
+        self.lock = threading.Lock()
+        self.do_GET = fakes3.Handler.do_GET
+        slow = self
+        def do_GET(handler):
+            slow.get(handler)
+        fakes3.Handler.do_GET = do_GET
+
+    def get(self, handler):
+        if (handler.headers.get("Range") or "").startswith("bytes=0-"):
+            before = self.count
+            time.sleep(self.delay)
+            self.started_meanwhile = self.count - before
+        else:
+            self.lock.acquire()
+            try:
+                self.count += 1
+            finally:
+                self.lock.release()
+        self.do_GET(handler)
+
+    def remove(self):
+        fakes3.Handler.do_GET = self.do_GET
+
+class DownloadTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.data = os.urandom(4*MB + 1234)
+        self.store.put_object("test", "obj", self.data)
+        self.dest = self.path("dest")
+
+    def download(self, dest=None, num_processes=None, max_tries=None, **options):
+        if num_processes or max_tries:
+            self.make_manager(num_processes=num_processes or 4, max_tries=max_tries or 5)
+        return self.manager.download(self.url("obj"), dest or self.dest, **options).result()
+
+    def contents(self):
+        return open(self.dest, "rb").read()
+
+class DownloadTest(DownloadTestCase):
+
+    def test_download_and_verify(self):
+        downloads = self.download(split=1, verify=True)
+        self.assertTrue(downloads[0].finished)
+        self.assertEqual(self.contents(), self.data)
+        self.assertEqual(self.store.reset_counts().get("GET"), 5)
+
+    def test_existing_file(self):
+        open(self.dest, "wb").write("old")
+        self.assertRaises(ValueError, self.download)
+        self.download(force=True)
+        self.assertEqual(self.contents(), self.data)
+
+    def test_failed_range_is_retried(self):
+        self.server.fail_hook = FailingGets("obj", [2], 503)
+        self.download(split=1, max_tries=3)
+        self.assertEqual(self.contents(), self.data)
+        self.assertEqual(self.server.fail_hook.count, 6)
+
+    def test_resume_fetches_only_missing_ranges(self):
+        # One worker, so the ranges are fetched in order, and from the third on they fail
+        self.server.fail_hook = FailingGets("obj", range(3, 100))
+        self.assertRaises(Exception, self.download, split=1, resume=True, num_processes=1, max_tries=1)
+        journal = DownloadJournal.load(download_journal_path(self.dest))
+        self.assertEqual(len(journal.ranges) - len(journal.pending()), 2)
+
+        self.server.fail_hook = None
+        self.store.reset_counts()
+        self.download(split=1, resume=True, verify=True)
+        self.assertEqual(self.contents(), self.data)
+        self.assertEqual(self.store.reset_counts().get("GET"), 3)
+        self.assertFalse(os.path.exists(journal.path))
+
+    def test_resume_of_a_changed_object(self):
+        self.server.fail_hook = FailingGets("obj", range(3, 100))
+        self.assertRaises(Exception, self.download, split=1, resume=True, num_processes=1, max_tries=1)
+        self.server.fail_hook = None
+        self.store.put_object("test", "obj", os.urandom(len(self.data)))
+        self.assertRaises(ValueError, self.download, split=1, resume=True)
+
+class RangeDownloadTest(DownloadTestCase):
+
+    def test_single_range(self):
+        downloads = self.download(split=1, ranges=["1000-2500000"])
+        self.assertEqual(self.contents(), self.data[1000:2500001])
+        self.assertEqual(downloads[0].size, 2499001)
+        self.assertEqual(self.store.reset_counts().get("GET"), 3)
+
+    def test_several_ranges_in_order(self):
+        self.download(split=1, ranges=[(None, 100), (0, 9), (3*MB, 4*MB - 1)])
+        self.assertEqual(self.contents(), self.data[-100:] + self.data[:10] + self.data[3*MB:4*MB])
+
+    def test_ranges_to_a_stream(self):
+        fp = StringIO()
+        self.download(fp, split=1, ranges=["5-1500000", "-3"])
+        self.assertEqual(fp.getvalue(), self.data[5:1500001] + self.data[-3:])
+
+    def test_bad_ranges(self):
+        self.assertRaises(ValueError, self.download, ranges=["0-10", "5-20"])
+        self.assertRaises(ValueError, self.download, ranges=["%d-" % len(self.data)])
+        self.assertRaises(ValueError, self.download, ranges=["0-1"], verify=True)
+        self.assertRaises(ValueError, self.download, ranges=["0-1"], resume=True)
+
+class StreamDownloadTest(DownloadTestCase):
+
+    def setUp(self):
+        DownloadTestCase.setUp(self)
+        self.slow = None
+
+    def tearDown(self):
+        if self.slow is not None:
+            self.slow.remove()
+        # Don't wait on a transfer that hung
+        self.shutdown_manager(wait=False)
+        DownloadTestCase.tearDown(self)
+
+    def stream(self, timeout=30, **options):
+        fp = StringIO()
+        self.manager.download(self.url("obj"), fp, **options).result(timeout)
+        return fp.getvalue()
+
+    def test_stdout(self):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.manager.download(self.url("obj"), "-", split=1, verify=True).result(30)
+            data = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(data, self.data)
+        self.assertEqual(self.store.reset_counts().get("GET"), 5)
+
+    def test_ranges_finishing_out_of_order_are_written_in_order(self):
+        # While the first range is held up, the others finish and wait for it,
+        # and no more than max_buffers ranges are fetched or held at once
+        self.slow = SlowFirstRange(1)
+        self.assertEqual(self.stream(split=1, max_buffers=3), self.data)
+        self.assertTrue(self.slow.started_meanwhile <= 2)
+        self.assertEqual(self.slow.count, 4)
+
+    def test_slow_first_range_with_few_buffers(self):
+        self.slow = SlowFirstRange(1)
+        self.assertEqual(self.stream(split=1, max_buffers=1), self.data)
+        self.assertEqual(self.stream(split=1, max_buffers=3), self.data)
+
+class RangeHelpersTest(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("0-1023"), (0, 1023))
+        self.assertEqual(parse_range("1024-"), (1024, None))
+        self.assertEqual(parse_range("-10"), (None, 10))
+        for value in ("", "-", "x", "9-2", "-0", "1-2-3"):
+            self.assertRaises(ValueError, parse_range, value)
+
+    def test_resolve_ranges(self):
+        self.assertEqual(resolve_ranges(["0-9", "-5"], 100, "s3://b/k"), [(0, 9), (95, 99)])
+        # Cut short at the end of the object
+        self.assertEqual(resolve_ranges([(40, 100)], 50, "s3://b/k"), [(40, 49)])
+        self.assertEqual(resolve_ranges([(None, 100)], 50, "s3://b/k"), [(0, 49)])
+        self.assertRaises(ValueError, resolve_ranges, ["10-", "-5"], 100, "s3://b/k")
+        self.assertRaises(ValueError, resolve_ranges, [(50, None)], 50, "s3://b/k")
+        self.assertRaises(ValueError, resolve_ranges, [(None, 5)], 0, "s3://b/k")
+
+    def test_split_ranges(self):
+        self.assertEqual(list(split_ranges([(10, 29), (0, 4)], 8)),
+                [(10, 17, 0), (18, 25, 8), (26, 29, 16), (0, 4, 20)])
+
+if __name__ == "__main__":
+    unittest.main()
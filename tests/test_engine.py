@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from fake import ROOT, FakeS3TestCase
+
+from s3mp.engine import make_pool
+from s3mp.tuning import MB
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+class EngineTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.data = os.urandom(11*MB + 17)
+        open(self.path("src"), "wb").write(self.data)
+
+    def downloaded(self):
+        return open(self.path("dest"), "rb").read()
+
+class ProcessEngineTest(EngineTestCase):
+
+    manager_options = {"num_processes": 2, "engine": "process"}
+
+    def test_round_trip(self):
+        self.manager.upload(self.path("src"), self.url("obj"), split=5).result()
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], self.data)
+        self.manager.download(self.url("obj"), self.path("dest"), split=5).result()
+        self.assertEqual(self.downloaded(), self.data)
+
+@unittest.skipIf(gevent is None, "gevent isn't installed")
+class AsyncEngineTest(EngineTestCase):
+
+    def run_tool(self, name, *args):
+        # The tools have to patch with gevent before boto is imported, which
+        # has long since happened in this process
+        subprocess.check_call([sys.executable, os.path.join(ROOT, name),
+                "--insecure", "-e", "async", "-np", "4", "-s", "5"] + list(args))
+
+    def test_round_trip(self):
+        self.run_tool("s3-mp-upload.py", self.path("src"), self.url("obj"))
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], self.data)
+        self.run_tool("s3-mp-download.py", self.url("obj"), self.path("dest"))
+        self.assertEqual(self.downloaded(), self.data)
+
+    def test_refuses_without_patching(self):
+        self.assertRaises(ValueError, make_pool, "async", 2)
+
+if __name__ == "__main__":
+    unittest.main()
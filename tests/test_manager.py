@@ -0,0 +1,37 @@
+import os
+import time
+import unittest
+
+from fake import FakeS3TestCase
+
+from s3mp.tuning import MB
+
+class SharedPoolTest(FakeS3TestCase):
+
+    manager_options = {"num_processes": 2}
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.store.put_object("test", "big", os.urandom(32*MB))
+        self.store.put_object("test", "small", "x")
+        self.server.latency = 0.05
+
+    def tearDown(self):
+        self.server.latency = 0
+        FakeS3TestCase.tearDown(self)
+
+    def test_small_transfer_is_not_held_up_by_a_big_one(self):
+        big = self.manager.download(self.url("big"), self.path("big"), split=1)
+        # Wait for its parts to be going to the pool
+        while not self.store.requests.get("GET"):
+            time.sleep(0.01)
+        small = self.manager.download(self.url("small"), self.path("small"))
+        small.result()
+        # The big download's 32 parts take 0.8s at two at a time
+        self.assertFalse(big.done())
+        big.result()
+        self.assertEqual(os.path.getsize(self.path("big")), 32*MB)
+        self.assertEqual(open(self.path("small"), "rb").read(), "x")
+
+if __name__ == "__main__":
+    unittest.main()
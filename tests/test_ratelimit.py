@@ -0,0 +1,85 @@
+import time
+import unittest
+from cStringIO import StringIO
+
+from fake import FakeS3TestCase
+
+from s3mp.ratelimit import BLOCK_SIZE, BURST_SECONDS, RateLimiter, TokenBucket
+from s3mp.tuning import MB
+
+def timed(func, *args):
+    t0 = time.time()
+    func(*args)
+    return time.time() - t0
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(100)
+        self.assertEqual(bucket.burst, 100 * BURST_SECONDS)
+        # The saved-up burst is free, and anything more waits for the rate
+        self.assertTrue(timed(bucket.take, 25) < 0.05)
+        self.assertAlmostEqual(timed(bucket.take, 50), 0.5, delta=0.1)
+
+    def test_debt_is_paid_off_by_the_next_taker(self):
+        bucket = TokenBucket(100)
+        bucket.take(25)
+        bucket.take(20)
+        # Refilled while the first taker slept, but only to zero
+        self.assertAlmostEqual(timed(bucket.take, 10), 0.1, delta=0.05)
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_no_limits(self):
+        limiter = RateLimiter()
+        self.assertTrue(timed(lambda: [limiter.request() or limiter.transfer(MB) for _ in range(1000)]) < 0.5)
+        self.assertEqual(limiter.block_size, None)
+        fp = StringIO("data")
+        self.assertTrue(limiter.wrap(fp) is fp)
+
+    def test_requests_per_second(self):
+        limiter = RateLimiter(max_requests=20)
+        # Five requests of burst, then 20 a second
+        elapsed = timed(lambda: [limiter.request() for _ in range(15)])
+        self.assertAlmostEqual(elapsed, 0.5, delta=0.15)
+
+    def test_limited_reader(self):
+        limiter = RateLimiter(max_bandwidth=4*MB)
+        self.assertEqual(limiter.block_size, BLOCK_SIZE)
+        data = "x" * (3*MB)
+        fp = limiter.wrap(StringIO(data))
+        t0 = time.time()
+        chunks = []
+        while True:
+            chunk = fp.read(100000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        # 1M of burst, then 2M at 4M/s
+        self.assertAlmostEqual(time.time() - t0, 0.5, delta=0.15)
+        self.assertEqual("".join(chunks), data)
+
+class CopyBandwidthTest(FakeS3TestCase):
+
+    manager_options = {"num_processes": 2, "max_bandwidth": 8}
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.store.put_object("test", "src", "x" * (6*MB))
+        # 2M of burst, then 8M/s
+
+    def copy(self, **options):
+        t0 = time.time()
+        self.manager.copy(self.url("src"), self.url("dest"), split=5, **options).result()
+        self.assertEqual(self.store.buckets["test"]["dest"]["data"], "x" * (6*MB))
+        return time.time() - t0
+
+    def test_server_side_copy_is_not_charged_for_bytes(self):
+        self.assertTrue(self.copy() < 0.4)
+
+    def test_streamed_copy_is_charged_both_ways(self):
+        # 12M through the host
+        self.assertAlmostEqual(self.copy(stream=True), 1.25, delta=0.4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import unittest
+
+from fake import FakeS3TestCase
+
+from s3mp.tuning import MB
+
+class S3FileTest(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.data = os.urandom(8*MB + 1234)
+        self.store.put_object("test", "obj", self.data)
+
+    def open(self, **options):
+        fp = self.manager.open(self.url("obj"), **options)
+        self.store.reset_counts()
+        return fp
+
+    def gets(self):
+        return self.store.reset_counts().get("GET", 0)
+
+    def test_footer_fetches_one_block(self):
+        fp = self.open(block_size=MB)
+        fp.seek(-8, os.SEEK_END)
+        self.assertEqual(fp.read(8), self.data[-8:])
+        self.assertEqual(fp.tell(), len(self.data))
+        self.assertEqual(self.gets(), 1)
+        self.assertEqual(fp.read(8), "")
+
+    def test_sequential_read_fetches_every_block_once(self):
+        fp = self.open(block_size=MB, read_ahead=2, max_blocks=3)
+        chunks = []
+        while True:
+            chunk = fp.read(300000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual("".join(chunks), self.data)
+        self.assertEqual(self.gets(), 9)
+        self.assertEqual(len(fp.blocks), 3)
+
+    def test_cache_hits_and_lru_eviction(self):
+        fp = self.open(block_size=MB, read_ahead=0, max_blocks=2)
+        for offset in (0, MB, 0, 2*MB):
+            fp.seek(offset)
+            fp.read(10)
+        # Block 1 was the least recently used when block 2 came in
+        self.assertEqual(self.gets(), 3)
+        self.assertEqual(list(fp.blocks), [0, 2])
+        fp.seek(MB)
+        self.assertEqual(fp.read(10), self.data[MB:MB + 10])
+        self.assertEqual(self.gets(), 1)
+
+    def test_read_spanning_more_than_the_cache(self):
+        fp = self.open(block_size=MB, max_blocks=2)
+        fp.seek(4*MB)
+        self.assertEqual(fp.read(10), self.data[4*MB:4*MB + 10])
+        fp.seek(0)
+        self.assertEqual(fp.read(6*MB), self.data[:6*MB])
+        self.assertEqual(len(fp.blocks), 2)
+        self.assertEqual(fp.read(), self.data[6*MB:])
+
+    def test_seek_and_close(self):
+        fp = self.open(block_size=MB)
+        fp.seek(100)
+        fp.seek(-50, os.SEEK_CUR)
+        self.assertEqual(fp.tell(), 50)
+        self.assertRaises(IOError, fp.seek, -1)
+        self.assertEqual(fp.read(), self.data[50:])
+        fp.close()
+        self.assertRaises(ValueError, fp.read, 1)
+
+    def test_missing_object(self):
+        self.assertRaises(ValueError, self.manager.open, self.url("missing"))
+
+if __name__ == "__main__":
+    unittest.main()
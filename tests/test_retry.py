@@ -0,0 +1,38 @@
+import httplib
+import socket
+import unittest
+
+import fake
+
+from boto.exception import S3DataError, S3ResponseError
+
+from s3mp.retry import FATAL, THROTTLE, TRANSIENT, TransientError, classify
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_server_errors(self):
+        self.assertEqual(classify(S3ResponseError(503, "Slow Down")), THROTTLE)
+        self.assertEqual(classify(S3ResponseError(500, "Internal Server Error")), TRANSIENT)
+        self.assertEqual(classify(S3ResponseError(404, "Not Found")), FATAL)
+        self.assertEqual(classify(S3ResponseError(403, "Forbidden")), FATAL)
+
+    def test_error_codes(self):
+        def error(status, code):
+            body = "<Error><Code>%s</Code><Message></Message></Error>" % code
+            return S3ResponseError(status, "", body)
+        self.assertEqual(classify(error(400, "RequestTimeout")), TRANSIENT)
+        self.assertEqual(classify(error(400, "ExpiredToken")), FATAL)
+
+    def test_network_errors(self):
+        for err in (socket.error(104, "Connection reset by peer"), socket.timeout(),
+                httplib.IncompleteRead(""), S3DataError("ETag from S3 did not match computed MD5"),
+                TransientError("Range ended early")):
+            self.assertEqual(classify(err), TRANSIENT)
+
+    def test_anything_else_is_fatal(self):
+        for err in (IOError(2, "No such file or directory"), TypeError(), AttributeError(), KeyError(1),
+                ValueError()):
+            self.assertEqual(classify(err), FATAL)
+
+if __name__ == "__main__":
+    unittest.main()
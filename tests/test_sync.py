@@ -0,0 +1,45 @@
+import os
+import unittest
+
+from fake import FakeS3TestCase
+
+
+class SyncDownloadTest(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.manifest = self.path("manifest")
+        fp = open(self.manifest, "w")
+        for i in range(5):
+            self.store.put_object("test", "d/f%d" % i, os.urandom(1000 + i))
+            fp.write("%s %s\n" % (self.url("d/f%d" % i), self.path("f%d" % i)))
+        fp.close()
+        self.index = self.path("index")
+
+    def download(self):
+        downloads = self.manager.download(None, None, manifest=self.manifest, sync=self.index).result()
+        return downloads, self.store.reset_counts()
+
+    def test_manifest_is_listed_once(self):
+        downloads, counts = self.download()
+        self.assertEqual(len(downloads), 5)
+        for i in range(5):
+            self.assertEqual(open(self.path("f%d" % i), "rb").read(), self.store.buckets["test"]["d/f%d" % i]["data"])
+        # The bucket, then a listing and a GET per object
+        self.assertEqual(counts, {"HEAD": 1, "GET": 6})
+
+        downloads, counts = self.download()
+        self.assertEqual(downloads, [])
+        self.assertEqual(counts, {"HEAD": 1, "GET": 1})
+
+        self.store.put_object("test", "d/f3", "changed")
+        downloads, counts = self.download()
+        self.assertEqual([d.src for d in downloads], [self.url("d/f3")])
+        self.assertEqual(open(self.path("f3"), "rb").read(), "changed")
+
+    def test_missing_object(self):
+        del self.store.buckets["test"]["d/f2"]
+        self.assertRaises(ValueError, self.download)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import unittest
+
+import fake
+
+from s3mp.compress import MAX_COMPRESS_PART_SIZE, GzipCodec, choose_compressed_part_size
+from s3mp.tuning import AUTO_MAX_PART_SIZE, MAX_PART_SIZE, MAX_PARTS, MB, choose_part_size
+
+TB = 1024*1024*MB
+
+class ChoosePartSizeTest(unittest.TestCase):
+
+    def test_auto_scales_with_the_object(self):
+        self.assertEqual(choose_part_size(100*MB, 50, auto=True), 8*MB)
+        self.assertEqual(choose_part_size(50*1024*MB, 50, auto=True), 52*MB)
+        self.assertEqual(choose_part_size(300*1024*MB, 50, auto=True), AUTO_MAX_PART_SIZE)
+
+    def test_largest_objects_fit_in_max_parts(self):
+        for size in (int(4.9*TB), 5*TB):
+            for auto in (False, True):
+                part_size = choose_part_size(size, 50, auto)
+                self.assertTrue(part_size <= MAX_PART_SIZE)
+                self.assertTrue(part_size * MAX_PARTS >= size)
+        self.assertEqual(choose_part_size(5*TB, 50, auto=True), choose_part_size(5*TB, 50))
+
+    def test_too_large(self):
+        self.assertRaises(ValueError, choose_part_size, 6*MAX_PARTS*MAX_PART_SIZE, 50)
+
+class ChooseCompressedPartSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compress.tmp")
+        fp = open(self.fname, "wb")
+        fp.write(os.urandom(6*MB))
+        fp.close()
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_large_parts_are_lowered(self):
+        size = os.path.getsize(self.fname)
+        self.assertEqual(choose_compressed_part_size(GzipCodec(), self.fname, size, 1024*MB),
+                MAX_COMPRESS_PART_SIZE)
+
+    def test_part_limit_wins(self):
+        size = 5*TB
+        part_size = choose_compressed_part_size(GzipCodec(), self.fname, size, 1024*MB)
+        self.assertTrue(MAX_COMPRESS_PART_SIZE < part_size < 1024*MB)
+        self.assertTrue(part_size * (MAX_PARTS - 1) >= size)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,266 @@
+import os
+import sys
+import threading
+import unittest
+from cStringIO import StringIO
+
+from fake import FakeS3TestCase
+
+import fakes3
+
+from s3mp.journal import UploadJournal, upload_journal_path
+from s3mp.tuning import MB
+from s3mp.verify import IntegrityError
+
+class ResumeUploadTest(FakeS3TestCase):
+
+    manager_options = {"max_tries": 1}
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.fname = self.path("src")
+        self.write(os.urandom(16*MB))
+
+    def write(self, data):
+        fp = open(self.fname, "wb")
+        fp.write(data)
+        fp.close()
+        self.data = data
+
+    def upload(self):
+        return self.manager.upload(self.fname, self.url("obj"), split=5, resume=True).result()
+
+    def interrupted_upload(self):
+        """
+        Upload all but the last of the file's three parts, leaving a journal
+        """
+        self.server.fail_hook = lambda method, path: "partNumber=3" in path and 500 or None
+        self.assertRaises(Exception, self.upload)
+        self.server.fail_hook = None
+        journal = UploadJournal.load(upload_journal_path(self.fname))
+        self.assertEqual(sorted(journal.parts), [1, 2])
+        self.assertEqual(journal.mtime, os.stat(self.fname).st_mtime)
+        self.store.reset_counts()
+        return journal
+
+    def test_resume_sends_only_the_missing_parts(self):
+        journal = self.interrupted_upload()
+        self.upload()
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], self.data)
+        self.assertEqual(self.store.reset_counts().get("PUT"), 1)
+        self.assertFalse(os.path.exists(journal.path))
+        self.assertEqual(self.store.uploads, {})
+
+    def test_changed_file_starts_over(self):
+        journal = self.interrupted_upload()
+        # Same size, new contents
+        self.write(os.urandom(16*MB))
+        st = os.stat(self.fname)
+        os.utime(self.fname, (st.st_atime, st.st_mtime + 10))
+        self.upload()
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], self.data)
+        self.assertEqual(self.store.reset_counts().get("PUT"), 3)
+        self.assertFalse(os.path.exists(journal.path))
+        # The interrupted upload was aborted
+        self.assertEqual(self.store.uploads, {})
+
+class ResumeDirectoryTest(FakeS3TestCase):
+
+    manager_options = {"max_tries": 1}
+
+    def write(self, name, data):
+        fp = open(self.path(name), "wb")
+        fp.write(data)
+        fp.close()
+
+    def upload(self, **options):
+        return self.manager.upload(self.tmp + "/", self.url("d/"), split=5, resume=True, **options).result()
+
+    def keys(self):
+        return sorted(self.store.buckets["test"])
+
+    def test_resume_a_directory(self):
+        self.write("small", "x" * 100)
+        self.upload()
+        self.write("big", os.urandom(16*MB))
+        self.server.fail_hook = lambda method, path: "partNumber=3" in path and 500 or None
+        self.assertRaises(Exception, self.upload)
+        self.server.fail_hook = None
+        self.assertTrue(os.path.exists(upload_journal_path(self.path("big"))))
+        self.write("big.s3mp-upload.tmp", "left over")
+
+        self.store.reset_counts()
+        uploads = self.upload()
+        # Only the big file's last part is sent, and no journals
+        self.assertEqual([u.fname for u in uploads], [self.path("big")])
+        self.assertEqual(self.store.reset_counts().get("PUT"), 1)
+        self.assertEqual(self.keys(), ["d/big", "d/small"])
+        self.assertEqual(self.store.uploads, {})
+
+    def test_resume_over_a_different_object(self):
+        self.store.put_object("test", "d/small", "y")
+        self.write("small", "x" * 100)
+        self.assertRaises(ValueError, self.upload)
+        self.upload(force=True)
+        self.assertEqual(self.store.buckets["test"]["d/small"]["data"], "x" * 100)
+
+    def test_resume_over_an_object_of_the_same_size(self):
+        self.store.put_object("test", "d/small", "b" * 100)
+        self.write("small", "a" * 100)
+        self.assertRaises(ValueError, self.upload)
+        self.assertEqual(self.store.buckets["test"]["d/small"]["data"], "b" * 100)
+        self.upload(force=True)
+        self.assertEqual(self.store.buckets["test"]["d/small"]["data"], "a" * 100)
+
+class VerifyUploadTest(FakeS3TestCase):
+
+    manager_options = {"max_tries": 2}
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.fname = self.path("src")
+        self.data = os.urandom(12*MB)
+        fp = open(self.fname, "wb")
+        fp.write(self.data)
+        fp.close()
+        self.put_part = fakes3.Handler._put_part
+
+    def tearDown(self):
+        fakes3.Handler._put_part = self.put_part
+        FakeS3TestCase.tearDown(self)
+
+    def upload(self, **options):
+        return self.manager.upload(self.fname, self.url("obj"), split=5, verify=True, **options).result()
+
+    def corrupt_part(self, part_num, times):
+        """
+        Have the fake store a flipped byte in the given part, the given
+        number of times, as if it were damaged on the way
+        """
+        put_part, left = self.put_part, [times]
+        def corrupting_put_part(handler, query, body):
+            if query.get("partNumber") == str(part_num) and left[0]:
+                left[0] -= 1
+                body = chr(ord(body[0]) ^ 1) + body[1:]
+            return put_part(handler, query, body)
+        fakes3.Handler._put_part = corrupting_put_part
+
+    def test_verified_upload(self):
+        uploads = self.upload()
+        self.assertEqual(uploads[0].etag.strip('"'), self.store.buckets["test"]["obj"]["etag"])
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], self.data)
+        # Nothing but the parts and the upload's requests
+        self.assertEqual(self.store.reset_counts().get("PUT"), 2)
+
+    def test_empty_file(self):
+        open(self.fname, "wb").close()
+        uploads = self.upload()
+        self.assertEqual(uploads[0].size, 0)
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], "")
+
+    def test_damaged_part_is_sent_again(self):
+        self.corrupt_part(2, 1)
+        self.upload()
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], self.data)
+        self.assertEqual(self.store.reset_counts().get("PUT"), 3)
+
+    def test_damaged_part_fails_the_upload(self):
+        self.corrupt_part(2, 3)
+        self.assertRaises(Exception, self.upload)
+        self.assertFalse("obj" in self.store.buckets["test"])
+
+    def test_etag_mismatch(self):
+        # Change a part's ETag in the fake just before the upload is completed
+        def change_etag(method, path):
+            if method == "POST" and "uploadId=" in path:
+                for upload in self.store.uploads.values():
+                    data, etag = upload["parts"][1]
+                    upload["parts"][1] = (data, "0" * 32)
+        self.server.fail_hook = change_etag
+        self.assertRaises(IntegrityError, self.upload)
+
+class CountingReader(object):
+    """
+    A stream that records, at every read, how many of the buffers it has
+    handed out the fake S3 hasn't yet received as parts
+    """
+
+    def __init__(self, data, received):
+        self.fp = StringIO(data)
+        self.received = received
+        self.reads = 0
+        self.most_held = 0
+
+    def read(self, size):
+        data = self.fp.read(size)
+        if data:
+            self.reads += 1
+            self.most_held = max(self.most_held, self.reads - self.received[0])
+        return data
+
+class StreamUploadTest(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        # Count the parts the fake has finished receiving
+        self.received = [0]
+        lock = threading.Lock()
+        put_part = self.put_part = fakes3.Handler._put_part
+        received = self.received
+        def counting_put_part(handler, *args):
+            try:
+                return put_part(handler, *args)
+            finally:
+                lock.acquire()
+                received[0] += 1
+                lock.release()
+        fakes3.Handler._put_part = counting_put_part
+
+    def tearDown(self):
+        fakes3.Handler._put_part = self.put_part
+        self.server.latency = 0
+        FakeS3TestCase.tearDown(self)
+
+    def test_short_stream_is_one_put(self):
+        uploads = self.manager.upload(StringIO("short"), self.url("obj")).result()
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], "short")
+        self.assertEqual(uploads[0].size, 5)
+        counts = self.store.reset_counts()
+        self.assertEqual(counts.get("PUT"), 1)
+        self.assertEqual(counts.get("POST"), None)
+
+    def test_empty_stdin(self):
+        stdin, sys.stdin = sys.stdin, StringIO("")
+        try:
+            uploads = self.manager.upload("-", self.url("obj")).result()
+        finally:
+            sys.stdin = stdin
+        self.assertEqual(uploads[0].size, 0)
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], "")
+
+    def test_stdin(self):
+        data = os.urandom(12*MB)
+        stdin, sys.stdin = sys.stdin, StringIO(data)
+        try:
+            uploads = self.manager.upload("-", self.url("obj"), split=5, verify=True).result()
+        finally:
+            sys.stdin = stdin
+        self.assertEqual(self.store.buckets["test"]["obj"]["data"], data)
+        self.assertEqual(uploads[0].parts, 3)
+        self.assertEqual(self.store.uploads, {})
+
+    def test_buffers_are_bounded(self):
+        self.server.latency = 0.05
+        stream = CountingReader(os.urandom(40*MB), self.received)
+        self.manager.upload(stream, self.url("obj"), split=5, max_buffers=2).result()
+        self.assertEqual(stream.reads, 8)
+        self.assertEqual(stream.most_held, 2)
+
+    def test_stream_options(self):
+        for option in ("resume", "auto", "sync", "compress"):
+            future = self.manager.upload(StringIO("data"), self.url("obj"), **{option: option == "compress"
+                    and "gzip" or True})
+            self.assertRaises(ValueError, future.result)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import errno
+import os
+import unittest
+
+from fake import FakeS3TestCase
+
+from s3mp import writer
+from s3mp.tuning import MB
+from s3mp.writer import ALIGNMENT, BUFFER_SIZE, RangeWriter, preallocate
+
+class WriterTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        FakeS3TestCase.setUp(self)
+        self.fname = self.path("dest")
+        self.libc_function = writer._libc_function
+        self.os_open = os.open
+
+    def tearDown(self):
+        writer._libc_function = self.libc_function
+        os.open = self.os_open
+        FakeS3TestCase.tearDown(self)
+
+    def preallocated(self, size):
+        fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT)
+        try:
+            preallocate(fd, size)
+        finally:
+            os.close(fd)
+
+    def contents(self):
+        return open(self.fname, "rb").read()
+
+    def without_o_direct(self):
+        """
+        Have opening a file with O_DIRECT fail, as it does on tmpfs
+        """
+        os_open = self.os_open
+        def open_without_o_direct(path, flags, *args):
+            if flags & os.O_DIRECT:
+                raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+            return os_open(path, flags, *args)
+        os.open = open_without_o_direct
+
+class PreallocateTest(WriterTestCase):
+
+    def test_preallocate(self):
+        self.preallocated(3*MB + 5)
+        st = os.stat(self.fname)
+        self.assertEqual(st.st_size, 3*MB + 5)
+        # The blocks are allocated, not left as a hole
+        self.assertTrue(st.st_blocks * 512 >= 3*MB + 5)
+
+    def test_fallback_to_truncate(self):
+        calls = []
+        def unsupported(fd, offset, length):
+            calls.append((offset, length))
+            return errno.EOPNOTSUPP
+        writer._libc_function = lambda name, *argtypes: name == "posix_fallocate64" and unsupported or None
+        self.preallocated(MB)
+        self.assertEqual(calls, [(0, MB)])
+        self.assertEqual(os.path.getsize(self.fname), MB)
+
+        os.remove(self.fname)
+        writer._libc_function = lambda name, *argtypes: None
+        self.preallocated(MB)
+        self.assertEqual(os.path.getsize(self.fname), MB)
+
+    def test_other_errors_are_raised(self):
+        writer._libc_function = lambda name, *argtypes: lambda fd, offset, length: errno.ENOSPC
+        self.assertRaises(OSError, self.preallocated, MB)
+
+class RangeWriterTest(WriterTestCase):
+
+    def write(self, offset, chunks, direct=True):
+        range_writer = RangeWriter(self.fname, offset, direct)
+        for chunk in chunks:
+            range_writer.write(chunk)
+        range_writer.close()
+        return range_writer
+
+    def test_direct_with_unaligned_head_and_tail(self):
+        size = 2*BUFFER_SIZE + 3*ALIGNMENT
+        self.preallocated(size)
+        data = os.urandom(size - 200)
+        # Chunks that cross the buffer's boundaries
+        chunks = [data[i:i + 1000000] for i in range(0, len(data), 1000000)]
+        range_writer = self.write(100, chunks)
+        self.assertTrue(range_writer.direct_fd is not None, "O_DIRECT isn't supported here")
+        self.assertEqual(self.contents(), "\0" * 100 + data + "\0" * 100)
+
+    def test_direct_range_within_a_page(self):
+        self.preallocated(ALIGNMENT)
+        self.write(10, ["abc", "def"])
+        self.assertEqual(self.contents(), "\0" * 10 + "abcdef" + "\0" * (ALIGNMENT - 16))
+
+    def test_fallback_without_o_direct(self):
+        self.without_o_direct()
+        size = BUFFER_SIZE + 10
+        self.preallocated(size)
+        data = os.urandom(size - 7)
+        range_writer = self.write(7, [data[:5], data[5:]])
+        self.assertTrue(range_writer.direct_fd is None)
+        self.assertEqual(self.contents(), "\0" * 7 + data)
+
+class DirectDownloadTest(WriterTestCase):
+
+    def setUp(self):
+        WriterTestCase.setUp(self)
+        self.data = os.urandom(9*MB + 1234)
+        self.store.put_object("test", "obj", self.data)
+
+    def download(self):
+        self.manager.download(self.url("obj"), self.fname, split=2, direct=True).result()
+        self.assertEqual(self.contents(), self.data)
+
+    def test_direct_download(self):
+        self.download()
+
+    def test_direct_download_without_o_direct(self):
+        self.without_o_direct()
+        self.download()
+
+if __name__ == "__main__":
+    unittest.main()